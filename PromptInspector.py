@@ -1,72 +1,100 @@
 import io
+import os
 import toml
 import json
 import asyncio
-import gzip
+import hashlib
+import time
 import traceback
+import aiohttp
 import discord
-import requests
 from discord import Intents, Embed, ButtonStyle, Message, Attachment, File, RawReactionActionEvent, ApplicationContext, \
-    Interaction, Emoji, PartialEmoji
+    Interaction, Emoji, PartialEmoji, RawMessageUpdateEvent, RawMessageDeleteEvent, RawBulkMessageDeleteEvent, Option
 from discord.ext import commands
 from discord.ui import View, button, Button
-from PIL import Image
 from collections import OrderedDict
 
+from backfill import Backfill, Checkpoints
+from budget import BudgetTimeout, MemoryBudget
+from buttonstore import ButtonStore
+from cache import CacheEntry, MetadataCache
+from civitai import CivitaiClient
+from containers import fetch_header
+from discord_cache import RestCache
+from metrics import Metrics, current_path
+from outbound import DEFAULT_PRIORITY, PRIORITIES, Debouncer, SendQueue, route_of
+from parsing import comfyui_parse, get_params_from_string, get_info_from_text, read_image_info, pretty_json, \
+    detect_format, novelai_get_data, index_fields
+from promptindex import PromptIndex
+from replies import MAX_EMBEDS, ReplyPacker
+from singleflight import SingleFlight
+from stealth import stream_memory
+from workers import RemoteWorkers, Workers
+
 CONFIG = toml.load('config.toml')
+# set by cluster.py for each bot process it runs
+SHARD_IDS = [int(shard) for shard in os.environ['PICHAN_SHARDS'].split(",")] if os.environ.get('PICHAN_SHARDS') else None
+PROCESS_INDEX = int(os.environ.get('PICHAN_PROCESS', 0))
+PROCESSES = int(os.environ.get('PICHAN_PROCESSES', 1))
+PARSE_SERVER = os.environ.get('PICHAN_PARSE_SERVER')
 monitored = CONFIG.get('MONITORED_CHANNEL_IDS', [])
 SCAN_LIMIT_BYTES = CONFIG.get('SCAN_LIMIT_BYTES', 40 * 1024 ** 2)  # Default 40 MB
 CAN_DELETE_EMBED = CONFIG.get('CAN_DELETE_EMBED', [])
 EMBED_COLOR = CONFIG.get("EMBED_COLOR")
+if PARSE_SERVER:
+    workers = RemoteWorkers(PARSE_SERVER, CONFIG.get('PARSE_SECRET'), timeout=CONFIG.get('WORKER_TIMEOUT', 30))
+else:
+    workers = Workers(mode=CONFIG.get('WORKER_MODE', 'process'), count=CONFIG.get('WORKER_COUNT'),
+                      timeout=CONFIG.get('WORKER_TIMEOUT', 30), max_tasks=CONFIG.get('WORKER_MAX_TASKS', 500))
+civitai_client = CivitaiClient(api_url=CONFIG.get('CIVITAI_API_URL', 'https://civitai.com/api/v1'),
+                               max_entries=CONFIG.get('CIVITAI_CACHE_SIZE', 10000),
+                               cache_path=CONFIG.get('CIVITAI_CACHE_PATH'))
+metadata_cache = MetadataCache(max_bytes=CONFIG.get('METADATA_CACHE_BYTES', 64 * 1024 ** 2))
+attachment_flights = SingleFlight()  # attachment id -> the download/parse already running for it
+memory_budget = MemoryBudget(max_bytes=CONFIG.get('MEMORY_BUDGET_BYTES', 512 * 1024 ** 2) // PROCESSES,
+                             max_wait=CONFIG.get('MEMORY_BUDGET_WAIT', 60))
+send_queue = SendQueue(route_rate=CONFIG.get('SEND_ROUTE_RATE', 5), route_per=CONFIG.get('SEND_ROUTE_SECONDS', 5),
+                       global_rate=max(1, CONFIG.get('SEND_GLOBAL_RATE', 45) // PROCESSES))  # per bot, not process
+button_store = ButtonStore(path=CONFIG.get('BUTTON_STORE_PATH'), max_bytes=CONFIG.get('BUTTON_STORE_BYTES', 256 * 1024 ** 2))
+prompt_index = PromptIndex(CONFIG['INDEX_PATH']) if CONFIG.get('INDEX_PATH') else None  # per-guild opt-in
+reply_debounce = Debouncer(window=CONFIG.get('REPLY_DEBOUNCE_SECONDS', 30))  # (path, user id, message id)
+backfill_checkpoints = Checkpoints(CONFIG.get('BACKFILL_STATE_PATH'))
+backfills = {}  # channel id -> the Backfill running or last run there
 intents = Intents.default() | Intents.message_content | Intents.members
-client = commands.Bot(intents=intents)
-
-
-def comfyui_get_data(dat):
-    try:
-        aa = []
-        dat = json.loads(dat)
-        for key, value in dat.items():
-            if value['class_type'] == "CLIPTextEncode":
-                aa.append({"val": value['inputs']['text'],
-                           "type": "prompt"})
-            elif value['class_type'] == "CheckpointLoaderSimple":
-                aa.append({"val": value['inputs']['ckpt_name'],
-                           "type": "model"})
-            elif value['class_type'] == "LoraLoader":
-                aa.append({"val": value['inputs']['lora_name'],
-                           "type": "lora"})
-        return aa
-    except Exception as e:
-        print(e)
-        return []
-
-
-def get_params_from_string(param_str):
-    output_dict = {}
-    parts = param_str.split('Steps: ')
-    prompts = parts[0]
-    params = 'Steps: ' + parts[1]
-    if 'Negative prompt: ' in prompts:
-        output_dict['Prompt'] = prompts.split('Negative prompt: ')[0]
-        output_dict['Negative Prompt'] = prompts.split('Negative prompt: ')[1]
-        if len(output_dict['Negative Prompt']) > 1024:
-            output_dict['Negative Prompt'] = output_dict['Negative Prompt'][:1020] + '...'
-    else:
-        output_dict['Prompt'] = prompts
-    if len(output_dict['Prompt']) > 1024:
-        output_dict['Prompt'] = output_dict['Prompt'][:1020] + '...'
-    params = params.split(', ')
-    for param in params:
-        try:
-            key, value = param.split(': ')
-            output_dict[key] = value
-        except ValueError:
-            pass
-    return output_dict
-
-
-def get_embed(embed_dict, context: Message, req_author=None):
+if SHARD_IDS is not None:
+    # guilds, and so their channels, messages and reactions, belong to one shard and so to one process;
+    # DMs and their buttons go to shard 0
+    client = commands.AutoShardedBot(intents=intents, shard_ids=SHARD_IDS,
+                                     shard_count=int(os.environ['PICHAN_SHARD_COUNT']),
+                                     auto_sync_commands=PROCESS_INDEX == 0)
+else:
+    client = commands.Bot(intents=intents)
+http_session = None
+rest_cache = RestCache(client)
+metrics = Metrics()
+metrics.add_source("workers", workers.stats)
+metrics.add_source("metadata_cache", metadata_cache.stats)
+metrics.add_source("civitai", civitai_client.stats)
+metrics.add_source("attachment_reads", attachment_flights.stats)
+metrics.add_source("memory_budget", memory_budget.stats)
+metrics.add_source("discord_rest", rest_cache.stats)
+metrics.add_source("send_queue", send_queue.stats)
+metrics.add_source("button_store", button_store.stats)
+if prompt_index is not None:
+    metrics.add_source("prompt_index", prompt_index.metrics)
+metrics.add_source("reply_debounce", reply_debounce.stats)
+metrics.add_source("backfill", lambda: {"running": sum(job.running for job in backfills.values()),
+                                        "messages": sum(job.messages for job in backfills.values()),
+                                        "images": sum(job.images for job in backfills.values())})
+metrics_runner = None
+
+
+async def get_embed(embed_dict, context: Message, req_author=None):
+    with metrics.stage("embed", "a1111"):
+        return await _get_embed(embed_dict, context, req_author)
+
+
+async def _get_embed(embed_dict, context: Message, req_author=None):
     print(req_author)
     embed = Embed(
         title=f"Parsed metadata. Requested by @{req_author}" if req_author is not None else "Parsed metadata",
@@ -79,7 +107,8 @@ def get_embed(embed_dict, context: Message, req_author=None):
         if i >= 25:
             continue
         if key == "Model hash":
-            civitai_url = civitai(value)
+            with metrics.stage("civitai", "a1111"):
+                civitai_url = await civitai_client.lookup(value)
             if civitai_url is not None:
                 value += f" [(Civitai URL)]({civitai_url})"
         if len(key) > 255:
@@ -92,8 +121,13 @@ def get_embed(embed_dict, context: Message, req_author=None):
 
 
 def get_embed_nai(embed_dict_orig, context: Message, req_author=None):
+    with metrics.stage("embed", "novelai"):
+        return _get_embed_nai(embed_dict_orig, context, req_author)
+
+
+def _get_embed_nai(embed_dict_orig, context: Message, req_author=None):
     try:
-        embed_dict = json.loads(embed_dict_orig["Comment"])
+        embed_dict = novelai_get_data(embed_dict_orig)
         embed = Embed(
             title=f"Novelai metadata. Requested by @{req_author}" if req_author is not None else "Novelai metadata",
             color=discord.Color.from_rgb(*EMBED_COLOR))
@@ -105,7 +139,6 @@ def get_embed_nai(embed_dict_orig, context: Message, req_author=None):
         embed.add_field(name="Negative Prompt", value=embed_dict['uc'], inline=False)
         blacklist = ['prompt', 'uc', 'signed_hash', 'request_type']
 
-        embed_dict['Model Hash'] = embed_dict_orig['Source'].split()[-1:][0].lower()
         for key, value in embed_dict.items():
             if value == None or value == 'None' or key in blacklist:
                 continue
@@ -119,128 +152,6 @@ def get_embed_nai(embed_dict_orig, context: Message, req_author=None):
         print(traceback.format_exc())
 
 
-def read_info_from_image_stealth(image: Image.Image):
-    # trying to read stealth pnginfo
-    width, height = image.size
-    pixels = image.load()
-
-    has_alpha = True if image.mode == "RGBA" else False
-    mode = None
-    compressed = False
-    binary_data = ""
-    buffer_a = ""
-    buffer_rgb = ""
-    index_a = 0
-    index_rgb = 0
-    sig_confirmed = False
-    confirming_signature = True
-    reading_param_len = False
-    reading_param = False
-    read_end = False
-    for x in range(width):
-        for y in range(height):
-            if has_alpha:
-                r, g, b, a = pixels[x, y]
-                buffer_a += str(a & 1)
-                index_a += 1
-            else:
-                r, g, b = pixels[x, y]
-            buffer_rgb += str(r & 1)
-            buffer_rgb += str(g & 1)
-            buffer_rgb += str(b & 1)
-            index_rgb += 3
-            if confirming_signature:
-                if index_a == len("stealth_pnginfo") * 8:
-                    decoded_sig = bytearray(
-                        int(buffer_a[i: i + 8], 2) for i in range(0, len(buffer_a), 8)
-                    ).decode("utf-8", errors="ignore")
-                    if decoded_sig in {"stealth_pnginfo", "stealth_pngcomp"}:
-                        confirming_signature = False
-                        sig_confirmed = True
-                        reading_param_len = True
-                        mode = "alpha"
-                        if decoded_sig == "stealth_pngcomp":
-                            compressed = True
-                        buffer_a = ""
-                        index_a = 0
-                    else:
-                        read_end = True
-                        break
-                elif index_rgb == len("stealth_pnginfo") * 8:
-                    decoded_sig = bytearray(
-                        int(buffer_rgb[i: i + 8], 2) for i in range(0, len(buffer_rgb), 8)
-                    ).decode("utf-8", errors="ignore")
-                    if decoded_sig in {"stealth_rgbinfo", "stealth_rgbcomp"}:
-                        confirming_signature = False
-                        sig_confirmed = True
-                        reading_param_len = True
-                        mode = "rgb"
-                        if decoded_sig == "stealth_rgbcomp":
-                            compressed = True
-                        buffer_rgb = ""
-                        index_rgb = 0
-            elif reading_param_len:
-                if mode == "alpha":
-                    if index_a == 32:
-                        param_len = int(buffer_a, 2)
-                        reading_param_len = False
-                        reading_param = True
-                        buffer_a = ""
-                        index_a = 0
-                else:
-                    if index_rgb == 33:
-                        pop = buffer_rgb[-1]
-                        buffer_rgb = buffer_rgb[:-1]
-                        param_len = int(buffer_rgb, 2)
-                        reading_param_len = False
-                        reading_param = True
-                        buffer_rgb = pop
-                        index_rgb = 1
-            elif reading_param:
-                if mode == "alpha":
-                    if index_a == param_len:
-                        binary_data = buffer_a
-                        read_end = True
-                        break
-                else:
-                    if index_rgb >= param_len:
-                        diff = param_len - index_rgb
-                        if diff < 0:
-                            buffer_rgb = buffer_rgb[:diff]
-                        binary_data = buffer_rgb
-                        read_end = True
-                        break
-            else:
-                # impossible
-                read_end = True
-                break
-        if read_end:
-            break
-    if sig_confirmed and binary_data != "":
-        # Convert binary string to UTF-8 encoded text
-        byte_data = bytearray(int(binary_data[i: i + 8], 2) for i in range(0, len(binary_data), 8))
-        try:
-            if compressed:
-                decoded_data = gzip.decompress(bytes(byte_data)).decode("utf-8")
-            else:
-                decoded_data = byte_data.decode("utf-8", errors="ignore")
-            return decoded_data
-        except Exception as e:
-            print(e)
-            pass
-    return None
-
-def civitai(hash: str):
-    r = requests.get(f"https://civitai.com/api/v1/model-versions/by-hash/{hash.upper()}")
-    try:
-        arr = r.json()
-    except:
-        print("civitai succ")
-        return None
-    if r.status_code == 200:
-        return "https://civitai.com/models/" + str(arr["modelId"])
-    else:
-        return None
 @client.slash_command()
 async def privacy(ctx):
     """
@@ -248,10 +159,10 @@ async def privacy(ctx):
     """
     base = Embed(title="Privacy Policy", color=discord.Color.from_rgb(*EMBED_COLOR))
     base.add_field(name="What we collect",
-                   value="Other than simple data from your user (mainly username, role color) not much else other than when an image is sent in a **monitored channel**, the bot downloads it to its RAM and processes it.\n***We do not store any of your data/images.***",
+                   value="Other than simple data from your user (mainly username, role color) not much else other than when an image is sent in a **monitored channel**, the bot downloads it to its RAM and processes it.\n***We do not store your images.***",
                    inline=False)
     base.add_field(name="What we use/store",
-                   value="Whenever the bot has an error decoding an image, it will print out the error and data to the console. The data consists of the raw bytes in the image metadata. Whenever a mod/admin toggles a channel on/off, the bot will save the ID to storage in case of it crashing. Other than that, that is all we use/store.",
+                   value="Whenever the bot has an error decoding an image, it will print out the error and data to the console. The data consists of the raw bytes in the image metadata. Whenever a mod/admin toggles a channel on/off, the bot will save the ID to storage in case of it crashing. If a server's mods turn on the prompt index (/index), the prompt, negative prompt, model, LoRAs and sampler of images posted in its monitored channels are kept with a link to the message so /search can find them; /index_opt_out keeps yours out and deletes them. Other than that, that is all we use/store.",
                    inline=False)
     base.add_field(name="What we share",
                    value="***We do not share any of your data/images.*** There's no use for them lol.", inline=False)
@@ -265,6 +176,190 @@ async def privacy(ctx):
     await ctx.respond(embed=base, ephemeral=True)
 
 
+
+@client.slash_command()
+async def status(ctx: ApplicationContext):
+    """
+    Shows the bot's worker pool load and cache stats. (mods only)
+    """
+    user_roles = [role.id for role in ctx.author.roles]
+    if not any(role_id in CAN_DELETE_EMBED for role_id in user_roles):
+        await ctx.respond("You do not have permission to use this command.", ephemeral=True)
+        return
+    stats = workers.stats()
+    embed = Embed(title="PI-Chan status", color=discord.Color.from_rgb(*EMBED_COLOR))
+    embed.add_field(name="Workers", value=f"{stats['workers']} ({stats['mode']})", inline=True)
+    embed.add_field(name="Busy / queued", value=f"{stats['busy']} / {stats['queued']}", inline=True)
+    embed.add_field(name="Utilisation", value=f"{stats['utilisation']:.1%}", inline=True)
+    embed.add_field(name="Jobs", value=f"{stats['completed']} done, {stats['failed']} failed, "
+                                       f"{stats['timeouts']} timed out, {stats['recycles']} pool restarts", inline=False)
+    civitai_stats = civitai_client.stats()
+    embed.add_field(name="Civitai cache", value=f"{civitai_stats['entries']} hashes, {civitai_stats['hits']} hits, "
+                                                f"{civitai_stats['requests']} requests, {civitai_stats['errors']} errors",
+                    inline=False)
+    cache_stats = metadata_cache.stats()
+    embed.add_field(name="Metadata cache", value=f"{cache_stats['entries']} images, {cache_stats['bytes'] / 1024 ** 2:.1f} MB, "
+                                                 f"{cache_stats['id_hits'] + cache_stats['hash_hits']} hits, "
+                                                 f"{cache_stats['misses']} misses, {cache_stats['evictions']} evictions",
+                    inline=False)
+    flight_stats = attachment_flights.stats()
+    embed.add_field(name="Attachment reads", value=f"{flight_stats['started']} started, {flight_stats['shared']} shared, "
+                                                   f"{flight_stats['in_flight']} running", inline=False)
+    rest_stats = rest_cache.stats()
+    embed.add_field(name="Discord REST", value=f"{sum(rest_stats['avoided'].values())} calls avoided, "
+                                               f"{sum(rest_stats['rest_calls'].values())} made "
+                                               f"({', '.join(f'{k}: {v}' for k, v in rest_stats['rest_calls'].items()) or 'none'})",
+                    inline=False)
+    queue_stats, debounce_stats = send_queue.stats(), reply_debounce.stats()
+    embed.add_field(name="Send queue", value=f"{queue_stats['queued']} queued, {queue_stats['sent']} sent, "
+                                             f"{queue_stats['rate_limited']} rate limited, "
+                                             f"{debounce_stats['collapsed']} repeat requests dropped", inline=False)
+    budget_stats = memory_budget.stats()
+    embed.add_field(name="Memory budget", value=f"{budget_stats['used'] / 1024 ** 2:.0f} / {budget_stats['max_bytes'] / 1024 ** 2:.0f} MB "
+                                                f"(peak {budget_stats['peak'] / 1024 ** 2:.0f} MB), {budget_stats['waiting']} waiting, "
+                                                f"{budget_stats['timeouts']} timed out", inline=False)
+    await ctx.respond(embed=embed, ephemeral=True)
+
+
+@client.slash_command(name="metrics")
+async def metrics_summary(ctx: ApplicationContext):
+    """
+    Shows how long each stage of image handling takes. (mods only)
+    """
+    user_roles = [role.id for role in ctx.author.roles]
+    if not any(role_id in CAN_DELETE_EMBED for role_id in user_roles):
+        await ctx.respond("You do not have permission to use this command.", ephemeral=True)
+        return
+    embed = Embed(title="PI-Chan stage latency", color=discord.Color.from_rgb(*EMBED_COLOR))
+    for stage, (runs, errors, p50, p99) in sorted(metrics.summary().items()):
+        embed.add_field(name=stage, value=f"{runs} runs, {errors} errors\np50 {p50 * 1000:.0f} ms, p99 {p99 * 1000:.0f} ms",
+                        inline=True)
+    images = metrics.total("pichan_reply_images_total")
+    if images:
+        embed.add_field(name="replies", value=f"{images:.0f} images in "
+                                              f"{metrics.total('pichan_reply_messages_total'):.0f} messages", inline=True)
+    if not embed.fields:
+        embed.description = "Nothing measured yet."
+    await ctx.respond(embed=embed, ephemeral=True)
+
+@client.slash_command()
+async def search(ctx: ApplicationContext,
+                 query: Option(str, "Words that must all be in the prompt, negative prompt or LoRAs (word* for prefixes)"),
+                 model: Option(str, "Only images made with a model matching these words", required=False, default=None)):
+    """
+    Searches the prompts of images posted in this server's monitored channels.
+    """
+    if prompt_index is None or ctx.guild is None or ctx.guild.id not in prompt_index.guilds:
+        await ctx.respond("The prompt index isn't turned on in this server.", ephemeral=True)
+        return
+    with metrics.stage("search"):
+        results = await prompt_index.search(ctx.guild.id, query, model or "")
+    embed = Embed(title=f"Prompts matching \"{query}\"", color=discord.Color.from_rgb(*EMBED_COLOR))
+    for guild_id, channel_id, message_id, author_id, fmt, prompt, model_name, sampler, loras in results:
+        prompt = prompt if len(prompt) <= 300 else prompt[:297] + '...'
+        embed.add_field(name=f"{model_name or fmt}"[:256],
+                        value=f"{prompt}\n[Jump to image](https://discord.com/channels/{guild_id}/{channel_id}/{message_id}) "
+                              f"by <@{author_id}>", inline=False)
+    if not results:
+        embed.description = "Nothing found."
+    await ctx.respond(embed=embed, ephemeral=True)
+
+
+@client.slash_command(name="stats")
+async def index_stats(ctx: ApplicationContext):
+    """
+    Shows the most used models, LoRAs and samplers in this server's indexed images.
+    """
+    if prompt_index is None or ctx.guild is None or ctx.guild.id not in prompt_index.guilds:
+        await ctx.respond("The prompt index isn't turned on in this server.", ephemeral=True)
+        return
+    with metrics.stage("stats"):
+        stats = await prompt_index.stats(ctx.guild.id)
+    total = stats.get("total", [("", 0)])[0][1]
+    embed = Embed(title="PI-Chan prompt index", description=f"{total} images indexed",
+                  color=discord.Color.from_rgb(*EMBED_COLOR))
+    for kind, title in (("format", "Made with"), ("model", "Models"), ("lora", "LoRAs"), ("sampler", "Samplers")):
+        if stats.get(kind):
+            embed.add_field(name=title, value="\n".join(f"{value[:80]}: {n}" for value, n in stats[kind]),
+                            inline=kind == "format")
+    await ctx.respond(embed=embed, ephemeral=True)
+
+
+@client.slash_command(name="index")
+async def toggle_index(ctx: ApplicationContext,
+                       enabled: Option(bool, "Whether images posted in monitored channels are indexed for /search")):
+    """
+    Turns the prompt index on/off for this server; off deletes what was indexed. (mods only)
+    """
+    user_roles = [role.id for role in ctx.author.roles]
+    if not any(role_id in CAN_DELETE_EMBED for role_id in user_roles):
+        await ctx.respond("You do not have permission to use this command.", ephemeral=True)
+        return
+    if prompt_index is None:
+        await ctx.respond("The prompt index isn't set up on this bot (INDEX_PATH in config.toml).", ephemeral=True)
+        return
+    deleted = await prompt_index.set_guild(ctx.guild.id, enabled, ctx.author.id)
+    await ctx.respond("New images in monitored channels will be indexed." if enabled else
+                      f"Indexing is off, {deleted} indexed images were deleted.", ephemeral=True)
+
+
+@client.slash_command(name="index_opt_out")
+async def index_opt_out(ctx: ApplicationContext,
+                        opt_out: Option(bool, "False to be indexed again", required=False, default=True)):
+    """
+    Keeps your images out of the prompt index and deletes the ones already in it.
+    """
+    if prompt_index is None:
+        await ctx.respond("The prompt index isn't set up on this bot, nothing of yours is stored.", ephemeral=True)
+        return
+    deleted = await prompt_index.set_opt_out(ctx.author.id, opt_out)
+    await ctx.respond(f"Done, your images won't be indexed. {deleted} entries were deleted." if opt_out else
+                      "Done, your images will be indexed again where the index is turned on.", ephemeral=True)
+
+
+@client.slash_command(name="backfill")
+async def backfill_channel(ctx: ApplicationContext,
+                           channel: Option(discord.TextChannel, "A monitored channel (defaults to this one)",
+                                           required=False, default=None),
+                           stop: Option(bool, "Stop the backfill running there", required=False, default=False),
+                           restart: Option(bool, "Start over from the oldest message", required=False, default=False)):
+    """
+    Reacts to and indexes older images in a monitored channel, resuming where it stopped. (mods only)
+    """
+    user_roles = [role.id for role in ctx.author.roles]
+    if not any(role_id in CAN_DELETE_EMBED for role_id in user_roles):
+        await ctx.respond("You do not have permission to use this command.", ephemeral=True)
+        return
+    channel = channel or ctx.channel
+    if channel.id not in monitored:
+        await ctx.respond(f"{channel.mention} isn't a monitored channel.", ephemeral=True)
+        return
+    job = backfills.get(channel.id)
+    if stop or (job is not None and job.running):
+        if stop and job is not None and job.running:
+            await ctx.defer(ephemeral=True)
+            job.task.cancel()
+            await asyncio.wait([job.task])  # so the progress shown is where it really stopped
+        await ctx.respond(f"Backfill of {channel.mention}: {job.progress()}" if job is not None else
+                          f"Nothing is running in {channel.mention}.", ephemeral=True)
+        return
+    if restart:
+        backfill_checkpoints.reset(channel.id)
+    job = backfills[channel.id] = Backfill(channel, backfill_message, backfill_checkpoints,
+                                           concurrency=CONFIG.get('BACKFILL_CONCURRENCY', 4))
+    job.start()
+    await ctx.respond(f"Backfill of {channel.mention} started.", ephemeral=True)
+    # interaction tokens last 15 minutes; /backfill again shows the progress after that
+    deadline = time.monotonic() + 14 * 60
+    while job.running and time.monotonic() < deadline:
+        await asyncio.wait([job.task], timeout=10)
+        try:
+            await ctx.interaction.edit_original_response(content=f"Backfill of {channel.mention}: {job.progress()}")
+        except discord.HTTPException:
+            break
+    if not job.running:
+        print(f"Backfill of #{channel.name} ({channel.id}) {job.progress()}")
+
 # @client.slash_command()
 # async def toggle_channel(ctx: ApplicationContext, channel_id):
 #     """
@@ -303,50 +398,176 @@ async def privacy(ctx):
 
 @client.event
 async def on_ready():
+    global metrics_runner
     print(f"Logged in as {client.user}!")
+    # buttons of messages sent before a restart route here by custom_id
+    client.add_view(DmView.listener())
+    client.add_view(ServerView(store=True))
+    if CONFIG.get('METRICS_PORT') and metrics_runner is None:
+        port = CONFIG.get('METRICS_PORT') + PROCESS_INDEX
+        metrics_runner = await metrics.serve(CONFIG.get('METRICS_HOST', '127.0.0.1'), port)
+        print(f"Serving metrics on http://{CONFIG.get('METRICS_HOST', '127.0.0.1')}:{port}/metrics")
+
+
+@client.event
+async def on_guild_emojis_update(guild, before, after):
+    rest_cache.forget_guild_emojis(guild.id)
+
+
+@client.event
+async def on_guild_channel_update(before, after):
+    rest_cache.forget_channel(after.id)
+
+
+@client.event
+async def on_guild_channel_delete(channel):
+    rest_cache.forget_channel(channel.id)
+
+
+@client.event
+async def on_thread_delete(thread):
+    rest_cache.forget_channel(thread.id)
+
+
+@client.event
+async def on_raw_message_edit(payload: RawMessageUpdateEvent):
+    rest_cache.forget_message(payload.message_id)
+
+
+@client.event
+async def on_raw_message_delete(payload: RawMessageDeleteEvent):
+    rest_cache.forget_message(payload.message_id)
+
+
+@client.event
+async def on_raw_bulk_message_delete(payload: RawBulkMessageDeleteEvent):
+    for message_id in payload.message_ids:
+        rest_cache.forget_message(message_id)
 
 
 @client.event
 async def on_message(message: Message):
     if message.channel.id in monitored and message.attachments:
-        attachments = [a for a in message.attachments if
-                       a.filename.lower().endswith(".png") and a.size < SCAN_LIMIT_BYTES]
+        current_path.set("on_message")
+        metrics.inc("pichan_events_total", path="on_message")
+        attachments = [a for a in message.attachments if is_image(a) and a.size < SCAN_LIMIT_BYTES]
+        indexing = prompt_index is not None and message.guild is not None and \
+            prompt_index.enabled(message.guild.id, message.author.id)
+        reacted = False
         for i, attachment in enumerate(
                 attachments):  # download one at a time as usually the first image is already ai-generated
             metadata = OrderedDict()
             await read_attachment_metadata(i, attachment, metadata)
-            if metadata:
+            if not metadata:
+                continue
+            if indexing:
+                await index_attachment(attachment, message, metadata[i])
+            if not reacted:
                 # await message.add_reaction('🔎')
-                emoji_shit = await message.guild.fetch_emoji(CONFIG.get("EMOJI_ID"))
-                await message.add_reaction(emoji_shit)
+                emoji_shit = await rest_cache.emoji(message.guild, CONFIG.get("EMOJI_ID"))
+                with metrics.stage("react"):
+                    await send_queue.submit(route_of(message.add_reaction),
+                                            PRIORITIES.get(current_path.get(), DEFAULT_PRIORITY),
+                                            lambda: message.add_reaction(emoji_shit))
+                rest_cache.remember_message(message)  # reactions to it won't have to fetch it again
+                reacted = True
+            if not indexing:  # the rest of the post only matters to the index
                 return
 
 
+async def index_attachment(attachment: Attachment, message: Message, info):
+    """Queues an image's searchable fields for the prompt index"""
+    try:
+        fields = await run_parser(attachment, index_fields, info)
+        prompt_index.add(attachment, message, fields)
+    except:
+        print(traceback.format_exc())
+
+
+async def backfill_message(message: Message) -> tuple:
+    """What on_message would have done with an old post, from header reads only (no stealth pnginfo)
+    and reacting at the lowest send priority. Returns (images, images with metadata)."""
+    current_path.set("backfill")
+    attachments = [a for a in message.attachments if is_image(a) and a.size < SCAN_LIMIT_BYTES]
+    indexing = prompt_index is not None and message.guild is not None and \
+        prompt_index.enabled(message.guild.id, message.author.id)
+    metadata = OrderedDict()
+    for i, attachment in enumerate(attachments):
+        await read_attachment_metadata(i, attachment, metadata, header_only=True)
+        if i not in metadata:
+            continue
+        if indexing:
+            await index_attachment(attachment, message, metadata[i])
+        else:
+            break
+    if not metadata:
+        return len(attachments), 0
+    rest_cache.remember_message(message)
+    emoji = await rest_cache.emoji(message.guild, CONFIG.get("EMOJI_ID"))
+    if not any(reaction.me and getattr(reaction.emoji, "id", None) == emoji.id for reaction in message.reactions):
+        with metrics.stage("react"):
+            await send_queue.submit(route_of(message.add_reaction), PRIORITIES["backfill"],
+                                    lambda: message.add_reaction(emoji))
+    return len(attachments), len(metadata)
+
+
+FULL_PARAMETERS = "pichan:full:"  # + position of the embed in the message
+
+
+def _buttons(message: Message) -> list:
+    for row in message.components:
+        yield from getattr(row, "children", [row])
+
+
 class DmView(View):
-    def __init__(self):
-        super().__init__(timeout=3600, disable_on_timeout=True)
-        self.metadata = None
-
-    @button(label='Full Parameters', style=ButtonStyle.green)
-    async def details(self, button, interaction):
-        button.disabled = True
-        await interaction.response.edit_message(view=self)
-        if len(self.metadata) > 1980:
+    """"Full Parameters" buttons. The metadata they show is in button_store, looked up by message id and
+    embed position on click, so sent views hold nothing and keep working after a restart."""
+
+    def __init__(self, buttons=(), store: bool = False):
+        super().__init__(timeout=None, store=store)
+        for position, label, disabled in buttons:
+            details = Button(label=label, style=ButtonStyle.green, custom_id=f"{FULL_PARAMETERS}{position}",
+                             disabled=disabled)
+            details.callback = self.details
+            self.add_item(details)
+
+    @classmethod
+    def for_metadata(cls, metadata: list) -> "DmView":
+        """One button per embed that has metadata to expand"""
+        expandable = [n for n, data in enumerate(metadata) if data is not None]
+        return cls([(n, 'Full Parameters' if len(expandable) == 1 else f'Full Parameters #{n + 1}', False)
+                    for n in expandable])
+
+    @classmethod
+    def listener(cls) -> "DmView":
+        """Registered once with client.add_view, it answers the buttons of every DmView ever sent"""
+        return cls([(n, "Full Parameters", False) for n in range(MAX_EMBEDS)], store=True)
+
+    async def details(self, interaction: Interaction):
+        current_path.set("full_parameters")
+        clicked = interaction.data["custom_id"]
+        metadata = await button_store.get(interaction.message.id, int(clicked[len(FULL_PARAMETERS):]))
+        if metadata is None:
+            await interaction.response.send_message("Sorry, these parameters aren't kept anymore.", ephemeral=True)
+            return
+        await interaction.response.edit_message(view=DmView(
+            [(int(b.custom_id[len(FULL_PARAMETERS):]), b.label, b.disabled or b.custom_id == clicked)
+             for b in _buttons(interaction.message) if (b.custom_id or "").startswith(FULL_PARAMETERS)]))
+        if len(metadata) > 1980:
             with io.StringIO() as f:
-                indented = json.dumps(json.loads(self.metadata), sort_keys=True, indent=2)
+                indented = await workers.run(pretty_json, metadata)
                 f.write(indented)
                 f.seek(0)
-                await interaction.followup.send(file=File(f, "parameters.yaml"))
+                await send(interaction.followup.send, file=File(f, "parameters.yaml"))
         else:
-            await interaction.followup.send(f"```yaml\n{self.metadata}```")
+            await send(interaction.followup.send, f"```yaml\n{metadata}```")
 
 
 class ServerView(View):
-    def __init__(self):
-        super().__init__(timeout=3600)
-        self.metadata = None
+    def __init__(self, store: bool = False):
+        super().__init__(timeout=None, store=store)
 
-    @button(label='🗑️', style=ButtonStyle.red)
+    @button(label='🗑️', style=ButtonStyle.red, custom_id="pichan:delete")
     async def delete_message(self, button, interaction: Interaction):
         user_roles = [role.id for role in interaction.user.roles]
         if any(role_id in CAN_DELETE_EMBED for role_id in user_roles):
@@ -355,215 +576,316 @@ class ServerView(View):
             await interaction.response.send_message("You don't have permission to delete this message.", ephemeral=True)
 
 
-async def read_attachment_metadata(i: int, attachment: Attachment, metadata: OrderedDict):
+async def send(method, *args, **kwargs):
+    """Sends through `method` (channel.send, message.reply, ...) once the send queue gives its route a turn,
+    context-menu replies first, and times it"""
+    async def call():
+        with metrics.stage("send"):
+            return await method(*args, **kwargs)
+    return await send_queue.submit(route_of(method), PRIORITIES.get(current_path.get(), DEFAULT_PRIORITY), call)
+
+
+async def send_replies(method, replies: ReplyPacker, view=None) -> int:
+    """Sends the packed replies through `method`; `view(metadata per embed)` makes each message's view.
+    Returns how many messages that took."""
+    messages = replies.pack()
+    for packed in messages:
+        files = [File(io.StringIO(text), name) for name, text in packed.attachments()]
+        sent_view = view(packed.metadata) if view is not None else None
+        kwargs = {"view": sent_view} if sent_view is not None else {}
+        try:
+            sent = await send(method, content="\n".join(packed.content) or None, embeds=packed.embeds, files=files,
+                              mention_author=False, **kwargs)
+        finally:
+            for file in files:
+                file.close()
+        if isinstance(sent_view, DmView) and sent_view.children:
+            await button_store.put(sent.id, packed.metadata)
+    metrics.inc("pichan_reply_images_total", len(replies), path=current_path.get())
+    metrics.inc("pichan_reply_messages_total", len(messages), path=current_path.get())
+    return len(messages)
+
+
+async def add_reply(replies: ReplyPacker, attachment: Attachment, data, message: Message, req_author=None) -> bool:
+    """Adds the embed for one image (and the workflow file for ComfyUI) to `replies`.
+    False if A1111 parameters couldn't be parsed into an embed."""
+    if 'Steps:' in data:
+        try:
+            params = await run_parser(attachment, get_params_from_string, data)
+            embed = await get_embed(params, message, req_author)
+        except:
+            print(traceback.format_exc())
+            return False
+        embed.set_image(url=attachment.url)
+        replies.add(embed=embed, metadata=data)
+    elif 'Software' in data:
+        if isinstance(data, str):
+            data = json.loads(data)
+        embed = get_embed_nai(data, message, req_author)
+        embed.set_image(url=attachment.url)
+        replies.add(embed=embed, metadata=json.dumps(data))
+    elif "\"inputs\"" in data:
+        i = 0
+        comfyui = await run_parser(attachment, comfyui_parse, data)
+        with metrics.stage("embed", "comfyui"):
+            title = f"ComfyUI Parameters. Requested by @{req_author}" if req_author is not None else "ComfyUI Parameters"
+            embed = Embed(title=title, color=discord.Color.from_rgb(*EMBED_COLOR))
+            for enum, dax in enumerate(comfyui['fields']):
+                i += 1
+                if i >= 25:
+                    break  # why the hell continue? just break...
+                embed.add_field(name=f"{dax['type']} {enum + 1} (beta)", value=dax['val'], inline=True)
+            embed.set_footer(text=f'Posted by {message.author}', icon_url=message.author.display_avatar)
+        embed.set_image(url=attachment.url)
+        replies.add(embed=embed, files=[("parameters.json", comfyui['pretty'])])
+    return True
+
+
+async def get_http_session() -> aiohttp.ClientSession:
+    global http_session
+    if http_session is None or http_session.closed:
+        # header reads give up on a stalled CDN quickly and fall back to attachment.read()
+        timeout = CONFIG.get('HTTP_TIMEOUT', 15)
+        http_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None, sock_connect=timeout,
+                                                                           sock_read=timeout))
+    return http_session
+
+
+async def read_attachment_metadata(i: int, attachment: Attachment, metadata: OrderedDict, header_only: bool = False):
     """Allows downloading in bulk"""
     try:
-        image_data = await attachment.read()
-        with Image.open(io.BytesIO(image_data)) as img:
-            info = None
-            if img.info:
-                if 'parameters' in img.info:
-                    info = img.info['parameters']
-                elif 'prompt' in img.info or 'Prompt' in img.info:
-                    info = img.info['prompt']
-                elif "Software" in img.info:
-                    info = img.info
-            else:
-                info = read_info_from_image_stealth(img)
-
-            if info:
-                metadata[i] = info
+        entry = metadata_cache.get_by_id(attachment.id)
+        if entry is None:
+            key = ("header", attachment.id) if header_only else attachment.id
+            entry = await attachment_flights.do(key, extract_attachment_metadata, attachment, header_only)
+        if entry.info:
+            metadata[i] = entry.info
+    except BudgetTimeout as e:
+        print(f"Skipped {attachment.url}: {e}")
     except:
         print(traceback.format_exc())
 
 
+def estimate_read_memory(attachment: Attachment, png) -> int:
+    """Download bytes plus the decoded pixel buffer of a full read"""
+    if png is not None and png.width is not None and png.streamable:
+        decoded = stream_memory(png.width, png.height, png.color_type)
+    elif png is not None and png.decoded_size is not None:
+        decoded = png.decoded_size
+    elif attachment.width and attachment.height:
+        decoded = attachment.width * attachment.height * 4
+    else:
+        decoded = attachment.size * 4
+    copies = 2 if workers.mode != "thread" else 1  # process and remote workers get their own copy of the bytes
+    return attachment.size * copies + decoded
+
+
+def is_image(attachment: Attachment) -> bool:
+    """Worth a header read; which reader runs is decided by the file's magic bytes, not its name"""
+    content_type = attachment.content_type or ""
+    return content_type.startswith("image/") or (not content_type and attachment.width is not None)
+
+
+async def extract_attachment_metadata(attachment: Attachment, header_only: bool = False) -> CacheEntry:
+    # PNG text chunks sit before IDAT and EXIF/XMP is found through the container headers,
+    # so only those byte ranges are downloaded
+    with metrics.stage("fetch_header") as stage:
+        header = await fetch_header(await get_http_session(), attachment.url, SCAN_LIMIT_BYTES)
+        stage.format = header.format if header else "unknown"
+    with metrics.stage("detect") as stage:
+        info = get_info_from_text(header.text) if header else None
+        stage.format = detect_format(info) if info else "none"
+    if info or (header is not None and header.format != "png"):
+        # stealth pnginfo only exists in PNGs, there's nothing more to find in the other formats
+        key = "head:" + header.digest.hexdigest()
+        return metadata_cache.get_by_hash(key, attachment.id) or metadata_cache.put(key, info, attachment.id)
+    if header_only:
+        return CacheEntry(None, None)  # not cached, so a reaction to it still gets the full read
+    png = header
+    # stealth pnginfo lives in the pixels, this needs the whole file
+    async with memory_budget.reserve(estimate_read_memory(attachment, png)):
+        with metrics.stage("fetch_full"):
+            image_data = await attachment.read()
+        key = "file:" + await asyncio.to_thread(lambda: hashlib.sha256(image_data).hexdigest())
+        entry = metadata_cache.get_by_hash(key, attachment.id)
+        if entry is None:
+            with metrics.stage("decode_stealth", "stealth"):
+                info = await workers.run(read_image_info, image_data, png is None)
+            entry = metadata_cache.put(key, info, attachment.id)
+        del image_data
+    return entry
+
+
+async def run_parser(attachment: Attachment, parser, data):
+    """Runs a parser in the worker pool, or reuses its result if this attachment was parsed before"""
+    entry = metadata_cache.get_by_id(attachment.id, count=False)
+    if entry is not None and parser.__name__ in entry.parsed:
+        return entry.parsed[parser.__name__]
+    with metrics.stage("parse", detect_format(data)):
+        result = await workers.run(parser, data)
+    if entry is not None:
+        metadata_cache.set_parsed(entry, parser.__name__, result)
+    return result
+
+
 @client.event
 async def on_raw_reaction_add(ctx: RawReactionActionEvent):
     """Send image metadata in reacted post to user DMs"""
     if ctx.emoji.id != CONFIG.get("EMOJI_ID") or ctx.channel_id not in monitored or ctx.member.bot:
         return
-    channel = client.get_channel(ctx.channel_id)
-    message = await channel.fetch_message(ctx.message_id)
-    if not message:
-        return
-    attachments = [a for a in message.attachments if a.filename.lower().endswith(".png")]
-    if not attachments:
-        return
-    # if ctx.emoji.name == '❔':
-    # user_dm = await client.get_user(ctx.user_id).create_dm()
-    # await user_dm.send(embed=Embed(title="Predicted Prompt", color=discord.Color.from_rgb(*EMBED_COLOR)), description=GRADCL.predict(attachments[0].url, "chen-moat2", 0.4, True, True, api_name="/classify")[1]).set_image(url=attachments[0].url))
-    # return
-    metadata = OrderedDict()
-    tasks = [read_attachment_metadata(i, attachment, metadata) for i, attachment in enumerate(attachments)]
-    await asyncio.gather(*tasks)  # this code is amazing. -yoinked; yes, it is - itsolegdm
-    if not metadata:
-        return
-    user_dm = await client.get_user(ctx.user_id).create_dm()
-    for attachment, data in [(attachments[i], data) for i, data in metadata.items()]:
-        try:
-            if 'Steps:' in data:
-                try:
-                    params = get_params_from_string(data)
-                    embed = get_embed(params, message)
-                    embed.set_image(url=attachment.url)
-                    custom_view = DmView()
-                    custom_view.metadata = data
-                    await user_dm.send(view=custom_view, embed=embed, mention_author=False)
-                except:
-                    print(traceback.format_exc())
+    current_path.set("reaction")
+    metrics.inc("pichan_events_total", path="reaction")
+    key = ("reaction", ctx.user_id, ctx.message_id)
+    if not reply_debounce.claim(key):
+        return  # removed and re-added, the DM is already on its way
+    try:
+        message = await rest_cache.message(ctx.channel_id, ctx.message_id)
+        if not message:
+            return
+        attachments = [a for a in message.attachments if is_image(a)]
+        if not attachments:
+            return
+        # if ctx.emoji.name == '❔':
+        # user_dm = await client.get_user(ctx.user_id).create_dm()
+        # await user_dm.send(embed=Embed(title="Predicted Prompt", color=discord.Color.from_rgb(*EMBED_COLOR)), description=GRADCL.predict(attachments[0].url, "chen-moat2", 0.4, True, True, api_name="/classify")[1]).set_image(url=attachments[0].url))
+        # return
+        metadata = OrderedDict()
+        tasks = [read_attachment_metadata(i, attachment, metadata) for i, attachment in enumerate(attachments)]
+        await asyncio.gather(*tasks)  # this code is amazing. -yoinked; yes, it is - itsolegdm
+        if not metadata:
+            return
+        user_dm = await rest_cache.dm(ctx.user_id)
+        replies = ReplyPacker()
+        for attachment, data in [(attachments[i], data) for i, data in metadata.items()]:
+            try:
+                if not await add_reply(replies, attachment, data, message):
                     txt = "uh oh! PI-chan did a fucky wucky and cant pawse it into a neat view, so hewes the raw content\n >w<"
-                    await user_dm.send(txt)
-                    with io.StringIO() as f:
-                        f.write(data)
-                        f.seek(0)
-                        await user_dm.send(file=File(f, "parameters.yaml"))
-            elif 'Software' in data:
-                if isinstance(data, str):
-                    data = json.loads(data)
-                embed = get_embed_nai(data, message)
-                embed.set_image(url=attachment.url)
-                custom_view = DmView()
-                custom_view.metadata = data
-                await user_dm.send(view=custom_view, embed=embed, mention_author=False)
-            else:
-                if "\"inputs\"" not in data:
-                    continue
-
-                i = 0
-                embed = Embed(title="ComfyUI Parameters", color=discord.Color.from_rgb(*EMBED_COLOR))
-                for enum, dax in enumerate(comfyui_get_data(data)):
-                    i += 1
-                    if i >= 25:
-                        break  # why the hell continue? just break...
-                    embed.add_field(name=f"{dax['type']} {enum + 1} (beta)", value=dax['val'], inline=True)
-                embed.set_footer(text=f'Posted by {message.author}', icon_url=message.author.display_avatar)
-                embed.set_image(url=attachment.url)
-                await user_dm.send(embed=embed, mention_author=False)
-                with io.StringIO() as f:
-                    indented = json.dumps(json.loads(data), sort_keys=True, indent=2)
-                    f.write(indented)
-                    f.seek(0)
-                    await user_dm.send(file=File(f, "parameters.json"))
-
-        except:
-            print(data)
-            print(traceback.format_exc())
-            pass
+                    replies.add(content=txt, files=[("parameters.yaml", data)])
+            except:
+                print(data)
+                print(traceback.format_exc())
+        if replies:
+            await send_replies(user_dm.send, replies, DmView.for_metadata)
+    except BaseException:
+        reply_debounce.release(key)  # the reply failed, let a retry through instead of collapsing it
+        raise
 
 
 @client.message_command(name="View Raw Prompt")
 async def view_raw_data(ctx: ApplicationContext, message: Message):
     """Get raw list of parameters for every image in this post."""
-    attachments = [a for a in message.attachments if a.filename.lower().endswith(".png")]
+    current_path.set("view_raw_data")
+    metrics.inc("pichan_events_total", path="view_raw_data")
+    attachments = [a for a in message.attachments if is_image(a)]
     if not attachments:
         await ctx.respond("This post contains no matching images.", ephemeral=True)
         return
-    await ctx.defer(ephemeral=True)
-    metadata = OrderedDict()
-    tasks = [read_attachment_metadata(i, attachment, metadata) for i, attachment in enumerate(attachments)]
-    await asyncio.gather(*tasks)
-    if not metadata:
-        await ctx.respond(f"This post contains no image generation data.", ephemeral=True)
+    key = ("view_raw_data", ctx.author.id, message.id)
+    if not reply_debounce.claim(key):
+        await ctx.respond("Already on its way, give it a moment!", ephemeral=True)
         return
-    print(metadata.values())
-    response = "\n\n".join(str(value) for value in metadata.values())
-    custom_view = ServerView()
-    user_roles = [role.id for role in ctx.author.roles]
-    if any(role_id in CAN_DELETE_EMBED for role_id in user_roles):
-        if len(response) < 1900:
-            await message.reply(f"**Requested by @{ctx.author.name}**\n```yaml\n{response}```", mention_author=False, view=custom_view)
-            await ctx.delete()
-        else:
-            with io.StringIO() as f:
-                f.write(response)
-                f.seek(0)
-                await message.reply(f"**Requested by @{ctx.author.name}**", file=File(f, "parameters.yaml"), mention_author=False, view=custom_view)
+    try:
+        await ctx.defer(ephemeral=True)
+        metadata = OrderedDict()
+        tasks = [read_attachment_metadata(i, attachment, metadata) for i, attachment in enumerate(attachments)]
+        await asyncio.gather(*tasks)
+        if not metadata:
+            await ctx.respond(f"This post contains no image generation data.", ephemeral=True)
+            return
+        print(metadata.values())
+        response = "\n\n".join(str(value) for value in metadata.values())
+        custom_view = ServerView()
+        user_roles = [role.id for role in ctx.author.roles]
+        if any(role_id in CAN_DELETE_EMBED for role_id in user_roles):
+            if len(response) < 1900:
+                await send(message.reply, f"**Requested by @{ctx.author.name}**\n```yaml\n{response}```", mention_author=False, view=custom_view)
                 await ctx.delete()
-    else:
-        await ctx.respond(f"Sorry, but you can't use it here. I'll send you a DM :3 ", ephemeral=True)
-        user_dm = await client.get_user(ctx.user_id).create_dm()
-        if len(response) < 1900:
-            await user_dm.send(f"**Requested by @{ctx.author.name}**\n```yaml\n{response}```", mention_author=False, view=custom_view)
+            else:
+                with io.StringIO() as f:
+                    f.write(response)
+                    f.seek(0)
+                    await send(message.reply, f"**Requested by @{ctx.author.name}**", file=File(f, "parameters.yaml"), mention_author=False, view=custom_view)
+                    await ctx.delete()
         else:
-            with io.StringIO() as f:
-                f.write(response)
-                f.seek(0)
-                await user_dm.send(f"**Requested by @{ctx.author.name}**", file=File(f, "parameters.yaml"), mention_author=False, view=custom_view)
+            await ctx.respond(f"Sorry, but you can't use it here. I'll send you a DM :3 ", ephemeral=True)
+            user_dm = await rest_cache.dm(ctx.user_id)
+            if len(response) < 1900:
+                await send(user_dm.send, f"**Requested by @{ctx.author.name}**\n```yaml\n{response}```", mention_author=False, view=custom_view)
+            else:
+                with io.StringIO() as f:
+                    f.write(response)
+                    f.seek(0)
+                    await send(user_dm.send, f"**Requested by @{ctx.author.name}**", file=File(f, "parameters.yaml"), mention_author=False, view=custom_view)
+    except BaseException:
+        reply_debounce.release(key)  # the reply failed, let a retry through instead of collapsing it
+        raise
 
 
 @client.message_command(name="Print Parameters/Prompt")
 async def print_params(ctx: ApplicationContext, message: Message):
     """Get a formatted list of parameters for every image in this post."""
-    attachments = [a for a in message.attachments if a.filename.lower().endswith(".png")]
+    current_path.set("print_params")
+    metrics.inc("pichan_events_total", path="print_params")
+    attachments = [a for a in message.attachments if is_image(a)]
     if not attachments:
         await ctx.respond("This post contains no matching images.", ephemeral=True)
         return
-    await ctx.defer(ephemeral=True)
-    metadata = OrderedDict()
-    tasks = [read_attachment_metadata(i, attachment, metadata) for i, attachment in enumerate(attachments)]
-    await asyncio.gather(*tasks)
-    if not metadata:
-        await ctx.respond(f"This post contains no image generation data.", ephemeral=True)
+    key = ("print_params", ctx.author.id, message.id)
+    if not reply_debounce.claim(key):
+        await ctx.respond("Already on its way, give it a moment!", ephemeral=True)
         return
-    user_roles = [role.id for role in ctx.author.roles]
-    user_dm = await client.get_user(ctx.user.id).create_dm()
-    if any(role_id in CAN_DELETE_EMBED for role_id in user_roles):
-        sendr = message.reply
-        ctxr = ctx.delete
-    else:
-        sendr = user_dm.send
-        ctxr = lambda: ctx.respond(f"Sorry, but you can't use it here. I'll send you a DM :3 ", ephemeral=True)
+    try:
+        await ctx.defer(ephemeral=True)
+        metadata = OrderedDict()
+        tasks = [read_attachment_metadata(i, attachment, metadata) for i, attachment in enumerate(attachments)]
+        await asyncio.gather(*tasks)
+        if not metadata:
+            await ctx.respond(f"This post contains no image generation data.", ephemeral=True)
+            return
+        user_roles = [role.id for role in ctx.author.roles]
+        user_dm = await rest_cache.dm(ctx.user.id)
+        if any(role_id in CAN_DELETE_EMBED for role_id in user_roles):
+            sendr = message.reply
+            ctxr = ctx.delete
+        else:
+            sendr = user_dm.send
+            ctxr = lambda: ctx.respond(f"Sorry, but you can't use it here. I'll send you a DM :3 ", ephemeral=True)
 
-    for attachment, data in [(attachments[i], data) for i, data in metadata.items()]:
-        try:
-            if 'Steps:' in data:
-                try:
-                    params = get_params_from_string(data)
-                    print(ctx.author.nick)
-                    embed = get_embed(params, message, ctx.author.name)
-                    embed.set_image(url=attachment.url)
-                    custom_view = ServerView()
-                    custom_view.metadata = data
-                    await sendr(view=custom_view, embed=embed, mention_author=False)
-                    await ctxr()
-                except:
-                    print(traceback.format_exc())
+        replies = ReplyPacker()
+        for attachment, data in [(attachments[i], data) for i, data in metadata.items()]:
+            try:
+                if not await add_reply(replies, attachment, data, message, ctx.author.name):
                     txt = "uh oh! PI-chan did a fucky wucky and cant pawse it into a neat view\n >w<"
                     await ctx.respond(txt)
-            elif 'Software' in data:
-                if isinstance(data, str):
-                    data = json.loads(data)
-                embed = get_embed_nai(data, message, ctx.author.name)
-                embed.set_image(url=attachment.url)
-                custom_view = ServerView()
-                custom_view.metadata = data
-                await sendr(view=custom_view, embed=embed, mention_author=False)
-                await ctxr()
-            else:
-                if "\"inputs\"" not in data:
-                    continue
-
-                i = 0
-                embed = Embed(title=f"ComfyUI Parameters. Requested by @{ctx.author.name}", color=discord.Color.from_rgb(*EMBED_COLOR))
-                for enum, dax in enumerate(comfyui_get_data(data)):
-                    i += 1
-                    if i >= 25:
-                        break  # why the hell continue? just break...
-                    embed.add_field(name=f"{dax['type']} {enum + 1} (beta)", value=dax['val'], inline=True)
-                embed.set_footer(text=f'Posted by {message.author}', icon_url=message.author.display_avatar)
-                embed.set_image(url=attachment.url)
-                await ctxr()
-                await sendr(embed=embed, mention_author=False)
-                with io.StringIO() as f:
-                    indented = json.dumps(json.loads(data), sort_keys=True, indent=2)
-                    f.write(indented)
-                    f.seek(0)
-                    await sendr(file=File(f, "parameters.json"), mention_author=False)
-
-        except:
-            print(data)
-            print(traceback.format_exc())
-            pass
-
-
-client.run(CONFIG.get("BOT_TOKEN"))
+            except:
+                print(data)
+                print(traceback.format_exc())
+        if replies:
+            await send_replies(sendr, replies, lambda metadata: ServerView())
+            await ctxr()
+    except BaseException:
+        reply_debounce.release(key)  # the reply failed, let a retry through instead of collapsing it
+        raise
+
+
+async def main():
+    try:
+        await client.start(CONFIG.get("BOT_TOKEN"))
+    finally:
+        # in the bot's loop, so the aiohttp sessions and pending writes are closed where they were opened
+        if not client.is_closed():
+            await client.close()
+        await civitai_client.close()
+        if http_session is not None:
+            await http_session.close()
+        if prompt_index is not None:
+            await prompt_index.close()
+        button_store.close()
+        workers.shutdown()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
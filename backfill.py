@@ -0,0 +1,113 @@
+import asyncio
+import json
+import os
+import time
+
+import discord
+
+
+class Checkpoints:
+    """channel id -> id of the newest message a backfill has finished with, kept in a JSON file
+    so an interrupted backfill picks up where it stopped. Saving keeps the channels other processes
+    sharing the file wrote (each channel is only backfilled by the process that has its guild)."""
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self.positions = self._load()
+
+    def _load(self) -> dict:
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return {int(k): v for k, v in json.load(f).items()}
+        except (ValueError, OSError) as e:  # unreadable or not our JSON: backfills start over, the next save fixes it
+            print(f"Ignoring backfill checkpoints in {self.path}: {type(e).__name__}: {e}")
+            return {}
+
+    def get(self, channel_id: int):
+        return self.positions.get(channel_id)
+
+    def set(self, channel_id: int, message_id: int):
+        self._save(channel_id, message_id)
+
+    def reset(self, channel_id: int):
+        self._save(channel_id, None)
+
+    def _save(self, channel_id: int, message_id):
+        self.positions = {**(self._load() if self.path else self.positions), channel_id: message_id}
+        if message_id is None:
+            del self.positions[channel_id]
+        if self.path:  # written aside and renamed, so a crash mid-write leaves the previous checkpoint
+            with open(self.path + f".{os.getpid()}.tmp", "w", encoding="utf-8") as f:
+                json.dump({str(k): v for k, v in self.positions.items()}, f)
+            os.replace(self.path + f".{os.getpid()}.tmp", self.path)
+
+
+class Backfill:
+    """Walks a channel's history oldest first from its checkpoint, `batch_size` messages at a time.
+    `process(message)` runs for at most `concurrency` messages at once and returns (images, with metadata);
+    the checkpoint moves past a batch once all of it is done, so nothing is skipped on resume."""
+
+    def __init__(self, channel, process, checkpoints: Checkpoints, concurrency: int = 4, batch_size: int = 50,
+                 limit: int = None):
+        self.channel = channel
+        self.process = process
+        self.checkpoints = checkpoints
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.limit = limit
+        self.messages = 0
+        self.images = 0
+        self.found = 0
+        self.errors = 0
+        self.resumed_from = checkpoints.get(channel.id)
+        self.started = time.monotonic()
+        self.finished = None
+        self.task = None
+
+    async def run(self):
+        after = discord.Object(id=self.resumed_from) if self.resumed_from else None
+        window = asyncio.Semaphore(self.concurrency)
+        batch = []
+        try:
+            async for message in self.channel.history(limit=self.limit, after=after, oldest_first=True):
+                batch.append(message)
+                if len(batch) >= self.batch_size:
+                    await self._process(batch, window)
+                    batch = []
+            if batch:
+                await self._process(batch, window)
+        finally:
+            self.finished = time.monotonic()
+
+    async def _process(self, batch: list, window: asyncio.Semaphore):
+        async def one(message):
+            async with window:
+                try:
+                    images, found = await self.process(message)
+                except Exception as e:
+                    print(f"Backfill of {message.jump_url} failed: {type(e).__name__}: {e}")
+                    self.errors += 1
+                    return
+            self.images += images
+            self.found += found
+
+        await asyncio.gather(*(one(message) for message in batch))
+        self.messages += len(batch)
+        self.checkpoints.set(self.channel.id, batch[-1].id)
+
+    def start(self) -> asyncio.Task:
+        self.task = asyncio.create_task(self.run())
+        return self.task
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    def progress(self) -> str:
+        elapsed = (self.finished or time.monotonic()) - self.started
+        state = "running" if self.running else "cancelled" if self.task and self.task.cancelled() else "done"
+        return (f"{state}: {self.messages} messages, {self.images} images, {self.found} with metadata, "
+                f"{self.errors} errors in {elapsed:.0f}s ({self.messages / elapsed if elapsed else 0:.1f} messages/s)"
+                + (" - resumed from the last checkpoint" if self.resumed_from else ""))
@@ -0,0 +1,149 @@
+"""Pulls generation metadata out of image folders and archives, no Discord needed.
+
+    python batch.py ~/dataset archive.zip shard-000.tar > index.jsonl
+    python batch.py ~/dataset --jobs 8 --raw --output index.jsonl
+
+Writes one JSON object per image as soon as it is done (so the order isn't the input order):
+{"path": ..., "format": "a1111"|"novelai"|"comfyui"|"unknown"|null, "params": ..., "error": ...}
+Files in zip/tar archives are listed as "archive.zip/inner/path.png".
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tarfile
+import time
+import traceback
+import zipfile
+from functools import lru_cache
+
+from parsing import parse_metadata, read_image_info
+from workers import Workers
+
+IMAGE_EXTENSIONS = (".png", ".webp", ".jpg", ".jpeg", ".avif")
+
+
+@lru_cache(maxsize=8)
+def _open_zip(path: str) -> zipfile.ZipFile:
+    # each worker keeps its archives open instead of re-reading the central directory for every member
+    return zipfile.ZipFile(path)
+
+
+def extract(name: str, source, raw: bool = False) -> dict:
+    """Runs in a worker. source is a file path, an (archive, member) pair for zips, or the file bytes."""
+    result = {"path": name, "format": None, "params": None, "error": None}
+    try:
+        if isinstance(source, str):
+            with open(source, "rb") as f:
+                data = f.read()
+        elif isinstance(source, tuple):
+            data = _open_zip(source[0]).read(source[1])
+        else:
+            data = source
+        info = read_image_info(data)
+        if info:
+            result["format"], result["params"] = parse_metadata(info)
+            if raw:
+                result["metadata"] = info
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    return result
+
+
+def _is_image(name: str) -> bool:
+    return name.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def iter_sources(paths):
+    """Yields (name, source) for every image under `paths`. Tar members are read here, in order,
+    because compressed tars can't be seeked into from the workers."""
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for file in sorted(files):
+                    full = os.path.join(root, file)
+                    if _is_image(file):
+                        yield full, full
+                    elif zipfile.is_zipfile(full) or tarfile.is_tarfile(full):
+                        yield from iter_sources([full])
+        elif zipfile.is_zipfile(path):
+            with zipfile.ZipFile(path) as archive:
+                for member in archive.infolist():
+                    if not member.is_dir() and _is_image(member.filename):
+                        yield f"{path}/{member.filename}", (path, member.filename)
+        elif tarfile.is_tarfile(path):
+            with tarfile.open(path, "r|*") as archive:
+                for member in archive:
+                    if member.isfile() and _is_image(member.name):
+                        yield f"{path}/{member.name}", archive.extractfile(member).read()
+        elif os.path.isfile(path):
+            yield path, path
+        else:
+            print(f"{path}: no such file or directory", file=sys.stderr)
+
+
+async def run(paths, out, jobs: int, timeout: float, raw: bool):
+    workers = Workers(mode="process", count=jobs, timeout=timeout)
+    # a few jobs queued per worker keeps them busy without holding a whole tar in memory
+    window = asyncio.Semaphore(workers.count * 4)
+    counts = {"images": 0, "with_metadata": 0, "errors": 0}
+    start = time.monotonic()
+
+    async def one(name, source):
+        try:
+            try:
+                result = await workers.run(extract, name, source, raw)
+            except asyncio.TimeoutError:
+                result = {"path": name, "format": None, "params": None, "error": f"timed out after {timeout}s"}
+            except Exception as e:  # a worker died (usually out of memory), the pool is replaced on the next job
+                result = {"path": name, "format": None, "params": None, "error": f"{type(e).__name__}: {e}"}
+                workers.recycle()
+            counts["images"] += 1
+            counts["with_metadata"] += result["format"] is not None
+            counts["errors"] += result["error"] is not None
+            out.write(json.dumps(result, ensure_ascii=False) + "\n")
+        finally:
+            window.release()
+
+    tasks = set()
+    try:
+        for name, source in iter_sources(paths):
+            await window.acquire()
+            task = asyncio.create_task(one(name, source))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+        workers.shutdown(wait=True)  # every job is done, let the pool exit cleanly
+    finally:
+        workers.shutdown()
+    elapsed = time.monotonic() - start
+    print(f"{counts['images']} images, {counts['with_metadata']} with metadata, {counts['errors']} errors "
+          f"in {elapsed:.1f}s ({counts['images'] / elapsed if elapsed else 0:.0f}/s)", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+", help="image files, folders, .zip or .tar(.gz/.bz2/.xz) archives")
+    parser.add_argument("--output", "-o", help="write JSONL here instead of stdout")
+    parser.add_argument("--jobs", "-j", type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds before giving up on one image")
+    parser.add_argument("--raw", action="store_true", help="also include the unparsed metadata")
+    args = parser.parse_args()
+
+    out = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    try:
+        asyncio.run(run(args.paths, out, args.jobs, args.timeout, args.raw))
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        print(traceback.format_exc(), file=sys.stderr)
+        sys.exit(1)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""How parse throughput scales with the size of the worker pool cluster.py shares between bot processes.
+
+Run from the repo root:
+
+    python -m bench.cluster_bench                            # pools of 1, 2, 4, ... workers up to the core count
+    python -m bench.cluster_bench --clients 4 --seconds 5    # 4 stand-in bot processes, 5 seconds per pool size
+
+For every pool size a ParseServer is started here and `--clients` processes stand in for the sharded bot
+processes, each keeping `--in-flight` stealth decodes of a corpus image (the heaviest job the bot sends)
+running through RemoteWorkers. No Discord connection or config.toml is needed.
+"""
+import argparse
+import asyncio
+import json
+import os
+import secrets
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench import corpus
+from workers import ParseServer, RemoteWorkers, Workers
+
+IMAGE = corpus.stealth_name("alpha", False, (1024, 1024))
+
+
+async def client(address: str, path: str, seconds: float, in_flight: int) -> dict:
+    from parsing import read_image_info
+    with open(path, "rb") as f:
+        data = f.read()
+    workers = RemoteWorkers(address, os.environ["PICHAN_BENCH_SECRET"], timeout=60)
+    latencies = []
+    deadline = time.monotonic() + seconds
+
+    async def loop():
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            assert await workers.run(read_image_info, data, False)
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(loop() for _ in range(in_flight)))
+    workers.shutdown()
+    latencies.sort()
+    return {"jobs": len(latencies), "p50_ms": latencies[len(latencies) // 2] * 1000 if latencies else 0.0}
+
+
+async def measure(pool: int, clients: int, seconds: float, in_flight: int, path: str) -> dict:
+    workers = Workers(mode="process", count=pool)
+    secret = secrets.token_hex(32)
+    with tempfile.TemporaryDirectory() as tmp:
+        address = os.path.join(tmp, "parse.sock")
+        server = ParseServer(workers, address, secret)
+        await server.start()
+        await workers.run(len, b"")  # start the pool before timing
+        processes = [await asyncio.create_subprocess_exec(
+            sys.executable, "-m", "bench.cluster_bench", "--client", address, "--image", path, "--seconds",
+            str(seconds), "--in-flight", str(in_flight), stdout=subprocess.PIPE,
+            env=dict(os.environ, PICHAN_BENCH_SECRET=secret)) for _ in range(clients)]  # not argv: ps shows that
+        results = [json.loads((await p.communicate())[0].decode().strip().splitlines()[-1]) for p in processes]
+        server.close()
+    workers.shutdown()
+    jobs = sum(r["jobs"] for r in results)
+    # over the clients' own `seconds`, so their startup isn't counted
+    return {"workers": pool, "clients": clients, "jobs": jobs, "jobs_per_s": jobs / seconds,
+            "p50_ms": max(r["p50_ms"] for r in results)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=2, help="stand-in bot processes")
+    parser.add_argument("--in-flight", type=int, default=4, help="jobs each client keeps running")
+    parser.add_argument("--seconds", type=float, default=3.0, help="time spent per pool size")
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--client", help=argparse.SUPPRESS)  # socket path, used for the client subprocesses
+    parser.add_argument("--image", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.client:
+        print(json.dumps(asyncio.run(client(args.client, args.image, args.seconds, args.in_flight))))
+        return
+
+    path = corpus.build(max_side=1024)[IMAGE]
+    pools = [1]
+    while pools[-1] * 2 <= args.max_workers:
+        pools.append(pools[-1] * 2)
+    if pools[-1] != args.max_workers:
+        pools.append(args.max_workers)
+    print(f"{'workers':>7} {'clients':>7} {'jobs':>7} {'jobs/s':>9} {'scaling':>8} {'p50 ms':>9}")
+    base = None
+    for pool in pools:
+        result = asyncio.run(measure(pool, args.clients, args.seconds, args.in_flight, path))
+        base = base or result["jobs_per_s"]
+        print(f"{result['workers']:>7} {result['clients']:>7} {result['jobs']:>7} {result['jobs_per_s']:>9.1f} "
+              f"{result['jobs_per_s'] / base:>7.2f}x {result['p50_ms']:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,325 @@
+"""Synthetic test images for every metadata format the bot reads.
+
+Everything is generated from a fixed seed, so the same corpus comes out on every machine.
+Files are written once to bench/.corpus and reused.
+"""
+import gzip
+import io
+import json
+import os
+import struct
+import zlib
+
+import numpy as np
+from PIL import Image, PngImagePlugin
+
+CORPUS_DIR = os.path.join(os.path.dirname(__file__), ".corpus")
+STEALTH_SIZES = [(512, 512), (1024, 1024), (2048, 2048), (3840, 2160), (7680, 4320)]
+STEALTH_MODES = [("alpha", False), ("alpha", True), ("rgb", False), ("rgb", True)]
+COMFYUI_NODES = [10, 100, 1000]
+SIGS = {("alpha", False): "stealth_pnginfo", ("alpha", True): "stealth_pngcomp",
+        ("rgb", False): "stealth_rgbinfo", ("rgb", True): "stealth_rgbcomp"}
+
+TAGS = ["masterpiece", "best quality", "1girl", "hakurei reimu", "red bow", "shrine", "cherry blossoms",
+        "detailed background", "looking at viewer", "smile", "(sunset:1.2)", "[city:forest:0.4]", "wide shot",
+        "from above", "(depth of field:0.8)", "sidelighting", "floating hair", "ribbon trim", "outdoors"]
+NEG_TAGS = ["lowres", "bad anatomy", "bad hands", "text", "error", "missing fingers", "cropped",
+            "worst quality", "jpeg artifacts", "signature", "watermark", "(blurry:1.3)"]
+
+
+def _tags(rng, pool, n):
+    return ", ".join(rng.choice(pool, n))
+
+
+def a1111_parameters(rng, tags: int = 60, extensions: bool = True) -> str:
+    prompt = _tags(rng, TAGS, tags) + ", <lora:add_detail:0.6>, <lora:style:0.8>"
+    prompt = prompt[:len(prompt) // 2] + "\n" + prompt[len(prompt) // 2:]  # multi-line prompts happen
+    negative = _tags(rng, NEG_TAGS, tags // 3) + ", easynegative"
+    params = [
+        "Steps: 28", "Sampler: DPM++ 2M Karras", "CFG scale: 7", f"Seed: {rng.integers(2 ** 32)}",
+        "Size: 832x1216", "Model hash: 7f96a1a9ca", "Model: animagineXLV3_v30", "VAE hash: 235745af8d",
+        "VAE: sdxl_vae.safetensors", "Denoising strength: 0.4", "Clip skip: 2",
+    ]
+    if extensions:
+        params += [
+            "Hires upscale: 1.5", "Hires steps: 10", "Hires upscaler: R-ESRGAN 4x+ Anime6B",
+            'Hires prompt: "1girl, detailed eyes, (sharp:1.1)"',
+            'Lora hashes: "add_detail: 7c6bad76eb54, style: 1a2b3c4d5e6f"',
+            'TI hashes: "easynegative: c74b4e810b03"',
+            'ControlNet 0: "Module: canny, Model: control_v11p_sd15_canny [d14c016b], Weight: 1, '
+            'Resize Mode: Crop and Resize, Low Vram: False, Guidance Start: 0, Guidance End: 1"',
+            'ADetailer model: face_yolov8n.pt', 'ADetailer prompt: "smile, blush"', "ADetailer version: 23.11.1",
+        ]
+    params.append("Version: v1.7.0")
+    return f"{prompt}\nNegative prompt: {negative}\n" + ", ".join(params)
+
+
+def novelai_text(rng) -> dict:
+    prompt = _tags(rng, TAGS, 40)
+    comment = {
+        "prompt": prompt, "steps": 28, "height": 1216, "width": 832, "scale": 5.0, "uncond_scale": 1.0,
+        "cfg_rescale": 0.0, "seed": int(rng.integers(2 ** 32)), "n_samples": 1, "hide_debug_overlay": False,
+        "noise_schedule": "native", "legacy_v3_extend": False, "reference_information_extracted_multiple": [],
+        "reference_strength_multiple": [], "sampler": "k_euler_ancestral", "controlnet_strength": 1.0,
+        "controlnet_model": None, "dynamic_thresholding": False, "dynamic_thresholding_percentile": 0.999,
+        "dynamic_thresholding_mimic_scale": 10.0, "sm": False, "sm_dyn": False, "skip_cfg_below_sigma": 0.0,
+        "lora_unet_weights": None, "lora_clip_weights": None, "uc": _tags(rng, NEG_TAGS, 12),
+        "request_type": "PromptGenerateRequest", "signed_hash": "x" * 88,
+    }
+    return {"Title": "AI generated image", "Description": prompt, "Software": "NovelAI",
+            "Source": "Stable Diffusion XL C1E1DE52", "Generation time": "4.52", "Comment": json.dumps(comment)}
+
+
+def comfyui_graph(rng, nodes: int) -> tuple:
+    """Returns (prompt, workflow) JSON strings for an SDXL-style graph padded out to `nodes` nodes"""
+    prompt = {
+        "4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "sd_xl_base_1.0.safetensors"}},
+        "5": {"class_type": "EmptyLatentImage", "inputs": {"width": 1024, "height": 1024, "batch_size": 1}},
+        "6": {"class_type": "CLIPTextEncode", "inputs": {"text": _tags(rng, TAGS, 30), "clip": ["10", 1]}},
+        "7": {"class_type": "CLIPTextEncode", "inputs": {"text": _tags(rng, NEG_TAGS, 10), "clip": ["10", 1]}},
+        "3": {"class_type": "KSampler", "inputs": {
+            "seed": int(rng.integers(2 ** 32)), "steps": 25, "cfg": 7.5, "sampler_name": "dpmpp_2m",
+            "scheduler": "karras", "denoise": 1.0, "model": ["10", 0], "positive": ["6", 0],
+            "negative": ["7", 0], "latent_image": ["5", 0]}},
+        "8": {"class_type": "VAEDecode", "inputs": {"samples": ["3", 0], "vae": ["4", 2]}},
+        "9": {"class_type": "SaveImage", "inputs": {"filename_prefix": "ComfyUI", "images": ["8", 0]}},
+        "10": {"class_type": "LoraLoader", "inputs": {"lora_name": "add_detail.safetensors", "strength_model": 0.6,
+                                                      "strength_clip": 0.6, "model": ["4", 0], "clip": ["4", 1]}},
+    }
+    node_id = 11
+    while len(prompt) < nodes:
+        # dangling helper nodes, the way big workflows are full of previews, upscalers and notes
+        if node_id % 3 == 0:
+            prompt[str(node_id)] = {"class_type": "CLIPTextEncode",
+                                    "inputs": {"text": _tags(rng, TAGS, 8), "clip": ["4", 1]}}
+        elif node_id % 3 == 1:
+            prompt[str(node_id)] = {"class_type": "ImageScaleBy", "inputs": {
+                "upscale_method": "lanczos", "scale_by": 1.5, "image": ["8", 0]}}
+        else:
+            prompt[str(node_id)] = {"class_type": "PreviewImage", "inputs": {"images": [str(node_id - 1), 0]}}
+        node_id += 1
+
+    ui_nodes, links = [], []
+    for nid, node in prompt.items():
+        inputs = []
+        for name, value in node["inputs"].items():
+            if isinstance(value, list):
+                links.append([len(links) + 1, int(value[0]), value[1], int(nid), len(inputs), "*"])
+                inputs.append({"name": name, "type": "*", "link": len(links)})
+        widgets = [v for v in node["inputs"].values() if not isinstance(v, list)]
+        if node["class_type"] == "KSampler":
+            widgets.insert(1, "fixed")  # the UI keeps control_after_generate right after the seed
+        ui_nodes.append({"id": int(nid), "type": node["class_type"], "pos": [0, 0], "size": [300, 100],
+                         "inputs": inputs, "outputs": [], "widgets_values": widgets})
+    workflow = {"last_node_id": node_id, "last_link_id": len(links), "nodes": ui_nodes, "links": links,
+                "groups": [], "config": {}, "extra": {}, "version": 0.4}
+    return json.dumps(prompt), json.dumps(workflow)
+
+
+def base_image(width: int, height: int, seed: int = 0) -> Image.Image:
+    """A smooth gradient with a little noise, so it compresses roughly like a real picture"""
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    arr = np.empty((height, width, 4), dtype=np.uint8)
+    arr[..., 0] = x
+    arr[..., 1] = y
+    arr[..., 2] = (x + y) / 2
+    arr[..., 3] = 255
+    arr[..., :3] += rng.integers(0, 4, (height, width, 1), dtype=np.uint8)
+    return Image.fromarray(arr, "RGBA")
+
+
+def encode_stealth(image: Image.Image, text: str, mode: str = "alpha", compressed: bool = False) -> Image.Image:
+    """Writes text the way sd_webui_stealth_pnginfo does (column-major LSBs)"""
+    data = text.encode("utf-8")
+    if compressed:
+        data = gzip.compress(data)
+    sig = SIGS[(mode, compressed)].encode("utf-8")
+    payload = np.unpackbits(np.frombuffer(data, dtype=np.uint8))
+    length = np.unpackbits(np.frombuffer(len(payload).to_bytes(4, "big"), dtype=np.uint8))
+    bits = np.concatenate((np.unpackbits(np.frombuffer(sig, dtype=np.uint8)), length, payload))
+    image = image.convert("RGBA" if mode == "alpha" else "RGB")
+    arr = np.array(image).transpose(1, 0, 2).copy()  # (x, y, band)
+    flat = arr.reshape(-1, arr.shape[2])
+    if mode == "alpha":
+        if len(bits) > len(flat):
+            raise ValueError("image too small for payload")
+        flat[:len(bits), 3] = (flat[:len(bits), 3] & 0xFE) | bits
+    else:
+        bits = np.concatenate((bits, np.zeros(-len(bits) % 3, dtype=np.uint8)))
+        if len(bits) // 3 > len(flat):
+            raise ValueError("image too small for payload")
+        rgb = flat[:len(bits) // 3, :3]
+        flat[:len(bits) // 3, :3] = (rgb & 0xFE) | bits.reshape(-1, 3)
+    return Image.fromarray(arr.transpose(1, 0, 2))
+
+
+def png_bytes(image: Image.Image, text: dict = None) -> bytes:
+    info = None
+    if text:
+        info = PngImagePlugin.PngInfo()
+        for key, value in text.items():
+            info.add_text(key, value)
+    with io.BytesIO() as f:
+        image.save(f, "PNG", pnginfo=info, compress_level=1)
+        return f.getvalue()
+
+
+def filtered_png_bytes(image: Image.Image, filter_type: int) -> bytes:
+    """An 8-bit RGB/RGBA PNG with every scanline written with `filter_type` (0-4). Pillow picks filters per
+    image, this forces the ones the streaming stealth decoder has to undo itself."""
+    pixels = np.asarray(image).astype(np.int16)
+    height, width, bpp = pixels.shape
+    rows = pixels.reshape(height, width * bpp)
+    left = np.zeros_like(rows)
+    left[:, bpp:] = rows[:, :-bpp]
+    up = np.zeros_like(rows)
+    up[1:] = rows[:-1]
+    up_left = np.zeros_like(rows)
+    up_left[1:, bpp:] = rows[:-1, :-bpp]
+    if filter_type == 4:
+        p = left + up - up_left
+        pa, pb, pc = abs(p - left), abs(p - up), abs(p - up_left)
+        predictor = np.where((pa <= pb) & (pa <= pc), left, np.where(pb <= pc, up, up_left))
+    else:
+        predictor = [np.zeros_like(rows), left, up, (left + up) >> 1][filter_type]
+    filtered = np.empty((height, 1 + width * bpp), dtype=np.uint8)
+    filtered[:, 0] = filter_type
+    filtered[:, 1:] = (rows - predictor) & 0xFF
+
+    def chunk(kind, payload):
+        return struct.pack(">I", len(payload)) + kind + payload + struct.pack(">I", zlib.crc32(kind + payload))
+    ihdr = struct.pack(">IIBBBBB", width, height, 8, 6 if bpp == 4 else 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", ihdr) + chunk(b"IDAT", zlib.compress(filtered.tobytes(), 1)) + \
+        chunk(b"IEND", b"")
+
+
+def exif_bytes(user_comment: str = None, comfyui: dict = None) -> bytes:
+    """A big-endian TIFF block the way piexif writes it for A1111 (UserComment, UTF-16BE), and/or with
+    ComfyUI's "prompt:"/"workflow:" strings in Model/Make"""
+    ifd0 = []
+    for tag, key in ((0x0110, "prompt"), (0x010F, "workflow")):
+        if comfyui and key in comfyui:
+            ifd0.append((tag, 2, f"{key}:{comfyui[key]}".encode("utf-8") + b"\0"))
+    exif = [(0x9286, 7, b"UNICODE\0" + user_comment.encode("utf-16-be"))] if user_comment else []
+    ifd0_size = 2 + 12 * (len(ifd0) + bool(exif)) + 4
+    exif_size = 2 + 12 * len(exif) + 4 if exif else 0
+    data = bytearray()
+    data_start = 8 + ifd0_size + exif_size
+
+    def entry(tag, typ, value):
+        if len(value) <= 4:
+            return struct.pack(">HHI", tag, typ, len(value)) + value.ljust(4, b"\0")
+        offset = data_start + len(data)
+        data.extend(value)
+        return struct.pack(">HHII", tag, typ, len(value), offset)
+    ifd0_entries = [entry(*e) for e in ifd0]
+    if exif:
+        ifd0_entries.append(struct.pack(">HHII", 0x8769, 4, 1, 8 + ifd0_size))
+    out = b"MM\0*" + struct.pack(">I", 8) + struct.pack(">H", len(ifd0_entries)) + b"".join(ifd0_entries) + \
+        b"\0\0\0\0"
+    if exif:
+        out += struct.pack(">H", len(exif)) + b"".join(entry(*e) for e in exif) + b"\0\0\0\0"
+    return out + bytes(data)
+
+
+def jpeg_bytes(image: Image.Image, exif: bytes) -> bytes:
+    with io.BytesIO() as f:
+        image.convert("RGB").save(f, "JPEG", quality=90, exif=b"Exif\0\0" + exif)
+        return f.getvalue()
+
+
+def webp_bytes(image: Image.Image, exif: bytes) -> bytes:
+    with io.BytesIO() as f:
+        image.save(f, "WEBP", quality=90, method=0, exif=exif)
+        return f.getvalue()
+
+
+def avif_bytes(image: Image.Image, exif: bytes) -> bytes:
+    """An AVIF-shaped ISOBMFF file: ftyp, a meta box listing an image item and an Exif item, and an mdat
+    holding both. Pillow can't encode AVIF, so the image item is the raw pixels rather than AV1 - the
+    header reader never looks at it anyway."""
+    def box(kind, payload):
+        return struct.pack(">I4s", 8 + len(payload), kind) + payload
+
+    def full_box(kind, payload, version=0):
+        return box(kind, struct.pack(">I", version << 24) + payload)
+
+    pixels = image.convert("RGB").tobytes()
+    exif_item = struct.pack(">I", 6) + b"Exif\0\0" + exif
+    ftyp = box(b"ftyp", b"avif" + struct.pack(">I", 0) + b"avifmif1miaf")
+    iinf = full_box(b"iinf", struct.pack(">H", 2) +
+                    full_box(b"infe", struct.pack(">HH4s", 1, 0, b"av01") + b"\0", 2) +
+                    full_box(b"infe", struct.pack(">HH4s", 2, 0, b"Exif") + b"\0", 2))
+    ispe = full_box(b"ispe", struct.pack(">II", *image.size))
+    iprp = box(b"iprp", box(b"ipco", ispe) + full_box(b"ipma", struct.pack(">IHBB", 1, 1, 1, 0x81)))
+
+    def meta(mdat_start):
+        iloc = full_box(b"iloc", struct.pack(">BBH", 0x44, 0x00, 2) +
+                        struct.pack(">HHHII", 1, 0, 1, mdat_start, len(pixels)) +
+                        struct.pack(">HHHII", 2, 0, 1, mdat_start + len(pixels), len(exif_item)))
+        return full_box(b"meta", full_box(b"hdlr", struct.pack(">I4s12x", 0, b"pict") + b"\0") +
+                        full_box(b"pitm", struct.pack(">H", 1)) + iloc + iinf + iprp)
+    mdat_start = len(ftyp) + len(meta(0)) + 8
+    return ftyp + meta(mdat_start) + box(b"mdat", pixels + exif_item)
+
+
+def stealth_name(mode: str, compressed: bool, size: tuple) -> str:
+    return f"stealth-{mode}{'-comp' if compressed else ''}-{size[0]}x{size[1]}"
+
+
+def build(max_side: int = None, corpus_dir: str = CORPUS_DIR) -> dict:
+    """Writes the corpus (skipping files that already exist) and returns {name: path}.
+    Stealth images wider than `max_side` are left out."""
+    os.makedirs(corpus_dir, exist_ok=True)
+    rng = np.random.default_rng(1234)
+    files = {}
+
+    def write(name, make, ext="png"):
+        path = os.path.join(corpus_dir, f"{name}.{ext}")
+        if not os.path.exists(path):
+            with open(path + ".tmp", "wb") as f:
+                f.write(make())
+            os.replace(path + ".tmp", path)
+        files[name] = path
+
+    # text generation is cheap, always run it so the rng sequence doesn't depend on what's cached
+    a1111 = a1111_parameters(rng)
+    nai = novelai_text(rng)
+    graphs = {n: comfyui_graph(rng, n) for n in COMFYUI_NODES}
+    write("a1111", lambda: png_bytes(base_image(832, 1216).convert("RGB"), {"parameters": a1111}))
+    write("novelai", lambda: png_bytes(base_image(832, 1216), nai))
+    for n, (prompt, workflow) in graphs.items():
+        write(f"comfyui-{n}", lambda: png_bytes(base_image(1024, 1024).convert("RGB"),
+                                                {"prompt": prompt, "workflow": workflow}))
+    write("jpeg-a1111", lambda: jpeg_bytes(base_image(832, 1216), exif_bytes(a1111)), "jpg")
+    write("webp-a1111", lambda: webp_bytes(base_image(832, 1216).convert("RGB"), exif_bytes(a1111)), "webp")
+    prompt, workflow = graphs[COMFYUI_NODES[1]]
+    write("webp-comfyui", lambda: webp_bytes(base_image(1024, 1024).convert("RGB"),
+                                             exif_bytes(comfyui={"prompt": prompt, "workflow": workflow})), "webp")
+    write("avif-a1111", lambda: avif_bytes(base_image(832, 1216), exif_bytes(a1111)), "avif")
+    write("plain", lambda: png_bytes(base_image(832, 1216).convert("RGB")))  # no metadata anywhere
+    for size in STEALTH_SIZES:
+        if max_side and max(size) > max_side:
+            continue
+        for mode, compressed in STEALTH_MODES:
+            write(stealth_name(mode, compressed, size),
+                  lambda: png_bytes(encode_stealth(base_image(*size), a1111, mode, compressed)))
+    # a whole ComfyUI workflow hidden in the alpha channel, every row Paeth filtered: the streaming decoder has
+    # to unfilter hundreds of columns instead of a few
+    write("stealth-paeth-2048x2048", lambda: filtered_png_bytes(
+        encode_stealth(base_image(2048, 2048), graphs[COMFYUI_NODES[-1]][1], "alpha"), 4))
+    return files
+
+
+def existing(corpus_dir: str = CORPUS_DIR) -> dict:
+    """{name: path} of the files already written by build()"""
+    return {os.path.splitext(name)[0]: os.path.join(corpus_dir, name) for name in sorted(os.listdir(corpus_dir))
+            if name.endswith((".png", ".jpg", ".webp", ".avif"))}
+
+
+def text_samples(n: int = 200, seed: int = 99) -> list:
+    """A1111 parameter strings of varying length, with and without extension fields"""
+    rng = np.random.default_rng(seed)
+    return [a1111_parameters(rng, tags=int(rng.integers(5, 150)), extensions=bool(i % 2)) for i in range(n)]
@@ -0,0 +1,312 @@
+"""End-to-end load test of the bot's handlers against a local Discord stand-in, for sizing hosts.
+
+Run from the repo root (needs a config.toml, a copy of config.template.toml is fine):
+
+    python -m bench.loadtest                                   # 5 posts/s for 20 s, default format mix
+    python -m bench.loadtest --rate 20 --seconds 60 --reactions 2
+    python -m bench.loadtest --mix a1111=3,jpeg-a1111=1,plain=2,stealth-alpha-1024x1024=1
+    python -m bench.loadtest --unpaced --json out.json         # no send-queue pacing: the bot's own ceiling
+
+Posts arrive at `--rate` per second (Poisson) with one image each, picked from `--mix` (corpus file names, weights),
+and get a Poisson(`--reactions`) number of reactions from different users `--reaction-delay` seconds later.
+on_message and on_raw_reaction_add run on synthetic messages, attachments and reaction events; images come
+from a local HTTP server that answers Range requests like the CDN, and every REST call and message the
+handlers make is answered and counted by the stand-in instead of Discord.
+
+Latency is from when an event arrives to when its handler is done (the reaction added, the DM sent), so it
+includes time spent waiting on the event loop, workers and send queue. The button store and prompt index are
+swapped for in-memory/temporary ones, so nothing is stored in the real ones.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import resource
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import numpy as np
+
+from bench import corpus
+from bench.suite import FakeAttachment, _serve
+
+DEFAULT_MIX = "a1111=4,novelai=1,comfyui-100=1,jpeg-a1111=1,webp-a1111=1,plain=2"
+GUILD_ID = 1000
+CHANNEL_ID = 2000
+_ids = itertools.count(10 ** 17)
+
+
+class StandIn:
+    """The parts of the client and REST API the handlers reach. Guild emoji and members are in the
+    gateway cache like on a connected bot, everything else is a counted REST call."""
+
+    def __init__(self, emoji_id: int, users: int):
+        self.rest = Counter()
+        self.outbound = Counter()
+        self.emoji = SimpleNamespace(id=emoji_id, name="pichan")
+        self.guild = FakeGuild(self)
+        self.channels = {CHANNEL_ID: FakeChannel(self, CHANNEL_ID)}
+        self.users = {user_id: FakeUser(self, user_id) for user_id in range(1, users + 1)}
+        self.messages = {}
+
+    # the client methods RestCache uses
+    def get_emoji(self, emoji_id: int):
+        return self.emoji if emoji_id == self.emoji.id else None
+
+    def get_user(self, user_id: int):
+        return self.users.get(user_id)
+
+    async def fetch_user(self, user_id: int):
+        self.rest["fetch_user"] += 1
+        return self.users.setdefault(user_id, FakeUser(self, user_id))
+
+    def get_channel(self, channel_id: int):
+        return self.channels.get(channel_id)
+
+    async def fetch_channel(self, channel_id: int):
+        self.rest["fetch_channel"] += 1
+        return self.channels[channel_id]
+
+
+class FakeGuild:
+    def __init__(self, standin: StandIn):
+        self.standin = standin
+        self.id = GUILD_ID
+
+    async def fetch_emoji(self, emoji_id: int):
+        self.standin.rest["fetch_emoji"] += 1
+        return self.standin.emoji
+
+
+class FakeChannel:
+    def __init__(self, standin: StandIn, channel_id: int, dm: bool = False):
+        self.standin = standin
+        self.id = channel_id
+        self.dm = dm
+
+    async def send(self, content: str = None, embeds: list = None, files: list = None, **kwargs):
+        self.standin.rest["send"] += 1
+        out = self.standin.outbound
+        out["dm_messages" if self.dm else "channel_messages"] += 1
+        out["embeds"] += len(embeds or [])
+        out["files"] += len(files or [])
+        out["bytes"] += len(content or "") + sum(len(embed) for embed in embeds or [])
+        return SimpleNamespace(id=next(_ids), channel=self)
+
+    async def fetch_message(self, message_id: int):
+        self.standin.rest["fetch_message"] += 1
+        return self.standin.messages[message_id]
+
+
+class FakeUser:
+    def __init__(self, standin: StandIn, user_id: int):
+        self.standin = standin
+        self.id = user_id
+        self.name = f"user{user_id}"
+        self.bot = False
+        self.display_avatar = "https://example.invalid/avatar.png"
+        self.dm_channel = None
+
+    async def create_dm(self):
+        self.standin.rest["create_dm"] += 1
+        self.dm_channel = FakeChannel(self.standin, next(_ids), dm=True)
+        return self.dm_channel
+
+    def __str__(self):
+        return self.name
+
+
+class FakeMessage:
+    def __init__(self, standin: StandIn, author: FakeUser, attachments: list):
+        self.standin = standin
+        self.id = next(_ids)
+        self.channel = standin.channels[CHANNEL_ID]
+        self.guild = standin.guild
+        self.author = author
+        self.attachments = attachments
+        self.reactions = []
+        self.components = []
+        self.created_at = datetime.now(timezone.utc)
+        self.jump_url = f"https://discord.com/channels/{GUILD_ID}/{CHANNEL_ID}/{self.id}"
+        standin.messages[self.id] = self
+
+    async def add_reaction(self, emoji):
+        self.standin.rest["add_reaction"] += 1
+        self.reactions.append(SimpleNamespace(emoji=emoji, me=True, count=1))
+
+    async def reply(self, *args, **kwargs):
+        return await self.channel.send(*args, **kwargs)
+
+
+def parse_mix(mix: str, files: dict) -> tuple:
+    names, weights = [], []
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name not in files:
+            raise SystemExit(f"{name} isn't in the corpus, pick from: {', '.join(sorted(files))}")
+        names.append(name)
+        weights.append(float(weight or 1))
+    return names, np.array(weights) / sum(weights)
+
+
+def percentiles(times: list) -> dict:
+    if not times:
+        return {"events": 0}
+    times = sorted(times)
+    pct = lambda q: times[min(len(times) - 1, int(q * len(times)))] * 1000
+    return {"events": len(times), "p50_ms": pct(0.5), "p90_ms": pct(0.9), "p99_ms": pct(0.99),
+            "max_ms": times[-1] * 1000}
+
+
+async def replay(args, files: dict) -> dict:
+    import PromptInspector
+    from buttonstore import ButtonStore
+    from outbound import SendQueue
+    from promptindex import PromptIndex
+    from containers import read_header_bytes
+
+    emoji_id = PromptInspector.CONFIG.get("EMOJI_ID") or 1
+    PromptInspector.CONFIG["EMOJI_ID"] = emoji_id
+    standin = StandIn(emoji_id, args.users)
+    PromptInspector.rest_cache.client = standin
+    PromptInspector.monitored[:] = [CHANNEL_ID]
+    PromptInspector.button_store = ButtonStore(None)
+    index_dir = None
+    if args.index:
+        index_dir = tempfile.TemporaryDirectory()
+        PromptInspector.prompt_index = PromptIndex(os.path.join(index_dir.name, "prompts.sqlite3"))
+        await PromptInspector.prompt_index.set_guild(GUILD_ID, True)
+    else:
+        PromptInspector.prompt_index = None
+    if args.unpaced:
+        PromptInspector.send_queue = SendQueue(route_rate=10 ** 9, route_per=1, global_rate=10 ** 9)
+    hits = {}
+    runner, base_url = await _serve(files, hits)
+    PromptInspector.civitai_client.api_url = base_url + "/api/v1"
+    PromptInspector.civitai_client.cache_path = None  # neither read from nor written to the bot's cache file
+    PromptInspector.civitai_client.cache.clear()
+
+    names, weights = parse_mix(args.mix, files)
+    images = {}
+    for name in names:
+        with open(files[name], "rb") as f:
+            data = f.read()
+        header = read_header_bytes(data)
+        images[name] = (f"{base_url}/attachments/{os.path.basename(files[name])}", data,
+                        header.width if header else None, header.height if header else None)
+
+    rng = np.random.default_rng(args.seed)
+    users = list(standin.users.values())
+    latencies = {"message": [], "reaction": []}
+    errors = Counter()
+    tasks = set()
+
+    async def timed(kind: str, arrived: float, handler):
+        try:
+            await handler
+        except Exception as e:
+            errors[f"{kind}: {type(e).__name__}"] += 1
+            return
+        latencies[kind].append(time.perf_counter() - arrived)
+
+    def dispatch(kind: str, handler):
+        task = asyncio.create_task(timed(kind, time.perf_counter(), handler))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    def react(message: FakeMessage, user: FakeUser):
+        event = SimpleNamespace(emoji=standin.emoji, channel_id=CHANNEL_ID, message_id=message.id, user_id=user.id,
+                                member=user, guild_id=GUILD_ID)
+        dispatch("reaction", PromptInspector.on_raw_reaction_add(event))
+
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    arrival = 0.0
+    posts = 0
+    while True:
+        arrival += rng.exponential(1 / args.rate)
+        if arrival >= args.seconds:
+            break
+        await asyncio.sleep(max(0.0, start + arrival - time.perf_counter()))
+        name = names[rng.choice(len(names), p=weights)]
+        url, data, width, height = images[name]
+        attachment = FakeAttachment(next(_ids), url, data, width, height)
+        message = FakeMessage(standin, users[int(rng.integers(len(users)))], [attachment])
+        posts += 1
+        dispatch("message", PromptInspector.on_message(message))
+        reactors = rng.choice(len(users), size=min(len(users), rng.poisson(args.reactions)), replace=False)
+        for user in reactors:
+            loop.call_later(args.reaction_delay, react, message, users[user])
+    await asyncio.sleep(args.reaction_delay)  # the last reactions
+    while tasks:
+        await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+
+    if PromptInspector.prompt_index is not None:
+        await PromptInspector.prompt_index.close()
+        index_dir.cleanup()
+    if getattr(PromptInspector.workers, "executor", None) is not None:
+        PromptInspector.workers.executor.shutdown(wait=True)  # so the workers' peak RSS is counted
+    await PromptInspector.http_session.close()
+    await PromptInspector.civitai_client.close()
+    await runner.cleanup()
+
+    events = sum(len(times) for times in latencies.values()) + sum(errors.values())
+    rest = dict(standin.rest, **hits)
+    return {
+        "posts": posts, "events": events, "seconds": elapsed, "events_per_s": events / elapsed,
+        "message": percentiles(latencies["message"]), "reaction": percentiles(latencies["reaction"]),
+        "errors": dict(errors), "rest_calls": rest,
+        "rest_per_event": {key: n / events for key, n in rest.items()} if events else {},
+        "outbound": dict(standin.outbound), "send_queue": PromptInspector.send_queue.stats(),
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "worker_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+
+def report(result: dict):
+    print(f"{result['posts']} posts, {result['events']} events in {result['seconds']:.1f}s: "
+          f"{result['events_per_s']:.1f} events/s")
+    print(f"{'event':<10} {'count':>7} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for kind in ("message", "reaction"):
+        stats = result[kind]
+        if stats["events"]:
+            print(f"{kind:<10} {stats['events']:>7} {stats['p50_ms']:>9.1f} {stats['p90_ms']:>9.1f} "
+                  f"{stats['p99_ms']:>9.1f} {stats['max_ms']:>9.1f}")
+    print("calls per event: " + ", ".join(f"{key} {n:.2f}" for key, n in sorted(result["rest_per_event"].items())))
+    print("outbound: " + ", ".join(f"{key} {n}" for key, n in sorted(result["outbound"].items())))
+    print(f"send queue: {result['send_queue']['rate_limited']} rate limited, "
+          f"{result['send_queue']['wait_seconds']:.1f}s waited in total")
+    print(f"peak RSS: {result['peak_rss_mb']:.0f} MB, workers {result['worker_rss_mb']:.0f} MB")
+    for error, n in result["errors"].items():
+        print(f"error: {error} x{n}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=float, default=5.0, help="posts per second")
+    parser.add_argument("--seconds", type=float, default=20.0, help="how long posts keep arriving")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="corpus file=weight,... (default: %(default)s)")
+    parser.add_argument("--reactions", type=float, default=1.0, help="mean reactions per post")
+    parser.add_argument("--reaction-delay", type=float, default=2.0, help="seconds between a post and its reactions")
+    parser.add_argument("--users", type=int, default=200, help="distinct posters and reactors")
+    parser.add_argument("--index", action="store_true", help="index every post into a temporary prompt index")
+    parser.add_argument("--unpaced", action="store_true", help="turn off send-queue pacing")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    files = corpus.build(max_side=4096 if "7680" not in args.mix else None)
+    result = asyncio.run(replay(args, files))
+    report(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
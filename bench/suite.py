@@ -0,0 +1,255 @@
+"""Offline benchmarks for every parse path, no Discord connection needed.
+
+Run from the repo root (needs a config.toml, a copy of config.template.toml is fine):
+
+    python -m bench.suite                    # everything
+    python -m bench.suite --quick            # leave out the 8K stealth images
+    python -m bench.suite --only stealth     # cases whose name contains "stealth"
+    python -m bench.suite --json out.json    # also save the results for comparing runs
+
+Each case runs in its own process so the peak RSS column belongs to that case alone.
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import numpy as np
+from PIL import Image
+
+from bench import corpus
+from containers import read_header_bytes
+from parsing import comfyui_parse, get_params_from_string, read_image_info
+from stealth import read_info_from_image_stealth, read_info_from_png_stealth
+
+READ_CASES = ["a1111", "novelai", "comfyui-1000", "jpeg-a1111", "webp-a1111", "webp-comfyui", "avif-a1111",
+              "stealth-alpha-comp-2048x2048", "stealth-rgb-3840x2160"]
+HEADER_CASES = ["a1111", "comfyui-1000", "jpeg-a1111", "webp-a1111", "webp-comfyui", "avif-a1111"]
+# each stealth decoder on its own: "pillow" from an image Pillow already decoded, "stream" from the PNG bytes
+DECODER_CASES = ["stealth-alpha-2048x2048", "stealth-alpha-comp-2048x2048", "stealth-rgb-2048x2048",
+                 "stealth-rgb-comp-3840x2160", "stealth-paeth-2048x2048"]
+
+
+def list_cases(files: dict) -> OrderedDict:
+    """case name -> format label"""
+    cases = OrderedDict()
+    cases["parse/a1111"] = "a1111"
+    for n in corpus.COMFYUI_NODES:
+        cases[f"parse/comfyui-{n}"] = "comfyui"
+    cases[f"parse/comfyui-workflow-{corpus.COMFYUI_NODES[-1]}"] = "comfyui"
+    for name in HEADER_CASES:
+        if name in files:
+            cases[f"header/{name}"] = name.split("-")[0]
+    cases["embed/a1111"] = "a1111"
+    cases["embed/novelai"] = "novelai"
+    for name in files:
+        if name.startswith("stealth-"):
+            cases[f"stealth/{name}"] = name.rsplit("-", 1)[0]
+    for name in DECODER_CASES:
+        if name in files:
+            cases[f"stealth-pillow/{name}"] = name.rsplit("-", 1)[0]
+            cases[f"stealth-stream/{name}"] = name.rsplit("-", 1)[0]
+    for name in READ_CASES:
+        if name in files:
+            cases[f"read/{name}"] = name.rsplit("-", 1)[0] if name.startswith("stealth-") else name.split("-")[0]
+    return cases
+
+
+class FakeAttachment:
+    """Just enough of discord.Attachment for read_attachment_metadata"""
+
+    def __init__(self, attachment_id: int, url: str, data: bytes, width: int, height: int):
+        self.id = attachment_id
+        self.url = url
+        self.filename = url.rsplit("/", 1)[-1]
+        self.content_type = "image/" + self.filename.rsplit(".", 1)[-1].replace("jpg", "jpeg")
+        self.size = len(data)
+        self.width = width
+        self.height = height
+
+    async def read(self) -> bytes:
+        import PromptInspector
+        async with (await PromptInspector.get_http_session()).get(self.url) as r:
+            return await r.read()
+
+
+async def _serve(files: dict, hits: dict = None):
+    """Serves the corpus like Discord's CDN and a Civitai stand-in; `hits` counts requests per route"""
+    from aiohttp import web
+
+    paths = {os.path.basename(path): path for path in files.values()}
+
+    async def image(request):
+        if hits is not None:
+            hits["cdn"] = hits.get("cdn", 0) + 1
+        return web.FileResponse(paths[request.match_info["file"]])  # answers Range requests like the CDN
+
+    async def civitai(request):
+        if hits is not None:
+            hits["civitai"] = hits.get("civitai", 0) + 1
+        return web.json_response({"modelId": 4201})
+
+    app = web.Application()
+    app.router.add_get("/attachments/{file}", image)
+    app.router.add_get("/api/v1/model-versions/by-hash/{hash}", civitai)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+
+
+def setup_case(case: str, files: dict, loop: asyncio.AbstractEventLoop):
+    """Returns (run once, input bytes per run, cleanup)"""
+    kind, name = case.split("/", 1)
+    if kind == "parse" and name == "a1111":
+        samples = corpus.text_samples()
+        it = iter(range(10 ** 9))
+        return lambda: get_params_from_string(samples[next(it) % len(samples)]), \
+            sum(map(len, samples)) / len(samples), None
+    if kind == "parse":
+        chunk = "prompt"
+        if name.startswith("comfyui-workflow-"):
+            chunk, name = "workflow", name.replace("-workflow", "")
+        with Image.open(files[name]) as img:
+            graph = img.info[chunk]
+        return lambda: comfyui_parse(graph), len(graph), None
+    if kind == "header":
+        with open(files[name], "rb") as f:
+            data = f.read()
+
+        def run():
+            assert read_header_bytes(data).text
+        return run, len(data), None
+    if kind == "stealth":
+        with open(files[name], "rb") as f:
+            data = f.read()
+
+        def run():
+            assert read_image_info(data, check_text=False)
+        return run, len(data), None
+    if kind == "stealth-pillow":
+        image = Image.open(files[name])
+        image.load()  # decoding isn't timed, the case is the decoder alone
+
+        def run():
+            assert read_info_from_image_stealth(image)
+        return run, os.path.getsize(files[name]), image.close
+    if kind == "stealth-stream":
+        with open(files[name], "rb") as f:
+            data = f.read()
+
+        def run():
+            assert read_info_from_png_stealth(data)
+        return run, len(data), None
+
+    import PromptInspector
+    runner, base_url = loop.run_until_complete(_serve(files))
+    PromptInspector.civitai_client.api_url = base_url + "/api/v1"
+    cleanup = lambda: loop.run_until_complete(runner.cleanup())
+    if kind == "embed":
+        context = SimpleNamespace(author=SimpleNamespace(display_avatar="https://example.invalid/a.png"))
+        if name == "a1111":
+            samples = [get_params_from_string(s) for s in corpus.text_samples()]
+            it = iter(range(10 ** 9))
+            return lambda: loop.run_until_complete(
+                PromptInspector.get_embed(samples[next(it) % len(samples)], context, "bench")), 0, cleanup
+        nai = corpus.novelai_text(np.random.default_rng(0))
+        return lambda: PromptInspector.get_embed_nai(nai, context, "bench"), 0, cleanup
+
+    # read: header/stealth path through a local HTTP server, with a cold metadata cache every time
+    with open(files[name], "rb") as f:
+        data = f.read()
+    header = read_header_bytes(data)
+    width, height = header.width, header.height
+    ids = iter(range(1, 10 ** 9))
+
+    def run():
+        PromptInspector.metadata_cache.clear()
+        attachment = FakeAttachment(next(ids), f"{base_url}/attachments/{os.path.basename(files[name])}", data, width, height)
+        metadata = OrderedDict()
+        loop.run_until_complete(PromptInspector.read_attachment_metadata(0, attachment, metadata))
+        assert metadata, f"no metadata read from {name}"
+
+    def read_cleanup():
+        if PromptInspector.workers.executor is not None:
+            PromptInspector.workers.executor.shutdown(wait=True)
+        loop.run_until_complete(PromptInspector.http_session.close())
+        cleanup()
+    return run, len(data), read_cleanup
+
+
+def run_case(case: str, seconds: float, min_runs: int, max_runs: int) -> dict:
+    files = corpus.existing()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    run, nbytes, cleanup = setup_case(case, files, loop)
+    run()  # warm-up: imports, worker startup, connection setup
+    times = []
+    start = time.perf_counter()
+    while len(times) < max_runs and (len(times) < min_runs or time.perf_counter() - start < seconds):
+        t = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - t)
+    total = sum(times)
+    if cleanup:
+        cleanup()
+    times.sort()
+    pct = lambda q: times[min(len(times) - 1, int(q * len(times)))] * 1000
+    return {
+        "case": case, "runs": len(times), "p50_ms": pct(0.5), "p99_ms": pct(0.99),
+        "ops_per_s": len(times) / total, "mb_per_s": nbytes * len(times) / total / 1024 ** 2,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "worker_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", help="run cases whose name contains this")
+    parser.add_argument("--quick", action="store_true", help="skip stealth images bigger than 4K")
+    parser.add_argument("--seconds", type=float, default=1.0, help="time spent per case")
+    parser.add_argument("--min-runs", type=int, default=5)
+    parser.add_argument("--max-runs", type=int, default=10000)
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--case", help=argparse.SUPPRESS)  # used for the per-case subprocess
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(args.case, args.seconds, args.min_runs, args.max_runs)))
+        return
+
+    print("Building corpus...", file=sys.stderr)
+    files = corpus.build(max_side=4096 if args.quick else None)
+    cases = list_cases(files)
+    results = []
+    print(f"{'case':<42} {'format':<18} {'runs':>6} {'ops/s':>9} {'MB/s':>8} {'p50 ms':>9} {'p99 ms':>9} "
+          f"{'RSS MB':>7} {'wRSS MB':>7}")
+    for case, fmt in cases.items():
+        if args.only and args.only not in case:
+            continue
+        out = subprocess.run([sys.executable, "-m", "bench.suite", "--case", case, "--seconds", str(args.seconds),
+                              "--min-runs", str(args.min_runs), "--max-runs", str(args.max_runs)],
+                             capture_output=True, text=True, cwd=os.getcwd())
+        if out.returncode != 0:
+            print(f"{case:<42} FAILED\n{out.stderr}")
+            continue
+        result = json.loads(out.stdout.strip().splitlines()[-1])
+        result["format"] = fmt
+        results.append(result)
+        print(f"{case:<42} {fmt:<18} {result['runs']:>6} {result['ops_per_s']:>9.1f} {result['mb_per_s']:>8.1f} "
+              f"{result['p50_ms']:>9.2f} {result['p99_ms']:>9.2f} {result['peak_rss_mb']:>7.0f} "
+              f"{result['worker_rss_mb']:>7.0f}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import asyncio
+import contextlib
+from collections import deque
+
+
+class BudgetTimeout(Exception):
+    pass
+
+
+class MemoryBudget:
+    """Admits memory-heavy work (full downloads, decoded pixel buffers) only while it fits in `max_bytes`.
+
+    Waiters are served first come, first served so a big image isn't starved by a stream of small ones.
+    A single job bigger than the whole budget is let through once nothing else is running."""
+
+    def __init__(self, max_bytes: int = 512 * 1024 ** 2, max_wait: float = 60):
+        self.max_bytes = max_bytes
+        self.max_wait = max_wait
+        self.used = 0
+        self.peak = 0
+        self.admitted = 0
+        self.timeouts = 0
+        self._waiters = deque()  # (nbytes, future)
+
+    @contextlib.asynccontextmanager
+    async def reserve(self, nbytes: int):
+        nbytes = min(nbytes, self.max_bytes)
+        await self._acquire(nbytes)
+        try:
+            yield
+        finally:
+            self._release(nbytes)
+
+    async def _acquire(self, nbytes: int):
+        if not self._waiters and self.used + nbytes <= self.max_bytes:
+            self._admit(nbytes)
+            return
+        waiter = (nbytes, asyncio.get_running_loop().create_future())
+        self._waiters.append(waiter)
+        # asyncio.wait rather than wait_for: wait_for swallows a cancel that lands after the admission
+        try:
+            done, _ = await asyncio.wait((waiter[1],), timeout=self.max_wait)
+        except asyncio.CancelledError:
+            self._give_up(waiter)
+            raise
+        if not done:
+            self._give_up(waiter)
+            self.timeouts += 1
+            raise BudgetTimeout(f"waited {self.max_wait}s for {nbytes / 1024 ** 2:.1f} MB of memory budget")
+
+    def _give_up(self, waiter: tuple):
+        nbytes, future = waiter
+        if future.done():
+            # admitted right as we gave up, hand the bytes back
+            self._release(nbytes)
+        else:
+            future.cancel()
+            self._waiters.remove(waiter)
+            self._wake()
+
+    def _admit(self, nbytes: int):
+        self.used += nbytes
+        self.peak = max(self.peak, self.used)
+        self.admitted += 1
+
+    def _release(self, nbytes: int):
+        self.used -= nbytes
+        self._wake()
+
+    def _wake(self):
+        while self._waiters and self.used + self._waiters[0][0] <= self.max_bytes:
+            nbytes, future = self._waiters.popleft()
+            self._admit(nbytes)
+            future.set_result(None)
+
+    def stats(self) -> dict:
+        return {"max_bytes": self.max_bytes, "used": self.used, "peak": self.peak, "waiting": len(self._waiters),
+                "waiting_bytes": sum(n for n, _ in self._waiters), "admitted": self.admitted,
+                "timeouts": self.timeouts}
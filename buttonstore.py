@@ -0,0 +1,103 @@
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import time
+import zlib
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (hash BLOB PRIMARY KEY, data BLOB NOT NULL, size INTEGER NOT NULL,
+                                  used REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS blobs_used ON blobs (used);
+CREATE TABLE IF NOT EXISTS buttons (message_id INTEGER NOT NULL, position INTEGER NOT NULL, hash BLOB NOT NULL,
+                                    PRIMARY KEY (message_id, position)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS buttons_hash ON buttons (hash);
+-- the size of every blob, kept in the database so processes sharing the file evict against the same total
+CREATE TABLE IF NOT EXISTS totals (id INTEGER PRIMARY KEY CHECK (id = 0), size INTEGER NOT NULL);
+INSERT OR IGNORE INTO totals SELECT 0, COALESCE(SUM(size), 0) FROM blobs;
+"""
+
+
+class ButtonStore:
+    """The metadata behind "Full Parameters" buttons, so sent views don't have to hold it.
+
+    Stored zlib-compressed in SQLite under (message id, position of the embed) and only read back when
+    a button is clicked. Identical metadata is kept once. Past `max_bytes` of compressed data the least
+    recently used blobs go, and their buttons answer that the data expired. With `path` None the
+    database lives in memory, which bounds memory the same way but doesn't survive a restart. Several
+    processes can share one file (cluster.py), a button sent by one works when another gets the click."""
+
+    def __init__(self, path: str = None, max_bytes: int = 256 * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self._db = sqlite3.connect(path or ":memory:", check_same_thread=False, timeout=30)
+        if path:
+            self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self.size = self._db.execute("SELECT size FROM totals").fetchone()[0]
+        self.stored = 0
+        self.hits = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def _put(self, message_id: int, metadata: list):
+        rows = []
+        for position, data in enumerate(metadata):
+            if data is None:
+                continue
+            raw = data.encode("utf-8")
+            rows.append((position, hashlib.sha1(raw).digest(), raw))
+        with self._lock, self._db:
+            now = time.time()
+            added = 0
+            for position, digest, raw in rows:
+                if self._db.execute("UPDATE blobs SET used = ? WHERE hash = ?", (now, digest)).rowcount == 0:
+                    blob = zlib.compress(raw, 6)
+                    self._db.execute("INSERT INTO blobs VALUES (?, ?, ?, ?)", (digest, blob, len(blob), now))
+                    added += len(blob)
+                self._db.execute("INSERT OR REPLACE INTO buttons VALUES (?, ?, ?)", (message_id, position, digest))
+                self.stored += 1
+            self.size = self._db.execute("UPDATE totals SET size = size + ? RETURNING size", (added,)).fetchone()[0]
+            self._evict()
+
+    def _evict(self):
+        freed = 0
+        while self.size - freed > self.max_bytes:
+            oldest = self._db.execute("SELECT hash, size FROM blobs ORDER BY used LIMIT 64").fetchall()
+            if not oldest:
+                break
+            for digest, size in oldest:
+                self._db.execute("DELETE FROM blobs WHERE hash = ?", (digest,))
+                self._db.execute("DELETE FROM buttons WHERE hash = ?", (digest,))
+                freed += size
+                self.evictions += 1
+                if self.size - freed <= self.max_bytes:
+                    break
+        if freed:
+            self.size = self._db.execute("UPDATE totals SET size = size - ? RETURNING size", (freed,)).fetchone()[0]
+
+    def _get(self, message_id: int, position: int):
+        with self._lock, self._db:
+            row = self._db.execute("SELECT blobs.hash, data FROM buttons JOIN blobs USING (hash) "
+                                   "WHERE message_id = ? AND position = ?", (message_id, position)).fetchone()
+            if row is None:
+                self.expired += 1
+                return None
+            self._db.execute("UPDATE blobs SET used = ? WHERE hash = ?", (time.time(), row[0]))
+        self.hits += 1
+        return zlib.decompress(row[1]).decode("utf-8")
+
+    async def put(self, message_id: int, metadata: list):
+        """metadata has one entry per embed of the message, None where there is no button"""
+        await asyncio.to_thread(self._put, message_id, metadata)
+
+    async def get(self, message_id: int, position: int):
+        return await asyncio.to_thread(self._get, message_id, position)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def stats(self) -> dict:
+        return {"bytes": self.size, "stored": self.stored, "hits": self.hits, "expired": self.expired,
+                "evictions": self.evictions}
@@ -0,0 +1,107 @@
+from collections import OrderedDict
+
+
+def _size_of(obj) -> int:
+    """Rough size in bytes of metadata strings and the dicts/lists parsed from them"""
+    if isinstance(obj, (str, bytes)):
+        return len(obj)
+    if isinstance(obj, dict):
+        return sum(_size_of(k) + _size_of(v) for k, v in obj.items()) + 64
+    if isinstance(obj, (list, tuple)):
+        return sum(_size_of(v) for v in obj) + 56
+    return 16
+
+
+class CacheEntry:
+    __slots__ = ("key", "info", "parsed", "size")
+
+    def __init__(self, key: str, info):
+        self.key = key
+        self.info = info  # what read_attachment_metadata extracted, None if the image has no metadata
+        self.parsed = {}  # parser name -> result
+        self.size = _size_of(info) + 128
+
+
+class MetadataCache:
+    """LRU cache of extracted metadata, bounded by size.
+
+    Entries are keyed by a content hash, attachment IDs point at those keys, so the same file
+    posted twice is only parsed once. Images without metadata are cached too (info is None)."""
+
+    def __init__(self, max_bytes: int = 64 * 1024 ** 2, max_ids: int = 100000):
+        self.max_bytes = max_bytes
+        self.max_ids = max_ids
+        self.entries = OrderedDict()  # content key -> CacheEntry
+        self.ids = OrderedDict()  # attachment id -> content key
+        self.size = 0
+        self.id_hits = 0
+        self.hash_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_by_id(self, attachment_id: int, count: bool = True):
+        key = self.ids.get(attachment_id)
+        entry = self.entries.get(key) if key is not None else None
+        if entry is None:
+            if key is not None:
+                del self.ids[attachment_id]
+            if count:
+                self.misses += 1
+            return None
+        self.ids.move_to_end(attachment_id)
+        self.entries.move_to_end(key)
+        if count:
+            self.id_hits += 1
+        return entry
+
+    def get_by_hash(self, key: str, attachment_id: int = None):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        self.hash_hits += 1
+        if attachment_id is not None:
+            self._link(attachment_id, key)
+        return entry
+
+    def put(self, key: str, info, attachment_id: int = None) -> CacheEntry:
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= old.size
+        entry = CacheEntry(key, info)
+        self.entries[key] = entry
+        self.size += entry.size
+        if attachment_id is not None:
+            self._link(attachment_id, key)
+        self._evict()
+        return entry
+
+    def set_parsed(self, entry: CacheEntry, name: str, result):
+        if self.entries.get(entry.key) is not entry:  # evicted or replaced since
+            return
+        size = _size_of(result)
+        entry.parsed[name] = result
+        entry.size += size
+        self.size += size
+        self._evict()
+
+    def _link(self, attachment_id: int, key: str):
+        self.ids[attachment_id] = key
+        self.ids.move_to_end(attachment_id)
+        while len(self.ids) > self.max_ids:
+            self.ids.popitem(last=False)
+
+    def _evict(self):
+        while self.size > self.max_bytes and self.entries:
+            _, entry = self.entries.popitem(last=False)
+            self.size -= entry.size
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.ids.clear()
+        self.size = 0
+
+    def stats(self) -> dict:
+        return {"entries": len(self.entries), "bytes": self.size, "id_hits": self.id_hits,
+                "hash_hits": self.hash_hits, "misses": self.misses, "evictions": self.evictions}
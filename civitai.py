@@ -0,0 +1,152 @@
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+
+import aiohttp
+
+from singleflight import SingleFlight
+
+API_URL = "https://civitai.com/api/v1"
+
+
+def _valid_entry(entry) -> bool:
+    return isinstance(entry, list) and len(entry) == 3 and isinstance(entry[0], str) and \
+        (entry[1] is None or isinstance(entry[1], str)) and isinstance(entry[2], (int, float))
+
+
+class CivitaiClient:
+    """Looks up Civitai model pages by model hash.
+
+    Results are kept in an LRU cache with a TTL; unknown hashes are cached too (with their own,
+    shorter TTL) so we don't ask again for every embed. Concurrent lookups of the same hash share
+    one request. If `cache_path` is set the cache is loaded from / saved to that JSON file; saving keeps
+    what other processes sharing the file saved."""
+
+    def __init__(self, api_url: str = API_URL, max_entries: int = 10000, ttl: float = 7 * 24 * 3600,
+                 negative_ttl: float = 6 * 3600, timeout: float = 10, cache_path: str = None,
+                 save_interval: float = 60):
+        self.api_url = api_url.rstrip("/")
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.cache_path = cache_path
+        self.save_interval = save_interval
+        self.cache = OrderedDict()  # hash -> (url or None, expires_at)
+        self.hits = 0
+        self.misses = 0
+        self.requests = 0
+        self.errors = 0
+        self._flights = SingleFlight()
+        self._session = None
+        self._dirty = False
+        self._last_save = time.monotonic()
+        self._save_task = None
+        if cache_path:
+            self.load()
+
+    async def lookup(self, model_hash: str):
+        """Returns the model URL or None if the hash is unknown (or Civitai can't be reached)"""
+        key = model_hash.upper()
+        entry = self.cache.get(key)
+        if entry is not None and entry[1] > time.time():
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        return await self._flights.do(key, self._fetch, key)
+
+    async def _fetch(self, key: str):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=self.timeout)
+        self.requests += 1
+        try:
+            async with self._session.get(f"{self.api_url}/model-versions/by-hash/{key}") as r:
+                if r.status == 404:
+                    self._store(key, None, self.negative_ttl)
+                    return None
+                if r.status != 200:
+                    self.errors += 1
+                    return None
+                arr = await r.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            print(f"civitai lookup failed: {type(e).__name__}: {e}")
+            self.errors += 1
+            return None
+        # null, a list or anything else that isn't a model version is a miss too
+        url = "https://civitai.com/models/" + str(arr["modelId"]) \
+            if isinstance(arr, dict) and arr.get("modelId") is not None else None
+        self._store(key, url, self.ttl if url else self.negative_ttl)
+        return url
+
+    def _store(self, key: str, url, ttl: float):
+        self.cache[key] = (url, time.time() + ttl)
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+        self._dirty = True
+        if self.cache_path and time.monotonic() - self._last_save >= self.save_interval and \
+                (self._save_task is None or self._save_task.done()):
+            self._last_save = time.monotonic()
+            self._save_task = asyncio.create_task(self._save_in_thread())
+
+    async def _save_in_thread(self):
+        """Periodic save: the file read, merge and write run on a thread, off the event loop"""
+        entries, self._dirty = list(self.cache.items()), False
+        try:
+            await asyncio.to_thread(self._write, entries)
+        except OSError as e:
+            print(f"Could not save civitai cache: {e}")
+            self._dirty = True
+
+    def load(self):
+        for key, url, expires_at in self._read():
+            self.cache[key] = (url, expires_at)
+
+    def _read(self) -> list:
+        """Unexpired entries in the file, oldest first. Entries that aren't [key, url, expires_at] are skipped."""
+        try:
+            with open(self.cache_path, encoding="utf-8") as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError) as e:
+            print(f"Could not load civitai cache: {e}")
+            return []
+        if not isinstance(entries, list):
+            print("Could not load civitai cache: not a list of entries")
+            return []
+        now = time.time()
+        return [entry for entry in entries[-self.max_entries:] if _valid_entry(entry) and entry[2] > now]
+
+    def save(self):
+        """Writes the cache to `cache_path` now (blocking)"""
+        if not self.cache_path or not self._dirty:
+            return
+        self._write(list(self.cache.items()))
+        self._dirty = False
+        self._last_save = time.monotonic()
+
+    def _write(self, entries: list):
+        """Merges `entries` into the file, atomically so a crash can't leave half a file"""
+        merged = OrderedDict((key, (url, expires_at)) for key, url, expires_at in self._read())
+        for key, entry in entries:
+            merged.pop(key, None)
+            merged[key] = entry
+        tmp = self.cache_path + f".{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump([[key, url, expires_at] for key, (url, expires_at) in list(merged.items())[-self.max_entries:]], f)
+        os.replace(tmp, self.cache_path)
+
+    def stats(self) -> dict:
+        return {"entries": len(self.cache), "hits": self.hits, "misses": self.misses,
+                "requests": self.requests, "errors": self.errors, "in_flight": len(self._flights)}
+
+    async def close(self):
+        if self._save_task is not None:
+            await self._save_task
+        await asyncio.to_thread(self.save)
+        if self._session is not None:
+            await self._session.close()
@@ -0,0 +1,83 @@
+"""Runs the bot as several processes splitting the gateway shards, all sending their parsing to one
+worker pool served from this process, so a big deployment uses every core.
+
+    python cluster.py                            # CLUSTER_PROCESSES processes, SHARD_COUNT shards
+    python cluster.py --processes 4 --shards 8   # override both
+
+Shard n goes to process n % processes. Each bot process is PromptInspector.py started with
+PICHAN_SHARDS, PICHAN_SHARD_COUNT, PICHAN_PROCESS, PICHAN_PROCESSES and PICHAN_PARSE_SERVER set;
+one that exits is started again. Only process 0 registers the slash commands.
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+import toml
+
+from workers import ParseServer, Workers
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+IDENTIFY_SECONDS = 5  # Discord lets a bot identify one shard every 5 seconds
+
+
+async def supervise(index: int, env: dict, delay: float):
+    await asyncio.sleep(delay)
+    while True:
+        process = await asyncio.create_subprocess_exec(sys.executable, os.path.join(ROOT, "PromptInspector.py"),
+                                                       cwd=ROOT, env=env)
+        try:
+            code = await process.wait()
+        except asyncio.CancelledError:
+            process.terminate()
+            await process.wait()
+            raise
+        print(f"Bot process {index} (shards {env['PICHAN_SHARDS']}) exited with {code}, restarting")
+        await asyncio.sleep(IDENTIFY_SECONDS)
+
+
+async def run(processes: int, shards: int, config: dict):
+    address = os.path.join(ROOT, config.get('PARSE_SERVER', 'parse.sock'))
+    workers = Workers(mode=config.get('WORKER_MODE', 'process'), count=config.get('WORKER_COUNT'),
+                      timeout=config.get('WORKER_TIMEOUT', 30), max_tasks=config.get('WORKER_MAX_TASKS', 500))
+    server = ParseServer(workers, address, config.get('PARSE_SECRET'))
+    await server.start()
+    print(f"Serving {workers.count} {workers.mode} parse workers on {address}")
+    supervisors = []
+    delay = 0
+    for index in range(processes):
+        shard_ids = list(range(index, shards, processes))
+        env = dict(os.environ, PICHAN_SHARDS=",".join(map(str, shard_ids)), PICHAN_SHARD_COUNT=str(shards),
+                   PICHAN_PROCESS=str(index), PICHAN_PROCESSES=str(processes), PICHAN_PARSE_SERVER=address)
+        supervisors.append(asyncio.create_task(supervise(index, env, delay)))
+        delay += IDENTIFY_SECONDS * len(shard_ids)  # so the processes don't identify at the same time
+    try:
+        await asyncio.gather(*supervisors)
+    finally:
+        for task in supervisors:
+            task.cancel()
+        await asyncio.gather(*supervisors, return_exceptions=True)
+        server.close()
+        workers.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", "-p", type=int, default=None, help="bot processes (default: CLUSTER_PROCESSES)")
+    parser.add_argument("--shards", "-s", type=int, default=None, help="gateway shards (default: SHARD_COUNT)")
+    args = parser.parse_args()
+    config = toml.load(os.path.join(ROOT, 'config.toml'))
+    processes = args.processes or config.get('CLUSTER_PROCESSES', 2)
+    shards = args.shards or config.get('SHARD_COUNT', processes)
+    if shards < processes:
+        parser.error(f"{processes} processes need at least as many shards, got {shards}")
+    if not config.get('PARSE_SECRET'):
+        parser.error("set PARSE_SECRET in config.toml, the parse server doesn't accept unauthenticated jobs")
+    try:
+        asyncio.run(run(processes, shards, config))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+import json
+
+# inputs that never lead to prompt text, so the conditioning walk doesn't wander into the whole graph
+NOT_CONDITIONING = {"clip", "model", "vae", "image", "images", "pixels", "mask", "latent", "latent_image", "samples",
+                    "control_net", "style_model", "clip_vision", "clip_vision_output", "upscale_model", "noise",
+                    "sampler", "sigmas", "guider"}
+TEXT_INPUTS = ("text", "text_g", "text_l", "clip_l", "t5xxl", "prompt", "positive_prompt", "negative_prompt")
+MODEL_INPUTS = ("ckpt_name", "unet_name", "model_name", "base_ckpt_name")
+SETTINGS = ("seed", "noise_seed", "steps", "cfg", "sampler_name", "scheduler", "denoise")
+# literal inputs of value/primitive nodes, tried when a linked input doesn't have a same-named one at its source
+VALUE_INPUTS = ("value", "int", "float", "string", "text", "seed", "noise_seed", "number")
+
+# widgets_values order of the common nodes, for workflow-only images (the UI format has no input names)
+WIDGETS = {
+    "CLIPTextEncode": ["text"],
+    "CLIPTextEncodeSDXL": ["width", "height", "crop_w", "crop_h", "target_width", "target_height", "text_g", "text_l"],
+    "CLIPTextEncodeSDXLRefiner": ["ascore", "width", "height", "text"],
+    "CheckpointLoaderSimple": ["ckpt_name"],
+    "UNETLoader": ["unet_name", "weight_dtype"],
+    "LoraLoader": ["lora_name", "strength_model", "strength_clip"],
+    "LoraLoaderModelOnly": ["lora_name", "strength_model"],
+    "EmptyLatentImage": ["width", "height", "batch_size"],
+    "EmptySD3LatentImage": ["width", "height", "batch_size"],
+    "KSampler": ["seed", "control_after_generate", "steps", "cfg", "sampler_name", "scheduler", "denoise"],
+    "KSamplerAdvanced": ["add_noise", "noise_seed", "control_after_generate", "steps", "cfg", "sampler_name",
+                         "scheduler", "start_at_step", "end_at_step", "return_with_leftover_noise"],
+    "RandomNoise": ["noise_seed", "control_after_generate"],
+    "KSamplerSelect": ["sampler_name"],
+    "BasicScheduler": ["scheduler", "steps", "denoise"],
+    "CFGGuider": ["cfg"],
+    "PrimitiveNode": ["value", "control_after_generate"],
+}
+
+
+def _is_link(value) -> bool:
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[1], int)
+
+
+class ComfyGraph:
+    """A ComfyUI graph, built with one json.loads from either the API `prompt` chunk or the UI `workflow` chunk.
+
+    nodes maps node id -> (class_type, inputs); a linked input is [source node id, output slot] in both cases."""
+
+    __slots__ = ("nodes", "data", "source")
+
+    def __init__(self, nodes: dict, data, source: str):
+        self.nodes = nodes
+        self.data = data
+        self.source = source  # "prompt" or "workflow"
+
+    @classmethod
+    def from_json(cls, text: str) -> "ComfyGraph":
+        data = json.loads(text)
+        if not isinstance(data, dict):
+            raise ValueError(f"not a ComfyUI graph: the JSON is a {type(data).__name__}, not an object")
+        if isinstance(data.get("nodes"), list):
+            return cls(cls._workflow_nodes(data), data, "workflow")
+        nodes = {str(node_id): (node.get("class_type", ""), node.get("inputs") or {})
+                 for node_id, node in data.items() if isinstance(node, dict)}
+        return cls(nodes, data, "prompt")
+
+    @staticmethod
+    def _workflow_nodes(data: dict) -> dict:
+        links = {}
+        for link in data.get("links") or []:
+            if isinstance(link, list) and len(link) >= 3:
+                links[link[0]] = [str(link[1]), link[2]]
+            elif isinstance(link, dict):
+                links[link.get("id")] = [str(link.get("origin_id")), link.get("origin_slot", 0)]
+        nodes = {}
+        for node in data["nodes"]:
+            if node.get("mode") in (2, 4):  # muted / bypassed
+                continue
+            node_type = node.get("type", "")
+            widgets = node.get("widgets_values")
+            inputs = {}
+            if isinstance(widgets, dict):  # some custom nodes save named widgets
+                inputs.update(widgets)
+            elif isinstance(widgets, list):
+                names = WIDGETS.get(node_type, [])
+                for i, value in enumerate(widgets):
+                    inputs[names[i] if i < len(names) else f"widget_{i}"] = value
+            for slot in node.get("inputs") or []:
+                if slot.get("link") in links:
+                    inputs[slot["name"]] = links[slot["link"]]
+            nodes[str(node["id"])] = (node_type, inputs)
+        return nodes
+
+    def resolve(self, value, name: str = None):
+        """Follows links until a literal value turns up (primitive, seed and string nodes), None if it doesn't"""
+        seen = set()
+        while _is_link(value):
+            node_id = str(value[0])
+            if node_id in seen or node_id not in self.nodes:
+                return None
+            seen.add(node_id)
+            _, inputs = self.nodes[node_id]
+            for key in ((name,) if name else ()) + VALUE_INPUTS:
+                if key in inputs:
+                    value = inputs[key]
+                    break
+            else:
+                literals = [v for v in inputs.values() if not _is_link(v)]
+                links = [v for v in inputs.values() if _is_link(v)]
+                if len(literals) == 1:
+                    value = literals[0]
+                elif len(links) == 1:  # Reroute and other pass-through nodes
+                    value = links[0]
+                else:
+                    return None
+        return value
+
+    def samplers(self) -> list:
+        """Node ids of every sampler: anything fed both positive and negative conditioning (or a guider)
+        along with sampling settings, so KSampler, KSamplerAdvanced, SamplerCustom(Advanced) and custom variants"""
+        found = []
+        for node_id, (_, inputs) in self.nodes.items():
+            conditioned = ("positive" in inputs and "negative" in inputs) or "guider" in inputs
+            if conditioned and any(key in inputs for key in SETTINGS + ("sampler", "sigmas", "noise")):
+                found.append(node_id)
+        return found
+
+    def _conditioning(self, inputs: dict, which: str):
+        """The link feeding a sampler's positive/negative side, looking through guider nodes"""
+        if which in inputs:
+            return inputs[which]
+        guider = inputs.get("guider")
+        if _is_link(guider) and str(guider[0]) in self.nodes:
+            _, guider_inputs = self.nodes[str(guider[0])]
+            if which in guider_inputs:
+                return guider_inputs[which]
+            if which == "positive":
+                return guider_inputs.get("conditioning")
+        return None
+
+    def prompt_texts(self, link) -> list:
+        """Prompt text reachable from a conditioning link. Nodes carrying both sides (ControlNetApplyAdvanced
+        and friends) are followed on the side matching the output slot."""
+        texts = []
+        stack = [link] if _is_link(link) else []
+        seen = set()
+        while stack:
+            node_id, slot = str(stack[-1][0]), stack[-1][1]
+            stack.pop()
+            if (node_id, slot) in seen or node_id not in self.nodes:
+                continue
+            seen.add((node_id, slot))
+            _, inputs = self.nodes[node_id]
+            if "positive" in inputs and "negative" in inputs:
+                side = inputs["positive" if slot == 0 else "negative"]
+                if _is_link(side):
+                    stack.append(side)
+                continue
+            for key in TEXT_INPUTS:
+                text = self.resolve(inputs[key], key) if key in inputs else None
+                if isinstance(text, str) and text.strip() and text not in texts:
+                    texts.append(text)
+            for key, value in reversed(list(inputs.items())):
+                if _is_link(value) and key not in NOT_CONDITIONING and key not in TEXT_INPUTS:
+                    stack.append(value)
+        return texts
+
+    def models(self, link) -> tuple:
+        """(checkpoints, loras) along a model chain. Loras are (name, strength)."""
+        checkpoints, loras = [], []
+        seen = set()
+        while _is_link(link) and str(link[0]) not in seen and str(link[0]) in self.nodes:
+            node_id = str(link[0])
+            seen.add(node_id)
+            _, inputs = self.nodes[node_id]
+            self._collect_models(inputs, checkpoints, loras)
+            link = inputs.get("model")
+        return checkpoints, loras
+
+    @staticmethod
+    def _collect_models(inputs: dict, checkpoints: list, loras: list):
+        for key in MODEL_INPUTS:
+            if isinstance(inputs.get(key), str) and inputs[key] not in checkpoints:
+                checkpoints.append(inputs[key])
+        if isinstance(inputs.get("lora_name"), str):
+            loras.append((inputs["lora_name"], inputs.get("strength_model", inputs.get("strength"))))
+        for value in inputs.values():  # rgthree's Power Lora Loader: {"on": true, "lora": ..., "strength": ...}
+            if isinstance(value, dict) and isinstance(value.get("lora"), str) and value.get("on", True):
+                loras.append((value["lora"], value.get("strength")))
+
+    def sampler_settings(self, node_id: str) -> dict:
+        """Seed, steps, cfg, sampler and scheduler of a sampler, looking one link away for the split-out
+        nodes SamplerCustomAdvanced uses (RandomNoise, KSamplerSelect, BasicScheduler, CFGGuider)"""
+        _, inputs = self.nodes[node_id]
+        neighbours = [self.nodes[str(v[0])][1] for v in inputs.values()
+                      if _is_link(v) and str(v[0]) in self.nodes]
+        settings = {}
+        for key in SETTINGS:
+            for source in [inputs] + neighbours:
+                if key in source:
+                    value = self.resolve(source[key], key)
+                    if value is not None:
+                        settings["seed" if key == "noise_seed" else key] = value
+                        break
+        latent = inputs.get("latent_image")
+        if _is_link(latent) and str(latent[0]) in self.nodes:
+            _, latent_inputs = self.nodes[str(latent[0])]
+            width, height = self.resolve(latent_inputs.get("width"), "width"), \
+                self.resolve(latent_inputs.get("height"), "height")
+            if width and height:
+                settings["size"] = f"{width}x{height}"
+        return settings
+
+    def summary(self) -> dict:
+        """{"samplers": [{positive, negative, settings, checkpoints, loras}], "checkpoints", "loras", "prompts"}.
+        `prompts` is every prompt text in the graph, for graphs without a recognisable sampler."""
+        samplers = []
+        for node_id in self.samplers():
+            _, inputs = self.nodes[node_id]
+            checkpoints, loras = self.models(inputs.get("model") or self._guider_model(inputs))
+            samplers.append({
+                "id": node_id,
+                "positive": self.prompt_texts(self._conditioning(inputs, "positive")),
+                "negative": self.prompt_texts(self._conditioning(inputs, "negative")),
+                "settings": self.sampler_settings(node_id),
+                "checkpoints": checkpoints,
+                "loras": loras,
+            })
+        checkpoints, loras, prompts = [], [], []
+        for _, inputs in self.nodes.values():
+            self._collect_models(inputs, checkpoints, loras)
+            for key in TEXT_INPUTS:
+                if isinstance(inputs.get(key), str) and inputs[key].strip():
+                    prompts.append(inputs[key])
+        return {"samplers": samplers, "checkpoints": checkpoints, "loras": loras, "prompts": prompts}
+
+    def _guider_model(self, inputs: dict):
+        guider = inputs.get("guider")
+        if _is_link(guider) and str(guider[0]) in self.nodes:
+            return self.nodes[str(guider[0])][1].get("model")
+        return None
+
+    def pretty(self) -> str:
+        return json.dumps(self.data, sort_keys=True, indent=2)
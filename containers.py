@@ -0,0 +1,503 @@
+"""Header-only metadata readers for the image containers people post, picked by the file's magic bytes.
+
+Each reader is a generator that yields (offset, size) requests and is sent the bytes at that offset back
+(fewer at the end of the file), so the same code runs over a downloaded file (read_header_bytes) and over
+HTTP range requests (fetch_header). Pixel data is never requested: JPEG stops at the first scan, WebP and
+AVIF jump straight to their EXIF/XMP chunks and items.
+"""
+import asyncio
+import hashlib
+import html
+import re
+import struct
+
+import aiohttp
+
+from pngchunks import PNG_SIGNATURE, READ_CHUNK, PngTextReader
+
+MAX_METADATA = 4 * 1024 ** 2  # largest EXIF/XMP block read, ComfyUI workflows included
+SEEK_THRESHOLD = 256 * 1024  # skipping more than this starts a new range request instead of reading through
+
+READERS = []  # (format, matches(first 16 bytes), reader generator function)
+
+
+def register(fmt: str, matches):
+    """Adds a reader for files whose first 16 bytes satisfy `matches`"""
+    def wrap(reader):
+        READERS.append((fmt, matches, reader))
+        return reader
+    return wrap
+
+
+def sniff(head: bytes):
+    """(format, reader) for the file starting with `head`, or (None, None)"""
+    for fmt, matches, reader in READERS:
+        if matches(head):
+            return fmt, reader
+    return None, None
+
+
+class HeaderInfo:
+    """What a reader found: Pillow-style text keys (parameters, prompt, workflow...), a digest of every
+    byte read (the metadata plus the headers, never pixels) and the image size when the header has it"""
+
+    __slots__ = ("format", "text", "digest", "width", "height")
+
+    def __init__(self, fmt: str):
+        self.format = fmt
+        self.text = {}
+        self.digest = hashlib.sha256(fmt.encode())
+        self.width = self.height = None
+
+
+# --- EXIF / XMP -------------------------------------------------------------------------------------------
+
+EXIF_IFD = 0x8769
+USER_COMMENT = 0x9286
+# ComfyUI's WebP saver puts "prompt:{...}" and "workflow:{...}" into these
+COMFYUI_TAGS = (0x010E, 0x010F, 0x0110)  # ImageDescription, Make, Model
+TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8}
+
+
+def decode_user_comment(value: bytes) -> str:
+    """EXIF UserComment: an 8 byte charset prefix, then the text"""
+    prefix, body = value[:8], value[8:]
+    if prefix == b"UNICODE\0":
+        # piexif (and so A1111) always writes UTF-16BE, other tools follow the TIFF byte order
+        if body[:2] in (b"\xfe\xff", b"\xff\xfe"):
+            encoding = "utf-16"
+        else:
+            encoding = "utf-16-be" if body[0::2].count(0) >= body[1::2].count(0) else "utf-16-le"
+        return body.decode(encoding, "ignore").rstrip("\0")
+    if prefix in (b"ASCII\0\0\0", b"\0" * 8):
+        return body.decode("utf-8", "replace").rstrip("\0")
+    return value.decode("utf-8", "replace").rstrip("\0")
+
+
+def _ifd_entries(tiff: bytes, offset: int, order: str):
+    """(tag, value bytes) of one IFD"""
+    if offset + 2 > len(tiff):
+        return
+    count = struct.unpack_from(order + "H", tiff, offset)[0]
+    for i in range(count):
+        pos = offset + 2 + i * 12
+        if pos + 12 > len(tiff):
+            return
+        tag, typ, n = struct.unpack_from(order + "HHI", tiff, pos)
+        size = TYPE_SIZES.get(typ, 1) * n
+        if size <= 4:
+            yield tag, tiff[pos + 8:pos + 8 + size]
+        else:
+            start = struct.unpack_from(order + "I", tiff, pos + 8)[0]
+            if start + size <= len(tiff):
+                yield tag, tiff[start:start + size]
+
+
+def parse_exif(tiff: bytes) -> dict:
+    """Generation text from a TIFF-structured EXIF block (with or without the "Exif\\0\\0" prefix)"""
+    if tiff.startswith(b"Exif\0\0"):
+        tiff = tiff[6:]
+    if tiff[:4] not in (b"II*\0", b"MM\0*"):
+        return {}
+    order = "<" if tiff[0] == 0x49 else ">"
+    text = {}
+    exif_ifd = None
+    for tag, value in _ifd_entries(tiff, struct.unpack_from(order + "I", tiff, 4)[0], order):
+        if tag == EXIF_IFD and len(value) == 4:
+            exif_ifd = struct.unpack(order + "I", value)[0]
+        elif tag in COMFYUI_TAGS:
+            key, _, rest = value.decode("utf-8", "replace").rstrip("\0").partition(":")
+            if key in ("prompt", "workflow") and rest.lstrip().startswith("{"):
+                text[key] = rest
+    if exif_ifd is not None:
+        for tag, value in _ifd_entries(tiff, exif_ifd, order):
+            if tag == USER_COMMENT:
+                comment = decode_user_comment(value)
+                if comment:
+                    text["parameters"] = comment
+    return text
+
+
+XMP_FIELDS = re.compile(r'<(exif:UserComment|dc:description)>.*?<rdf:li[^>]*>(.*?)</rdf:li>'
+                        r'|(exif:UserComment|dc:description)="([^"]*)"', re.S)
+XMP_HEADER = b"http://ns.adobe.com/xap/1.0/\0"
+
+
+def parse_xmp(packet: bytes) -> dict:
+    """UserComment (or failing that the description) of an XMP packet, as "parameters" """
+    found = {}
+    for match in XMP_FIELDS.finditer(packet.decode("utf-8", "replace")):
+        name, value = (match[1], match[2]) if match[1] else (match[3], match[4])
+        found.setdefault(name, html.unescape(value))
+    value = found.get("exif:UserComment") or found.get("dc:description")
+    return {"parameters": value} if value else {}
+
+
+# --- readers ----------------------------------------------------------------------------------------------
+
+@register("png", lambda head: head.startswith(PNG_SIGNATURE))
+def read_png(info: HeaderInfo):
+    """Text chunks up to the first IDAT, see PngTextReader. Returns the PngTextReader itself (it has the
+    IHDR fields the stealth path needs)."""
+    reader = PngTextReader()
+    offset = 0
+    while not reader.done:
+        data = yield offset, READ_CHUNK
+        if not data:
+            return None
+        reader.feed(data)
+        offset += len(data)
+    return reader if reader.is_png else None
+
+
+SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+@register("jpeg", lambda head: head.startswith(b"\xff\xd8\xff"))
+def read_jpeg(info: HeaderInfo):
+    """APP1 (EXIF, XMP) and COM segments, up to the start of the first scan"""
+    pos = 2
+    while True:
+        head = yield pos, 4
+        if len(head) < 4 or head[0] != 0xFF:
+            break
+        marker = head[1]
+        if marker == 0xFF:  # fill byte
+            pos += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:  # no length
+            pos += 2
+            continue
+        if marker in (0xDA, 0xD9):  # start of scan, end of image
+            break
+        length = struct.unpack_from(">H", head, 2)[0]
+        if length < 2:
+            break
+        info.digest.update(head)
+        if marker in (0xE1, 0xFE) or marker in SOF_MARKERS:
+            body = yield pos + 4, min(length - 2, MAX_METADATA)
+            info.digest.update(body)
+            if marker in SOF_MARKERS and len(body) >= 5:
+                info.height, info.width = struct.unpack_from(">HH", body, 1)
+            elif marker == 0xFE:
+                info.text.setdefault("comment", body.decode("utf-8", "replace"))
+            elif body.startswith(b"Exif\0\0"):
+                info.text.update(parse_exif(body[6:]))
+            elif body.startswith(XMP_HEADER):
+                for key, value in parse_xmp(body[len(XMP_HEADER):]).items():
+                    info.text.setdefault(key, value)
+        pos += 2 + length
+    if "parameters" not in info.text and "Steps: " in info.text.get("comment", ""):
+        info.text["parameters"] = info.text["comment"]
+    return info
+
+
+@register("webp", lambda head: head.startswith(b"RIFF") and head[8:12] == b"WEBP")
+def read_webp(info: HeaderInfo):
+    """EXIF and XMP chunks. They come after the image data, which is skipped over by offset."""
+    head = yield 0, 12
+    end = 8 + struct.unpack_from("<I", head, 4)[0]
+    pos = 12
+    wanted = {b"EXIF", b"XMP "}
+    while pos + 8 <= end and wanted:
+        head = yield pos, 8
+        if len(head) < 8:
+            break
+        fourcc, size = struct.unpack("<4sI", head)
+        info.digest.update(head)
+        if fourcc == b"VP8X":
+            body = yield pos + 8, 10
+            info.digest.update(body)
+            if len(body) == 10:
+                flags = body[0]
+                info.width = 1 + int.from_bytes(body[4:7], "little")
+                info.height = 1 + int.from_bytes(body[7:10], "little")
+                wanted = {fourcc for fourcc, bit in ((b"EXIF", 0x08), (b"XMP ", 0x04)) if flags & bit}
+        elif fourcc in (b"VP8 ", b"VP8L") and info.width is None:
+            body = yield pos + 8, 10
+            if fourcc == b"VP8 " and len(body) == 10:
+                w, h = struct.unpack_from("<HH", body, 6)
+                info.width, info.height = w & 0x3FFF, h & 0x3FFF
+            elif fourcc == b"VP8L" and len(body) >= 5:
+                bits = int.from_bytes(body[1:5], "little")
+                info.width, info.height = (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+            wanted = set()  # a simple (VP8/VP8L only) file has nothing after the image
+        elif fourcc in wanted:
+            body = yield pos + 8, min(size, MAX_METADATA)
+            info.digest.update(body)
+            info.text.update(parse_exif(body) if fourcc == b"EXIF" else parse_xmp(body))
+            wanted.discard(fourcc)
+        pos += 8 + size + (size & 1)
+    return info
+
+
+AVIF_BRANDS = {b"avif", b"avis", b"heic", b"heix", b"mif1", b"msf1"}
+
+
+def _box_header(data: bytes, pos: int):
+    """(type, header size, box size) of the ISOBMFF box at `pos`; box size 0 means "to the end" """
+    size, box_type = struct.unpack_from(">I4s", data, pos)
+    if size == 1:
+        return box_type, 16, struct.unpack_from(">Q", data, pos + 8)[0]
+    return box_type, 8, size
+
+
+def _boxes(data: bytes, start: int, end: int):
+    """(type, payload start, payload end) of the boxes in data[start:end]"""
+    pos = start
+    while pos + 8 <= end:
+        box_type, header, size = _box_header(data, pos)
+        box_end = end if size == 0 else pos + size
+        if box_end > end or box_end < pos + header:
+            return
+        yield box_type, pos + header, box_end
+        pos = box_end
+
+
+def _uint(data: bytes, pos: int, size: int) -> int:
+    return int.from_bytes(data[pos:pos + size], "big") if size else 0
+
+
+def _parse_iinf(meta: bytes, start: int, end: int) -> dict:
+    """item id -> "exif" / "xmp" for the metadata items"""
+    items = {}
+    version = meta[start]
+    pos = start + 4 + (2 if version == 0 else 4)
+    for box_type, body, box_end in _boxes(meta, pos, end):
+        if box_type != b"infe" or meta[body] < 2:
+            continue
+        version = meta[body]
+        pos = body + 4
+        id_size = 2 if version == 2 else 4
+        item_id = _uint(meta, pos, id_size)
+        item_type = meta[pos + id_size + 2:pos + id_size + 6]
+        if item_type == b"Exif":
+            items[item_id] = "exif"
+        elif item_type == b"mime":
+            # item_name, then content_type, both null-terminated
+            rest = meta[pos + id_size + 6:box_end].split(b"\0")
+            if len(rest) > 1 and rest[1] == b"application/rdf+xml":
+                items[item_id] = "xmp"
+    return items
+
+
+def _parse_iloc(meta: bytes, start: int) -> dict:
+    """item id -> (construction method, [(offset, length), ...])"""
+    version = meta[start]
+    pos = start + 4
+    offset_size, length_size = meta[pos] >> 4, meta[pos] & 0x0F
+    base_size, index_size = meta[pos + 1] >> 4, (meta[pos + 1] & 0x0F) if version in (1, 2) else 0
+    pos += 2
+    count_size = 2 if version < 2 else 4
+    count = _uint(meta, pos, count_size)
+    pos += count_size
+    locations = {}
+    for _ in range(count):
+        if pos >= len(meta):  # a count the box doesn't have room for
+            break
+        item_id = _uint(meta, pos, count_size)
+        pos += count_size
+        method = 0
+        if version in (1, 2):
+            method = _uint(meta, pos, 2) & 0x0F
+            pos += 2
+        pos += 2  # data_reference_index
+        base = _uint(meta, pos, base_size)
+        pos += base_size
+        extent_count = _uint(meta, pos, 2)
+        pos += 2
+        extents = []
+        for _ in range(extent_count):
+            pos += index_size
+            offset = _uint(meta, pos, offset_size)
+            length = _uint(meta, pos + offset_size, length_size)
+            pos += offset_size + length_size
+            extents.append((base + offset, length))
+        locations[item_id] = (method, extents)
+    return locations
+
+
+def _find_box(data: bytes, start: int, end: int, path: tuple):
+    """(payload start, payload end) of the first box along `path` (e.g. (b"iprp", b"ipco", b"ispe"))"""
+    for box_type, body, box_end in _boxes(data, start, end):
+        if box_type == path[0]:
+            return (body, box_end) if len(path) == 1 else _find_box(data, body, box_end, path[1:])
+    return None
+
+
+@register("avif", lambda head: head[4:8] == b"ftyp" and head[8:12] in AVIF_BRANDS)
+def read_avif(info: HeaderInfo):
+    """Exif and XMP items of an AVIF/HEIF file: the top-level `meta` box lists them (iinf) and says where
+    their bytes are (iloc), which is usually inside `mdat` next to the image items"""
+    pos = 0
+    meta = None
+    while meta is None:
+        head = yield pos, 16
+        if len(head) < 8:
+            return info
+        box_type, header, size = _box_header(head, 0)
+        if box_type == b"meta" and 0 < size <= MAX_METADATA:
+            meta = yield pos, size
+            if len(meta) < size:
+                return info
+        elif size == 0 or box_type == b"mdat":  # meta always comes before the media data
+            return info
+        pos += size
+    info.digest.update(meta)
+    body = 8 + 4  # meta is a full box
+    ispe = _find_box(meta, body, len(meta), (b"iprp", b"ipco", b"ispe"))
+    if ispe and ispe[1] - ispe[0] >= 12:
+        info.width, info.height = struct.unpack_from(">II", meta, ispe[0] + 4)
+    iinf = _find_box(meta, body, len(meta), (b"iinf",))
+    iloc = _find_box(meta, body, len(meta), (b"iloc",))
+    if not iinf or not iloc:
+        return info
+    items = _parse_iinf(meta, *iinf)
+    locations = _parse_iloc(meta, iloc[0])
+    idat = _find_box(meta, body, len(meta), (b"idat",))
+    for item_id, kind in sorted(items.items()):
+        method, extents = locations.get(item_id, (None, []))
+        data = b""
+        for offset, length in extents:
+            if not length or len(data) + length > MAX_METADATA:
+                break
+            if method == 0:
+                data += yield offset, length
+            elif method == 1 and idat:
+                data += meta[idat[0] + offset:idat[0] + offset + length]
+        info.digest.update(data)
+        if kind == "exif" and len(data) > 4:
+            # a 4 byte offset to the TIFF header comes first
+            info.text.update(parse_exif(data[4 + struct.unpack_from(">I", data)[0]:]))
+        elif kind == "xmp":
+            for key, value in parse_xmp(data).items():
+                info.text.setdefault(key, value)
+    return info
+
+
+# --- drivers ----------------------------------------------------------------------------------------------
+
+def _guarded(reader):
+    """Runs a reader, turning whatever a malformed file makes it raise into None (so the caller's full
+    read and Pillow still get their turn). Errors from reading the bytes themselves aren't caught here."""
+    try:
+        return (yield from reader)
+    except Exception:
+        return None
+
+
+def read_header_bytes(data: bytes):
+    """Runs the matching reader over a file already in memory. None for unknown formats."""
+    fmt, reader = sniff(data[:16])
+    if reader is None:
+        return None
+    gen = _guarded(reader(HeaderInfo(fmt)))
+    try:
+        offset, size = next(gen)
+        while True:
+            offset, size = gen.send(bytes(data[offset:offset + size]))
+    except StopIteration as stop:
+        return stop.value
+
+
+class LimitReached(Exception):
+    pass
+
+
+class RangeReader:
+    """Reads byte ranges of a remote file over one streaming response at a time. Reading forward continues
+    the current response; a jump back, or one further ahead than SEEK_THRESHOLD when the server honours
+    Range, opens a new one. Raises LimitReached once more than `limit` bytes have come in."""
+
+    def __init__(self, session: aiohttp.ClientSession, url: str, limit: int):
+        self.session = session
+        self.url = url
+        self.limit = limit
+        self.received = 0
+        self.requests = 0
+        self._response = None
+        self._pos = 0  # file offset of the next byte the response will give
+        self._ranges = False  # whether the last response was a 206
+        self._window = b""  # the last bytes read, so small re-reads don't need the network
+        self._window_start = 0
+
+    async def _open(self, offset: int):
+        await self.close()
+        self.requests += 1
+        response = await self.session.get(self.url, headers={"Range": f"bytes={offset}-"})
+        if response.status == 416:  # past the end
+            response.release()
+            self._pos = offset
+            return
+        response.raise_for_status()
+        self._response = response
+        self._ranges = response.status == 206
+        self._pos = offset if self._ranges else 0
+
+    async def _next(self, size: int) -> bytes:
+        data = await self._response.content.read(size)
+        self.received += len(data)
+        self._pos += len(data)
+        if self.received > self.limit:
+            raise LimitReached(self.limit)
+        return data
+
+    async def read(self, offset: int, size: int) -> bytes:
+        window_end = self._window_start + len(self._window)
+        if self._window_start <= offset and offset + size <= window_end:
+            return self._window[offset - self._window_start:offset + size - self._window_start]
+        parts = []
+        if self._response is not None and self._window_start <= offset <= window_end == self._pos:
+            parts.append(self._window[offset - self._window_start:])  # a read running on past the last one
+        elif self._response is None or offset < self._pos or \
+                (self._ranges and offset - self._pos > SEEK_THRESHOLD):
+            await self._open(offset)
+            if self._response is None:
+                return b""
+        while self._pos < offset:  # no range support, or a short hop: read through
+            if not await self._next(min(offset - self._pos, READ_CHUNK)):
+                return b""
+        want = size - sum(map(len, parts))
+        while want > 0:
+            data = await self._next(want)
+            if not data:
+                break
+            parts.append(data)
+            want -= len(data)
+        self._window, self._window_start = b"".join(parts), offset
+        return self._window
+
+    async def close(self):
+        if self._response is not None:
+            if self._response.content.at_eof():
+                self._response.release()
+            else:
+                self._response.close()  # drops the connection rather than downloading the rest
+            self._response = None
+
+
+async def fetch_header(session: aiohttp.ClientSession, url: str, limit: int):
+    """Reads the metadata of the image at `url` with range requests, dispatching on its magic bytes.
+    Returns a HeaderInfo (PngTextReader for PNGs), or None for unknown formats, files whose metadata
+    isn't found within `limit` bytes, and failed downloads or corrupt chunks (the caller falls back to
+    reading the whole file then)."""
+    source = RangeReader(session, url, limit)
+    try:
+        head = await source.read(0, 16)
+        fmt, reader = sniff(head)
+        if reader is None:
+            return None
+        gen = _guarded(reader(HeaderInfo(fmt)))
+        try:
+            request = next(gen)
+            while True:
+                request = gen.send(await source.read(*request))
+        except StopIteration as stop:
+            return stop.value
+    except LimitReached:
+        return None
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"Header read of {url} failed: {type(e).__name__}: {e}")
+        return None
+    finally:
+        await source.close()
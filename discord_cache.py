@@ -0,0 +1,102 @@
+from collections import OrderedDict, Counter
+
+import discord
+
+
+class _LRU(OrderedDict):
+    def __init__(self, max_size: int):
+        super().__init__()
+        self.max_size = max_size
+
+    def get(self, key, default=None):
+        if key in self:
+            self.move_to_end(key)
+            return self[key]
+        return default
+
+    def put(self, key, value):
+        self[key] = value
+        self.move_to_end(key)
+        while len(self) > self.max_size:
+            self.popitem(last=False)
+
+
+class RestCache:
+    """Remembers the Discord objects every event used to fetch over REST (reaction emoji, DM channels,
+    channels, messages). The bot forgets them on the matching gateway events (emoji update, channel
+    update/delete, message edit/delete). `avoided` counts REST calls saved, `rest_calls` the ones made."""
+
+    def __init__(self, client: discord.Client, max_messages: int = 5000, max_dms: int = 10000):
+        self.client = client
+        self.emojis = {}  # (guild id, emoji id) -> Emoji
+        self.dms = _LRU(max_dms)  # user id -> DMChannel
+        self.channels = {}  # channel id -> channel fetched over REST (the gateway cache didn't have it)
+        self.messages = _LRU(max_messages)  # message id -> Message
+        self.avoided = Counter()
+        self.rest_calls = Counter()
+
+    async def emoji(self, guild: discord.Guild, emoji_id: int):
+        emoji = self.emojis.get((guild.id, emoji_id))
+        if emoji is None:
+            emoji = self.client.get_emoji(emoji_id)
+        if emoji is not None:
+            self.avoided["emoji"] += 1
+        else:
+            self.rest_calls["emoji"] += 1
+            emoji = await guild.fetch_emoji(emoji_id)
+        self.emojis[(guild.id, emoji_id)] = emoji
+        return emoji
+
+    async def dm(self, user_id: int) -> discord.DMChannel:
+        channel = self.dms.get(user_id)
+        if channel is not None:
+            self.avoided["dm"] += 1
+            return channel
+        user = self.client.get_user(user_id)
+        if user is None:
+            self.rest_calls["user"] += 1
+            user = await self.client.fetch_user(user_id)
+        if user.dm_channel is not None:
+            self.avoided["dm"] += 1
+            channel = user.dm_channel
+        else:
+            self.rest_calls["dm"] += 1
+            channel = await user.create_dm()
+        self.dms.put(user_id, channel)
+        return channel
+
+    async def channel(self, channel_id: int):
+        channel = self.client.get_channel(channel_id) or self.channels.get(channel_id)
+        if channel is not None:
+            return channel
+        self.rest_calls["channel"] += 1
+        channel = self.channels[channel_id] = await self.client.fetch_channel(channel_id)
+        return channel
+
+    async def message(self, channel_id: int, message_id: int) -> discord.Message:
+        message = self.messages.get(message_id)
+        if message is not None:
+            self.avoided["message"] += 1
+            return message
+        channel = await self.channel(channel_id)
+        self.rest_calls["message"] += 1
+        message = await channel.fetch_message(message_id)
+        self.messages.put(message_id, message)
+        return message
+
+    def remember_message(self, message: discord.Message):
+        self.messages.put(message.id, message)
+
+    def forget_message(self, message_id: int):
+        self.messages.pop(message_id, None)
+
+    def forget_channel(self, channel_id: int):
+        self.channels.pop(channel_id, None)
+
+    def forget_guild_emojis(self, guild_id: int):
+        for key in [key for key in self.emojis if key[0] == guild_id]:
+            del self.emojis[key]
+
+    def stats(self) -> dict:
+        return {"avoided": dict(self.avoided), "rest_calls": dict(self.rest_calls),
+                "messages": len(self.messages), "dms": len(self.dms)}
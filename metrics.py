@@ -0,0 +1,162 @@
+import asyncio
+import bisect
+import contextvars
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from aiohttp import web
+
+# seconds; covers everything from a cached parse to a slow 8K download
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# which handler the current task is working for (on_message, reaction, print_params, view_raw_data);
+# asyncio copies it into the tasks gather() creates, so the read helpers don't need it passed in
+current_path = contextvars.ContextVar("metrics_path", default="other")
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other: "Histogram"):
+        for i, c in enumerate(other.counts):
+            self.counts[i] += c
+        self.sum += other.sum
+        self.count += other.count
+
+    def quantile(self, q: float) -> float:
+        """Estimated the way Prometheus' histogram_quantile does it (linear within a bucket)"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            if c and seen + c >= rank:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / c
+            seen += c
+        return self.buckets[-1]
+
+
+class _Stage:
+    __slots__ = ("format",)
+
+    def __init__(self, fmt: str):
+        self.format = fmt
+
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    escape = lambda v: str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels) + "}"
+
+
+class Metrics:
+    """Counters and latency histograms for each pipeline stage, served in the Prometheus text format"""
+
+    def __init__(self):
+        self.counters = defaultdict(float)  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.sources = {}  # prefix -> function returning a stats dict, exported as gauges
+
+    def inc(self, name: str, value: float = 1, **labels):
+        self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    @contextmanager
+    def stage(self, stage: str, fmt: str = "unknown"):
+        """Times a block as `stage`. Set `.format` on the yielded object once the format is known."""
+        timer = _Stage(fmt)
+        result = "ok"
+        start = time.perf_counter()
+        try:
+            yield timer
+        except asyncio.CancelledError:
+            result = "cancelled"
+            raise
+        except BaseException:
+            result = "error"
+            raise
+        finally:
+            labels = {"stage": stage, "path": current_path.get(), "format": timer.format}
+            self.observe("pichan_stage_seconds", time.perf_counter() - start, **labels)
+            self.inc("pichan_stage_total", result=result, **labels)
+
+    def total(self, name: str) -> float:
+        """A counter summed over all its labels"""
+        return sum(value for (counter, _), value in self.counters.items() if counter == name)
+
+    def add_source(self, prefix: str, stats):
+        self.sources[prefix] = stats
+
+    def render(self) -> str:
+        lines = []
+        typed = set()
+        for (name, labels), value in sorted(self.counters.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{_labels(labels)} {value:g}")
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda kv: kv[0]):
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            cumulative = 0
+            for bound, c in zip([f"{b:g}" for b in histogram.buckets] + ["+Inf"], histogram.counts):
+                cumulative += c
+                lines.append(f"{name}_bucket{_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {histogram.sum:g}")
+            lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+        for prefix, stats in self.sources.items():
+            for key, value in stats().items():
+                name = f"pichan_{prefix}_{key}"
+                if isinstance(value, dict):
+                    lines.append(f"# TYPE {name} gauge")
+                    lines += [f"{name}{_labels((('kind', k),))} {v:g}" for k, v in value.items()]
+                elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append(f"# TYPE {name} gauge")
+                    lines.append(f"{name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> dict:
+        """stage -> (runs, errors, p50 seconds, p99 seconds), over all paths and formats"""
+        merged = {}
+        for (name, labels), histogram in self.histograms.items():
+            if name == "pichan_stage_seconds":
+                merged.setdefault(dict(labels)["stage"], Histogram()).merge(histogram)
+        errors = defaultdict(float)
+        for (name, labels), value in self.counters.items():
+            labels = dict(labels)
+            if name == "pichan_stage_total" and labels["result"] == "error":
+                errors[labels["stage"]] += value
+        return {stage: (h.count, int(errors[stage]), h.quantile(0.5), h.quantile(0.99))
+                for stage, h in merged.items()}
+
+    async def serve(self, host: str, port: int) -> web.AppRunner:
+        async def handle(request):
+            return web.Response(body=self.render().encode("utf-8"),
+                                headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
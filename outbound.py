@@ -0,0 +1,169 @@
+import asyncio
+import itertools
+import time
+from collections import OrderedDict
+
+import discord
+
+# lower goes first: someone is waiting on a context-menu reply, a reaction DM can wait a little
+PRIORITIES = {"print_params": 0, "view_raw_data": 0, "full_parameters": 0, "reaction": 1, "backfill": 3}
+DEFAULT_PRIORITY = 2
+# routes whose Discord limit differs from the message one, by the part before the ":" -> (rate, per seconds)
+ROUTE_RATES = {"reactions": (4, 1.0)}
+
+
+class Debouncer:
+    """Remembers keys for `window` seconds; claim() is False for a key already claimed within that window.
+    release() a key when what it guarded failed, so a retry isn't collapsed into the failure."""
+
+    def __init__(self, window: float = 30, max_keys: int = 10000):
+        self.window = window
+        self.max_keys = max_keys
+        self._seen = OrderedDict()  # key -> time claimed, oldest first
+        self.claimed = 0
+        self.collapsed = 0
+        self.released = 0
+
+    def claim(self, key) -> bool:
+        now = time.monotonic()
+        while self._seen and (len(self._seen) >= self.max_keys or now - next(iter(self._seen.values())) >= self.window):
+            self._seen.popitem(last=False)
+        if key in self._seen:
+            self.collapsed += 1
+            return False
+        self._seen[key] = now
+        self.claimed += 1
+        return True
+
+    def release(self, key):
+        if self._seen.pop(key, None) is not None:
+            self.released += 1
+
+    def stats(self) -> dict:
+        return {"claimed": self.claimed, "collapsed": self.collapsed, "released": self.released,
+                "tracked": len(self._seen)}
+
+
+class _Bucket:
+    """Token bucket: `rate` sends per `per` seconds, with `rate` of them allowed back to back"""
+
+    __slots__ = ("rate", "per", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: int, per: float):
+        self.rate = rate
+        self.per = per
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def wait_time(self, now: float) -> float:
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.per)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) * self.per / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, seconds: float):
+        self.tokens = 0
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+def route_of(method) -> str:
+    """The rate-limit route a bound send method posts to: its channel (DMs included) or interaction webhook,
+    or the channel's reactions for add_reaction"""
+    target = getattr(method, "__self__", None)
+    if isinstance(target, discord.Message):
+        if getattr(method, "__name__", None) == "add_reaction":
+            return f"reactions:{target.channel.id}"
+        target = target.channel
+    if isinstance(target, discord.Webhook):
+        return f"webhook:{target.id}"
+    channel_id = getattr(target, "id", None)
+    return f"channel:{channel_id}" if channel_id is not None else "other"
+
+
+class SendQueue:
+    """Runs outbound Discord calls in priority order, pacing each route with a token bucket (Discord allows
+    about 5 messages per 5 seconds per channel) under a global one, so sends wait here instead of
+    running into 429s. A 429 that still gets through blocks its route for the retry-after time."""
+
+    def __init__(self, route_rate: int = 5, route_per: float = 5.0, global_rate: int = 45, max_routes: int = 10000):
+        self.route_rate = route_rate
+        self.route_per = route_per
+        self.max_routes = max_routes
+        self._global = _Bucket(global_rate, 1.0)
+        self._routes = OrderedDict()  # route -> _Bucket, least recently used first
+        self._pending = []  # (priority, sequence, route, future)
+        self._sequence = itertools.count()
+        self._wakeup = None
+        self._runner = None
+        self.sent = 0
+        self.rate_limited = 0
+        self.waited = 0.0
+
+    def _bucket(self, route: str) -> _Bucket:
+        bucket = self._routes.get(route)
+        if bucket is None:
+            rate, per = ROUTE_RATES.get(route.partition(":")[0], (self.route_rate, self.route_per))
+            bucket = self._routes[route] = _Bucket(rate, per)
+            while len(self._routes) > self.max_routes:
+                self._routes.popitem(last=False)
+        self._routes.move_to_end(route)
+        return bucket
+
+    async def submit(self, route: str, priority: int, factory):
+        """Waits for `route`'s turn, then awaits factory() and returns its result"""
+        if self._runner is None or self._runner.done():
+            self._wakeup = asyncio.Event()
+            self._runner = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((priority, next(self._sequence), route, future))
+        self._wakeup.set()
+        queued = time.monotonic()
+        try:
+            await future  # granted by the runner
+        finally:
+            self.waited += time.monotonic() - queued
+        try:
+            # sent from the caller's task, so it keeps the caller's context (metrics path) and cancellation
+            result = await factory()
+        except discord.HTTPException as e:
+            if e.status == 429:
+                self.rate_limited += 1
+                bucket = self._bucket(route)
+                bucket.block(getattr(e, "retry_after", None) or bucket.per)
+            raise
+        self.sent += 1
+        return result
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            delay = None
+            global_wait = self._global.wait_time(now)
+            for item in sorted(self._pending):
+                _, _, route, future = item
+                if future.done():  # the caller gave up
+                    self._pending.remove(item)
+                    continue
+                wait = max(global_wait, self._bucket(route).wait_time(now))
+                if wait > 0:
+                    delay = wait if delay is None else min(delay, wait)
+                    continue
+                self._pending.remove(item)
+                self._global.take()
+                self._bucket(route).take()
+                future.set_result(None)
+                global_wait = self._global.wait_time(now)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> dict:
+        return {"queued": len(self._pending), "sent": self.sent, "rate_limited": self.rate_limited,
+                "wait_seconds": self.waited, "routes": len(self._routes)}
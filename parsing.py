@@ -0,0 +1,289 @@
+import io
+import json
+import re
+
+from PIL import Image
+
+from comfyui import ComfyGraph
+from containers import read_header_bytes
+from stealth import PNG_SIGNATURE, UnsupportedPng, read_info_from_image_stealth, read_info_from_png_stealth
+
+
+def _comfyui_fields(graph: ComfyGraph) -> list:
+    """Embed fields ({"val", "type"}) for a ComfyUI graph: prompts by side, then settings and models per sampler"""
+    summary = graph.summary()
+    aa = []
+    seen = set()
+
+    def add(kind, value):
+        value = str(value)
+        if value.strip() and (kind, value) not in seen:
+            seen.add((kind, value))
+            aa.append({"val": value if len(value) <= 1024 else value[:1020] + '...', "type": kind})
+
+    for sampler in summary["samplers"]:
+        for text in sampler["positive"]:
+            add("positive", text)
+        for text in sampler["negative"]:
+            add("negative", text)
+    for sampler in summary["samplers"]:
+        settings = sampler["settings"]
+        add("sampler", ", ".join(f"{key}: {value}" for key, value in settings.items()))
+        for checkpoint in sampler["checkpoints"]:
+            add("model", checkpoint)
+        for name, strength in sampler["loras"]:
+            add("lora", name if strength is None else f"{name} ({strength})")
+    if not summary["samplers"]:  # nothing to hang the graph on, list what's in it
+        for text in summary["prompts"]:
+            add("prompt", text)
+        for checkpoint in summary["checkpoints"]:
+            add("model", checkpoint)
+        for name, strength in summary["loras"]:
+            add("lora", name if strength is None else f"{name} ({strength})")
+    return aa
+
+
+def comfyui_get_data(dat):
+    try:
+        return _comfyui_fields(ComfyGraph.from_json(dat))
+    except Exception as e:
+        print(e)
+        return []
+
+
+def comfyui_parse(dat) -> dict:
+    """Embed fields and the indented JSON of a ComfyUI graph from a single json.loads"""
+    graph = ComfyGraph.from_json(dat)
+    try:
+        fields = _comfyui_fields(graph)
+    except Exception as e:
+        print(e)
+        fields = []
+    return {"fields": fields, "pretty": graph.pretty()}
+
+
+# `Key: value` in an A1111 parameter line. Values are either JSON-quoted (and may hold commas, colons, escaped
+# quotes and nested `key: value` blocks, e.g. Lora hashes or ControlNet 0) or run up to the next comma/newline.
+_KEY = r'[^:,"\n]+'
+_QUOTED = r'[^"\\]*(?:\\.[^"\\]*)*'
+_PLAIN = r'[^,\n]*'
+PAIR_RE = re.compile(f'[,\\s]*({_KEY}): (?:"({_QUOTED})"|({_PLAIN}))')
+PARAMS_LINE_RE = re.compile(f'{_KEY}: (?:"{_QUOTED}"|{_PLAIN})(?:, {_KEY}: (?:"{_QUOTED}"|{_PLAIN}))*')
+NUMBER_START = set('-.0123456789')
+INT_RE = re.compile(r'-?\d+')
+FLOAT_RE = re.compile(r'-?\d*\.\d+(?:[eE][-+]?\d+)?|-?\d+[eE][-+]?\d+')
+
+
+def _typed(value: str):
+    """int/float for numbers, a dict for nested `key: value` blocks, the string otherwise"""
+    if value[:1] in NUMBER_START:
+        if INT_RE.fullmatch(value):
+            return int(value)
+        if FLOAT_RE.fullmatch(value):
+            return float(value)
+    if ': ' in value:
+        nested = _tokenize_params(value, strict=True)
+        if nested is not None:
+            return {key: _typed(raw) for key, raw in nested.items()}
+    return value
+
+
+def _tokenize_params_re(line: str) -> dict:
+    pairs = {key: quoted or plain for key, quoted, plain in PAIR_RE.findall(line)}
+    if '\\' in line:
+        for key, quoted, plain in PAIR_RE.findall(line):
+            if '\\' in quoted:
+                try:
+                    pairs[key] = json.loads(f'"{quoted}"')
+                except ValueError:
+                    pass
+    return pairs
+
+
+def _tokenize_params(line: str, strict: bool = False) -> dict:
+    """Splits `Key: value, Key: "quoted, value", ...` into {key: value} with quoted values unquoted.
+
+    One pass over the line split at its quotes: outside a quote it's plain `, `-separated pairs, and the
+    piece just before a quote is the key of the quoted value. Escaped quotes, or a quote that isn't a whole
+    value, go through PAIR_RE instead. Text that isn't a pair is skipped, or makes it return None with
+    strict=True."""
+    if strict and not PARAMS_LINE_RE.fullmatch(line):
+        return None
+    if '\\' in line:
+        return _tokenize_params_re(line)
+    if '\n' in line:
+        line = line.replace('\n', ', ')  # A1111 JSON-quotes values with newlines, so these only separate pairs
+    parts = line.split('"')
+    last = len(parts) - 1
+    if last % 2:
+        return _tokenize_params_re(line)
+    pairs = {}
+    for i in range(0, last + 1, 2):
+        pieces = parts[i].split(', ')
+        quoted_key = pieces.pop() if i < last else None
+        for piece in pieces:
+            key, sep, value = piece.partition(': ')
+            if sep:
+                pairs[key.lstrip(', ')] = value
+        if quoted_key is not None:
+            if not quoted_key.endswith(': '):
+                return _tokenize_params_re(line)
+            pairs[quoted_key[:-2].lstrip(', ')] = parts[i + 1]
+    return pairs
+
+
+def _params_start(text: str) -> int:
+    """Where the parameter line starts: the last line beginning with `Steps: `, or A1111's rule
+    (the last line, if it has at least 3 pairs). len(text) when there are no parameters."""
+    start = text.rfind("\nSteps: ") + 1
+    if start or text.startswith("Steps: "):
+        return start
+    start = text.find("Steps: ")  # older tools glued it onto the negative prompt
+    if start != -1:
+        return start
+    start = text.rfind("\n") + 1
+    if len(PAIR_RE.findall(text, start)) >= 3:
+        return start
+    return len(text)
+
+
+def _split_a1111(text: str):
+    """(prompt, negative prompt or None, {key: unquoted value text})"""
+    text = text.strip()
+    params_at = _params_start(text)
+    if text.startswith("Negative prompt:"):
+        neg_at = 0
+    else:
+        neg_at = text.find("\nNegative prompt:", 0, params_at)
+        neg_at = neg_at + 1 if neg_at != -1 else text.find("Negative prompt: ", 0, params_at)  # or glued on
+    if neg_at == -1:
+        prompt, negative = text[:params_at].rstrip(), None
+    else:
+        prompt = text[:neg_at].rstrip()
+        negative = text[neg_at + len("Negative prompt:"):params_at].strip()
+    raw = _tokenize_params(text[params_at:])
+    return prompt, negative, raw
+
+
+def parse_a1111(text: str) -> dict:
+    """Tokenizes A1111-style generation parameters in one pass.
+
+    Returns {"prompt": str, "negative_prompt": str or None, "params": {key: value}, "raw": {key: str}}.
+    `params` holds ints/floats/nested dicts, `raw` the unquoted text of each value as written."""
+    prompt, negative, raw = _split_a1111(text)
+    params = {key: _typed(value) for key, value in raw.items()}
+    return {"prompt": prompt, "negative_prompt": negative, "params": params, "raw": raw}
+
+
+def get_params_from_string(param_str):
+    """Flat {field: text} for the embed: Prompt, Negative Prompt, then every parameter"""
+    prompt, negative, raw = _split_a1111(param_str)
+    output_dict = {'Prompt': prompt if len(prompt) <= 1024 else prompt[:1020] + '...'}
+    if negative is not None:
+        output_dict['Negative Prompt'] = negative if len(negative) <= 1024 else negative[:1020] + '...'
+    output_dict.update(raw)
+    return output_dict
+
+
+def novelai_get_data(info: dict) -> dict:
+    """Fields of a NovelAI image: the JSON in its Comment chunk plus the model hash from Source"""
+    data = json.loads(info["Comment"])
+    data['Model Hash'] = info['Source'].split()[-1:][0].lower()
+    return data
+
+
+def parse_metadata(info):
+    """Returns (format, parsed fields) for whatever read_image_info found"""
+    fmt = detect_format(info)
+    if fmt == "a1111":
+        return fmt, get_params_from_string(info)
+    elif fmt == "novelai":
+        return fmt, novelai_get_data(info)
+    elif fmt == "comfyui":
+        return fmt, ComfyGraph.from_json(info).summary()
+    return fmt, None
+
+
+LORA_TAG_RE = re.compile(r'<(?:lora|lyco):([^:>]+)(?::[^>]*)?>')
+
+
+def index_fields(info) -> dict:
+    """The searchable parts of any supported metadata: {format, prompt, negative, model, model_hash,
+    loras (list of names), sampler}, "" where the format doesn't have it"""
+    fmt = detect_format(info)
+    fields = {"format": fmt, "prompt": "", "negative": "", "model": "", "model_hash": "", "loras": [], "sampler": ""}
+    if fmt == "a1111":
+        prompt, negative, raw = _split_a1111(info)
+        loras = LORA_TAG_RE.findall(prompt)
+        hashes = _typed(raw["Lora hashes"]) if "Lora hashes" in raw else {}
+        loras += [name for name in hashes if name not in loras] if isinstance(hashes, dict) else []
+        fields.update(prompt=prompt, negative=negative or "", model=raw.get("Model", ""),
+                      model_hash=raw.get("Model hash", ""), loras=loras, sampler=raw.get("Sampler", ""))
+    elif fmt == "novelai":
+        data = novelai_get_data(info)
+        fields.update(prompt=str(data.get("prompt", "")), negative=str(data.get("uc", "")),
+                      model=info.get("Source", ""), model_hash=data["Model Hash"], sampler=str(data.get("sampler", "")))
+    elif fmt == "comfyui":
+        summary = ComfyGraph.from_json(info).summary()
+        samplers = summary["samplers"]
+        positive = [text for sampler in samplers for text in sampler["positive"]] or summary["prompts"]
+        negative = [text for sampler in samplers for text in sampler["negative"]]
+        checkpoints = [name for sampler in samplers for name in sampler["checkpoints"]] or summary["checkpoints"]
+        loras = [name for sampler in samplers for name, _ in sampler["loras"]] or [name for name, _ in summary["loras"]]
+        fields.update(prompt="\n".join(dict.fromkeys(positive)), negative="\n".join(dict.fromkeys(negative)),
+                      model=checkpoints[0] if checkpoints else "", loras=list(dict.fromkeys(loras)),
+                      sampler=str(samplers[0]["settings"].get("sampler_name", "")) if samplers else "")
+    return fields
+
+
+def get_info_from_text(text: dict):
+    """Picks the generation data out of PNG text chunks (or `img.info`)"""
+    if 'parameters' in text:
+        return text['parameters']
+    elif 'prompt' in text or 'Prompt' in text:
+        return text['prompt']
+    elif 'workflow' in text:  # ComfyUI images saved without the API prompt
+        return text['workflow']
+    elif "Software" in text:
+        return text
+    return None
+
+
+def read_image_info(image_data: bytes, check_text: bool = True):
+    """Decodes a downloaded image and returns its generation data (text chunks first, then stealth pnginfo).
+    PNGs are streamed through read_info_from_png_stealth, so only their leading columns are ever decoded;
+    JPEG, WebP and AVIF only have their EXIF/XMP read, without Pillow."""
+    if check_text and not image_data.startswith(PNG_SIGNATURE):
+        header = read_header_bytes(image_data)
+        if header is not None:
+            return get_info_from_text(header.text)
+    if not check_text and image_data.startswith(PNG_SIGNATURE):
+        try:
+            return read_info_from_png_stealth(image_data)
+        except UnsupportedPng:
+            pass
+    with Image.open(io.BytesIO(image_data)) as img:
+        info = get_info_from_text(img.info) if check_text else None
+        if not info and check_text and img.format == "PNG":
+            try:
+                return read_info_from_png_stealth(image_data)
+            except UnsupportedPng:
+                pass
+        if not info:
+            info = read_info_from_image_stealth(img)
+    return info
+
+
+def pretty_json(data: str) -> str:
+    return json.dumps(json.loads(data), sort_keys=True, indent=2)
+
+
+def detect_format(data) -> str:
+    """Which generator wrote this metadata, by the same checks the handlers use"""
+    if 'Steps:' in data:
+        return "a1111"
+    elif 'Software' in data:
+        return "novelai"
+    elif "\"inputs\"" in data:
+        return "comfyui"
+    return "unknown"
@@ -0,0 +1,146 @@
+import hashlib
+import struct
+import zlib
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+MAX_TEXT_CHUNK = 1024 ** 2  # same limits as PIL.PngImagePlugin
+MAX_TEXT_MEMORY = 64 * MAX_TEXT_CHUNK
+READ_CHUNK = 64 * 1024
+
+
+def _decompress(data: bytes) -> bytes:
+    dobj = zlib.decompressobj()
+    plaintext = dobj.decompress(data, MAX_TEXT_CHUNK)
+    if dobj.unconsumed_tail:
+        raise ValueError("Decompressed Data Too Large")
+    return plaintext
+
+
+def decode_text_chunk(cid: bytes, data: bytes):
+    """Decodes a tEXt/zTXt/iTXt chunk the same way Pillow fills `img.info`, returns (key, value) or None"""
+    if cid == b"iTXt":
+        try:
+            k, r = data.split(b"\0", 1)
+        except ValueError:
+            return None
+        if len(r) < 2:
+            return None
+        cf, cm, r = r[0], r[1], r[2:]
+        try:
+            lang, tk, v = r.split(b"\0", 2)
+        except ValueError:
+            return None
+        if cf != 0:
+            if cm != 0:
+                return None
+            try:
+                v = _decompress(v)
+            except zlib.error:
+                return None
+        try:
+            return k.decode("latin-1", "strict"), v.decode("utf-8", "strict")
+        except UnicodeError:
+            return None
+
+    try:
+        k, v = data.split(b"\0", 1)
+    except ValueError:
+        k, v = data, b""
+    if cid == b"zTXt":
+        if v and v[0] != 0:
+            raise SyntaxError(f"Unknown compression method {v[0]} in zTXt chunk")
+        try:
+            v = _decompress(v[1:])
+        except zlib.error:
+            v = b""
+    if not k:
+        return None
+    return k.decode("latin-1", "strict"), v.decode("latin-1", "replace")
+
+
+class PngTextReader:
+    """Incremental PNG chunk reader. Feed it the start of a file; it collects text chunks and
+    reports done at the first IDAT (Pillow does not read text past that point on open either).
+    `digest` hashes exactly the bytes before that IDAT, i.e. everything the text depends on."""
+
+    format = "png"
+
+    def __init__(self):
+        self.text = {}
+        self.is_png = None
+        self.done = False
+        self._buffer = bytearray()
+        self._skip = 0
+        self._text_memory = 0
+        self.digest = hashlib.sha256()
+        self.width = self.height = self.bit_depth = self.color_type = self.interlace = None
+
+    def feed(self, data: bytes) -> bool:
+        if self.done:
+            return True
+        if self._skip:
+            skipped = min(self._skip, len(data))
+            self._skip -= skipped
+            self.digest.update(data[:skipped])
+            data = data[skipped:]
+        self._buffer += data
+        buf = self._buffer
+        pos = 0
+        if self.is_png is None:
+            if len(buf) < len(PNG_SIGNATURE):
+                return False
+            self.is_png = buf[:len(PNG_SIGNATURE)] == PNG_SIGNATURE
+            if not self.is_png:
+                self.done = True
+                return True
+            pos = len(PNG_SIGNATURE)
+        while len(buf) - pos >= 8:
+            length, cid = struct.unpack_from(">I4s", buf, pos)
+            if cid in (b"IDAT", b"IEND"):
+                self.done = True
+                break
+            if cid == b"IHDR" and len(buf) - pos >= 8 + 13:
+                self.width, self.height, self.bit_depth, self.color_type, self.interlace = \
+                    struct.unpack_from(">IIBBxxB", buf, pos + 8)
+            if cid not in (b"tEXt", b"zTXt", b"iTXt"):
+                # skip data + crc without buffering it
+                end = pos + 8 + length + 4
+                if end > len(buf):
+                    self._skip = end - len(buf)
+                    pos = len(buf)
+                    break
+                pos = end
+                continue
+            if len(buf) - pos < 8 + length + 4:
+                break
+            chunk = bytes(buf[pos + 8:pos + 8 + length])
+            crc = struct.unpack_from(">I", buf, pos + 8 + length)[0]
+            if zlib.crc32(cid + chunk) != crc:
+                raise SyntaxError(f"broken PNG file (bad CRC in {cid.decode()} chunk)")
+            item = decode_text_chunk(cid, chunk)
+            if item is not None:
+                self.text[item[0]] = item[1]
+                self._text_memory += len(item[1])
+                if self._text_memory > MAX_TEXT_MEMORY:
+                    raise ValueError("Too much memory used in text chunks")
+            pos += 8 + length + 4
+        self.digest.update(buf[:pos])
+        del buf[:pos]
+        return self.done
+
+    @property
+    def decoded_size(self):
+        """Roughly how many bytes Pillow needs to hold the decoded image, None before IHDR was seen"""
+        if self.width is None:
+            return None
+        if self.color_type in (2, 4, 6):
+            per_pixel = 4  # Pillow keeps multi-band images at 4 bytes per pixel
+        else:
+            per_pixel = 2 if self.bit_depth == 16 else 1
+        return self.width * self.height * per_pixel
+
+    @property
+    def streamable(self) -> bool:
+        """Whether stealth.read_info_from_png_stealth can read this image without Pillow decoding it"""
+        return self.bit_depth == 8 and self.color_type in (2, 6) and not self.interlace
+
@@ -0,0 +1,228 @@
+import asyncio
+import re
+import sqlite3
+import threading
+import time
+import traceback
+from collections import Counter
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY, attachment_id INTEGER NOT NULL UNIQUE, guild_id INTEGER NOT NULL,
+    channel_id INTEGER NOT NULL, message_id INTEGER NOT NULL, author_id INTEGER NOT NULL, posted REAL NOT NULL,
+    format TEXT NOT NULL, prompt TEXT NOT NULL, negative TEXT NOT NULL, model TEXT NOT NULL,
+    model_hash TEXT NOT NULL, loras TEXT NOT NULL, sampler TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS images_author ON images (author_id);
+CREATE INDEX IF NOT EXISTS images_guild ON images (guild_id, id);
+-- `guild` holds "g<guild id>" so a search is an FTS intersection instead of a filter over every match
+CREATE VIRTUAL TABLE IF NOT EXISTS images_fts USING fts5(guild, prompt, negative, model, loras, content='');
+-- what /stats shows, kept up to date by the writer so it never has to scan images
+CREATE TABLE IF NOT EXISTS counts (guild_id INTEGER NOT NULL, kind TEXT NOT NULL, value TEXT NOT NULL,
+                                   n INTEGER NOT NULL, PRIMARY KEY (guild_id, kind, value)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS guilds (guild_id INTEGER PRIMARY KEY, enabled_by INTEGER, enabled_at REAL);
+CREATE TABLE IF NOT EXISTS opted_out (user_id INTEGER PRIMARY KEY);
+"""
+COLUMNS = ("attachment_id", "guild_id", "channel_id", "message_id", "author_id", "posted", "format", "prompt",
+           "negative", "model", "model_hash", "loras", "sampler")
+STAT_KINDS = ("format", "model", "sampler")
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def fts_query(text: str) -> str:
+    """User input as an FTS5 query: every word must match, a trailing * on a word matches prefixes.
+    Operators and quotes are ignored, so no input is a syntax error."""
+    terms = []
+    for word in text.split():
+        prefix = word.endswith("*")
+        terms += [f'"{part}"' for part in WORD_RE.findall(word)]
+        if prefix and terms:
+            terms[-1] += "*"
+    return " ".join(terms)
+
+
+class PromptIndex:
+    """Opt-in, per-guild full-text index of the metadata the bot reads in monitored channels.
+
+    add() queues rows; they are written in one transaction per batch (every `batch_size` rows or
+    `flush_interval` seconds) on a thread. A batch that fails to write is logged and counted in
+    metrics(); close() waits for the writes in flight and writes what is still queued. Searches go through FTS5 and /stats through the `counts`
+    table the writer keeps, so neither scans the images table. Users who opted out are never written
+    and their rows are deleted when they opt out. Processes sharing the file (cluster.py) see each other's
+    opt-outs at their next write."""
+
+    def __init__(self, path: str, batch_size: int = 200, flush_interval: float = 2.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self.guilds = {row[0] for row in self._db.execute("SELECT guild_id FROM guilds")}
+        self.opted_out = {row[0] for row in self._db.execute("SELECT user_id FROM opted_out")}
+        self._pending = []
+        self._flush_task = None  # the flush_interval timer
+        self._writes = set()  # flushes started because a batch filled up
+        self.written = 0
+        self.batches = 0
+        self.failed = 0
+
+    def enabled(self, guild_id: int, author_id: int) -> bool:
+        return guild_id in self.guilds and author_id not in self.opted_out
+
+    def add(self, attachment, message, fields: dict):
+        """Queues one image; no-op unless its guild opted in and its author didn't opt out"""
+        if message.guild is None or not self.enabled(message.guild.id, message.author.id):
+            return
+        self._pending.append((attachment.id, message.guild.id, message.channel.id, message.id, message.author.id,
+                              message.created_at.timestamp(), fields["format"], fields["prompt"], fields["negative"],
+                              fields["model"], fields["model_hash"], ", ".join(fields["loras"]), fields["sampler"]))
+        if len(self._pending) >= self.batch_size:
+            task = asyncio.create_task(self.flush())
+            self._writes.add(task)
+            task.add_done_callback(self._flushed)
+        elif self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+            self._flush_task.add_done_callback(self._flushed)
+
+    def _flushed(self, task: asyncio.Task):
+        self._writes.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self.failed += 1
+            print("Prompt index write failed:\n" + "".join(traceback.format_exception(task.exception())))
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+    async def flush(self):
+        rows, self._pending = self._pending, []
+        if rows:
+            await asyncio.to_thread(self._write, rows)
+
+    def _write(self, rows: list):
+        counts = Counter()
+        with self._lock, self._db:
+            # another process may have taken an opt-out since this one loaded them
+            self.opted_out = {row[0] for row in self._db.execute("SELECT user_id FROM opted_out")}
+            for row in rows:
+                if row[4] in self.opted_out or row[1] not in self.guilds:  # changed while the row was queued
+                    continue
+                cursor = self._db.execute(f"INSERT OR IGNORE INTO images ({', '.join(COLUMNS)}) "
+                                          f"VALUES ({', '.join('?' * len(COLUMNS))})", row)
+                if not cursor.rowcount:  # already indexed (backfill, edits)
+                    continue
+                fields = dict(zip(COLUMNS, row))
+                self._db.execute("INSERT INTO images_fts (rowid, guild, prompt, negative, model, loras) "
+                                 "VALUES (?, ?, ?, ?, ?, ?)", (cursor.lastrowid, *self._fts_values(fields)))
+                self._count(counts, fields, 1)
+                self.written += 1
+            self._save_counts(counts)
+            self.batches += 1
+
+    @staticmethod
+    def _fts_values(fields: dict) -> tuple:
+        return f"g{fields['guild_id']}", fields["prompt"], fields["negative"], fields["model"], fields["loras"]
+
+    @staticmethod
+    def _count(counts: Counter, fields: dict, n: int):
+        guild_id = fields["guild_id"]
+        counts[(guild_id, "total", "")] += n
+        for kind in STAT_KINDS:
+            if fields[kind]:
+                counts[(guild_id, kind, fields[kind])] += n
+        for lora in fields["loras"].split(", "):
+            if lora:
+                counts[(guild_id, "lora", lora)] += n
+
+    def _save_counts(self, counts: Counter):
+        self._db.executemany("INSERT INTO counts VALUES (?, ?, ?, ?) ON CONFLICT DO UPDATE SET n = n + excluded.n",
+                             [(*key, n) for key, n in counts.items() if n])
+
+    def _delete(self, where: str, args: tuple):
+        rows = self._db.execute(f"SELECT id, {', '.join(COLUMNS)} FROM images WHERE {where}", args).fetchall()
+        counts = Counter()
+        for row in rows:
+            fields = dict(zip(COLUMNS, row[1:]))
+            # a contentless table has to be given the indexed values back to remove them
+            self._db.execute("INSERT INTO images_fts (images_fts, rowid, guild, prompt, negative, model, loras) "
+                             "VALUES ('delete', ?, ?, ?, ?, ?, ?)", (row[0], *self._fts_values(fields)))
+            self._count(counts, fields, -1)
+        self._db.execute(f"DELETE FROM images WHERE {where}", args)
+        self._save_counts(counts)
+        self._db.execute("DELETE FROM counts WHERE n <= 0")
+        return len(rows)
+
+    async def set_guild(self, guild_id: int, enabled: bool, user_id: int = None) -> int:
+        """Turns indexing on or off for a guild; turning it off deletes what was indexed. Returns rows deleted."""
+        def run():
+            with self._lock, self._db:
+                if enabled:
+                    self._db.execute("INSERT OR REPLACE INTO guilds VALUES (?, ?, ?)", (guild_id, user_id, time.time()))
+                    self.guilds.add(guild_id)
+                    return 0
+                self._db.execute("DELETE FROM guilds WHERE guild_id = ?", (guild_id,))
+                self.guilds.discard(guild_id)
+                return self._delete("guild_id = ?", (guild_id,))
+        return await asyncio.to_thread(run)
+
+    async def set_opt_out(self, user_id: int, opted_out: bool) -> int:
+        """Opting out deletes every image the user posted from the index. Returns rows deleted."""
+        def run():
+            with self._lock, self._db:
+                if not opted_out:
+                    self._db.execute("DELETE FROM opted_out WHERE user_id = ?", (user_id,))
+                    self.opted_out.discard(user_id)
+                    return 0
+                self._db.execute("INSERT OR IGNORE INTO opted_out VALUES (?)", (user_id,))
+                self.opted_out.add(user_id)
+                return self._delete("author_id = ?", (user_id,))
+        return await asyncio.to_thread(run)
+
+    def _search(self, guild_id: int, query: str, model: str, limit: int) -> list:
+        match = f'guild : "g{guild_id}"'
+        if query:
+            match += f" AND {{prompt negative loras}} : ({query})"
+        if model:
+            match += f" AND model : ({model})"
+        with self._lock:
+            return self._db.execute(
+                "SELECT images.guild_id, channel_id, message_id, author_id, format, images.prompt, images.model, "
+                "sampler, images.loras "
+                "FROM images_fts JOIN images ON images.id = images_fts.rowid "
+                "WHERE images_fts MATCH ? ORDER BY images_fts.rowid DESC LIMIT ?", (match, limit)).fetchall()
+
+    async def search(self, guild_id: int, text: str, model: str = "", limit: int = 10) -> list:
+        """Newest first: [(guild id, channel id, message id, author id, format, prompt, model, sampler, loras)]"""
+        query, model = fts_query(text), fts_query(model)
+        if not query and not model:
+            return []
+        return await asyncio.to_thread(self._search, guild_id, query, model, limit)
+
+    def _stats(self, guild_id: int, top: int) -> dict:
+        with self._lock:
+            rows = self._db.execute("SELECT kind, value, n FROM counts WHERE guild_id = ? ORDER BY kind, n DESC",
+                                    (guild_id,)).fetchall()
+        stats = {}
+        for kind, value, n in rows:
+            values = stats.setdefault(kind, [])
+            if len(values) < top:
+                values.append((value, n))
+        return stats
+
+    async def stats(self, guild_id: int, top: int = 5) -> dict:
+        """kind (total, format, model, lora, sampler) -> [(value, images)], most common first"""
+        return await asyncio.to_thread(self._stats, guild_id, top)
+
+    async def close(self):
+        """Writes everything queued, including batches still being written, then closes the database"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()  # its rows are written by the flush below
+        await asyncio.gather(*self._writes, return_exceptions=True)  # _flushed already logged failures
+        await self.flush()
+        with self._lock:
+            self._db.close()
+
+    def metrics(self) -> dict:
+        return {"written": self.written, "batches": self.batches, "failed_batches": self.failed,
+                "pending": len(self._pending), "guilds": len(self.guilds), "opted_out": len(self.opted_out)}
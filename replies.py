@@ -0,0 +1,82 @@
+import os
+
+# Discord's per-message limits
+MAX_EMBEDS = 10
+MAX_EMBED_CHARS = 6000  # summed over every embed in the message
+MAX_FILES = 10
+MAX_CONTENT = 2000
+MAX_UPLOAD = 8 * 1024 ** 2  # the smallest per-message upload limit (servers without boosts)
+
+
+class Reply:
+    __slots__ = ("embed", "content", "files", "metadata")
+
+    def __init__(self, embed=None, content: str = None, files: list = None, metadata=None):
+        self.embed = embed
+        self.content = content
+        self.files = files or []  # [(filename, text)]
+        self.metadata = metadata  # what the "Full Parameters" button shows, if anything
+
+
+class PackedMessage:
+    """One message worth of replies: send with content=, embeds= and files made from attachments()"""
+
+    __slots__ = ("embeds", "content", "files", "metadata")
+
+    def __init__(self):
+        self.embeds = []
+        self.content = []
+        self.files = []  # [(filename, text, number of the image it belongs to)]
+        self.metadata = []  # one entry per embed, None where there is nothing to expand
+
+    def fits(self, reply: Reply) -> bool:
+        if not self.embeds and not self.content and not self.files:
+            return True  # anything goes into an empty message, the way it did when every image had its own
+        embeds = self.embeds + ([reply.embed] if reply.embed is not None else [])
+        content = "\n".join(self.content + ([reply.content] if reply.content else []))
+        files = [text for _, text, _ in self.files] + [text for _, text in reply.files]
+        return (len(embeds) <= MAX_EMBEDS and sum(map(len, embeds)) <= MAX_EMBED_CHARS
+                and len(files) <= MAX_FILES and len(content) <= MAX_CONTENT
+                and sum(len(text.encode("utf-8")) for text in files) <= MAX_UPLOAD)
+
+    def add(self, reply: Reply):
+        if reply.embed is not None:
+            self.embeds.append(reply.embed)
+            self.metadata.append(reply.metadata)
+        if reply.content:
+            self.content.append(reply.content)
+        for name, text in reply.files:
+            self.files.append((name, text, len(self.embeds)))
+
+    def attachments(self) -> list:
+        """[(filename, text)], numbered after their image when a name comes up more than once"""
+        names = [name for name, _, _ in self.files]
+        renamed = []
+        for name, text, position in self.files:
+            if names.count(name) > 1:
+                stem, ext = os.path.splitext(name)
+                name = f"{stem}-{position}{ext}"
+            renamed.append((name, text))
+        return renamed
+
+
+class ReplyPacker:
+    """Collects the reply for each image of a post and packs them, in order, into as few messages as
+    Discord's embed, file and size limits allow (greedy, which is optimal when the order is kept)"""
+
+    def __init__(self):
+        self.replies = []
+
+    def add(self, embed=None, content: str = None, files: list = None, metadata=None):
+        self.replies.append(Reply(embed, content, files, metadata))
+
+    def __len__(self):
+        return len(self.replies)
+
+    def pack(self) -> list:
+        messages = []
+        for reply in self.replies:
+            if not messages or not messages[-1].fits(reply):
+                messages.append(PackedMessage())
+            messages[-1].add(reply)
+        return messages
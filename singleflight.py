@@ -0,0 +1,51 @@
+import asyncio
+
+
+class _Call:
+    __slots__ = ("task", "waiters", "abandoned")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+        self.abandoned = False
+
+
+class SingleFlight:
+    """Lets concurrent callers asking for the same key share one running task.
+
+    Every caller gets the task's result or exception. A caller being cancelled only cancels its own
+    wait; the task itself is cancelled once nobody is waiting for it any more. The key is forgotten as
+    soon as the task finishes, so failures are not remembered and the next call starts over."""
+
+    def __init__(self):
+        self._calls = {}
+        self.started = 0
+        self.shared = 0
+
+    async def do(self, key, func, *args):
+        call = self._calls.get(key)
+        if call is None or call.abandoned:
+            call = _Call(asyncio.ensure_future(func(*args)))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _: self._forget(key, call))
+            self.started += 1
+        else:
+            self.shared += 1
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                call.abandoned = True
+                call.task.cancel()
+
+    def _forget(self, key, call: _Call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    def __len__(self):
+        return len(self._calls)
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self._calls), "started": self.started, "shared": self.shared}
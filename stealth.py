@@ -0,0 +1,241 @@
+import gzip
+import io
+import struct
+import zlib
+
+import numpy as np
+from PIL import Image
+
+SIG_LEN = len("stealth_pnginfo") * 8  # signature length in bits
+ALPHA_SIGS = {b"stealth_pnginfo": False, b"stealth_pngcomp": True}
+RGB_SIGS = {b"stealth_rgbinfo": False, b"stealth_rgbcomp": True}
+HEADER_PIXELS = SIG_LEN + 32  # alpha signature + length, the longest header
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+INFLATE_CHUNK = 256 * 1024  # most bytes inflated at once
+
+
+def _lsb_pixels(columns, height: int, start: int, count: int) -> np.ndarray:
+    """Returns the LSBs of `count` pixels starting at column-major pixel index `start`, shape (count, bands).
+    columns(x0, x1) returns those pixel columns as a (height, x1 - x0, bands) array."""
+    x0 = start // height
+    x1 = -(-(start + count) // height)
+    block = columns(x0, x1)
+    # column-major order: transpose to (x, y, band) and flatten the first two axes
+    flat = block.transpose(1, 0, 2).reshape(-1, block.shape[2])
+    offset = start - x0 * height
+    return flat[offset:offset + count] & 1
+
+
+def _image_columns(image: Image.Image):
+    def columns(x0, x1):
+        block = np.asarray(image.crop((x0, 0, x1, image.height)))
+        return block[:, :, None] if block.ndim == 2 else block
+    return columns
+
+
+def _bits_to_bytes(bits: np.ndarray) -> bytearray:
+    """Packs bits MSB first. A trailing partial group is read as a right-aligned integer."""
+    full = len(bits) // 8 * 8
+    data = bytearray(np.packbits(bits[:full]).tobytes())
+    if full != len(bits):
+        data.append(int("".join(map(str, bits[full:].tolist())), 2))
+    return data
+
+
+def _bits_to_int(bits: np.ndarray) -> int:
+    return int.from_bytes(np.packbits(bits).tobytes(), "big") >> (-len(bits) % 8)
+
+
+def _read_header(lsb, total: int, has_alpha: bool):
+    """Finds the signature and payload length. Returns (mode, compressed, payload start pixel, payload length
+    in bits, payload bits already read) or None. Only looks at the first HEADER_PIXELS pixels."""
+    # the rgb signature fits in the first 40 pixels, the alpha one needs 120
+    rgb_sig_px = SIG_LEN // 3
+    mode = None
+    if total >= rgb_sig_px:
+        sig = bytes(_bits_to_bytes(lsb(0, rgb_sig_px)[:, :3].reshape(-1)))
+        if sig in RGB_SIGS:
+            mode, compressed = "rgb", RGB_SIGS[sig]
+    if mode is None:
+        if not has_alpha or total < SIG_LEN:
+            return None
+        sig = bytes(_bits_to_bytes(lsb(0, SIG_LEN)[:, 3]))
+        if sig not in ALPHA_SIGS:
+            return None
+        mode, compressed = "alpha", ALPHA_SIGS[sig]
+
+    if mode == "alpha":
+        pos = SIG_LEN
+        if total < pos + 32:
+            return None
+        param_len = _bits_to_int(lsb(pos, 32)[:, 3])
+        return mode, compressed, pos + 32, param_len, np.zeros(0, dtype=np.uint8)
+    # 32 length bits take 11 pixels, the 33rd bit is the first payload bit
+    pos = rgb_sig_px
+    if total < pos + 11:
+        return None
+    len_bits = lsb(pos, 11)[:, :3].reshape(-1)
+    return mode, compressed, pos + 11, _bits_to_int(len_bits[:32]), len_bits[32:]
+
+
+def _payload_pixels(header) -> int:
+    """How many pixels after the header the payload takes"""
+    mode, _, _, param_len, first_bits = header
+    if mode == "alpha":
+        return param_len
+    return max(1, -(-(param_len - len(first_bits)) // 3))
+
+
+def _read_payload(lsb, total: int, header):
+    mode, compressed, pos, param_len, first_bits = header
+    if param_len == 0:
+        return None
+    count = _payload_pixels(header)
+    if total < pos + count:
+        return None
+    if mode == "alpha":
+        bits = lsb(pos, count)[:, 3]
+    else:
+        bits = np.concatenate((first_bits, lsb(pos, count)[:, :3].reshape(-1)))[:param_len]
+
+    byte_data = _bits_to_bytes(bits)
+    try:
+        if compressed:
+            return gzip.decompress(bytes(byte_data)).decode("utf-8")
+        return byte_data.decode("utf-8", errors="ignore")
+    except Exception as e:
+        print(e)
+    return None
+
+
+def read_info_from_image_stealth(image: Image.Image):
+    """Reads stealth pnginfo (alpha or rgb LSB, plain or gzip) written column-major from the top-left pixel"""
+    if image.mode == "RGBA":
+        has_alpha = True
+    elif len(image.getbands()) == 3:
+        has_alpha = False
+    else:
+        return None
+    total = image.width * image.height
+    columns = _image_columns(image)
+    lsb = lambda start, count: _lsb_pixels(columns, image.height, start, count)
+    header = _read_header(lsb, total, has_alpha)
+    if header is None:
+        return None
+    return _read_payload(lsb, total, header)
+
+
+class UnsupportedPng(Exception):
+    """read_info_from_png_stealth only handles 8-bit, non-interlaced RGB and RGBA PNGs"""
+
+
+def _png_chunk(kind: bytes, payload: bytes) -> bytes:
+    return struct.pack(">I", len(payload)) + kind + payload + struct.pack(">I", zlib.crc32(kind + payload))
+
+
+def _unfilter_rows(filtered, nrows: int, ncols: int, bpp: int) -> bytes:
+    """Undoes the PNG filters of `nrows` scanline prefixes, each a filter byte and the first `ncols` pixels.
+    Every filter only looks left and up, so the prefixes are a valid PNG of their own, which Pillow's
+    decoder unfilters far faster than a Python loop over Sub/Avg/Paeth could."""
+    ihdr = struct.pack(">IIBBBBB", ncols, nrows, 8, 6 if bpp == 4 else 2, 0, 0, 0)
+    png = PNG_SIGNATURE + _png_chunk(b"IHDR", ihdr) + _png_chunk(b"IDAT", zlib.compress(filtered, 0)) + \
+        _png_chunk(b"IEND", b"")
+    with Image.open(io.BytesIO(png)) as image:
+        return image.tobytes()
+
+
+def _png_idat(data: bytes):
+    """Yields (width, height, bit depth, color type, interlace) from IHDR, then the IDAT payloads"""
+    view = memoryview(data)
+    if bytes(view[:8]) != PNG_SIGNATURE:
+        raise UnsupportedPng("not a PNG")
+    pos = 8
+    seen_idat = False
+    while pos + 8 <= len(view):
+        length, cid = struct.unpack_from(">I4s", view, pos)
+        body = view[pos + 8:pos + 8 + length]
+        if cid == b"IHDR":
+            yield struct.unpack_from(">IIBBxxB", body)
+        elif cid == b"IDAT":
+            seen_idat = True
+            yield body
+        elif seen_idat or cid == b"IEND":
+            return
+        pos += 8 + length + 4
+
+
+def stream_memory(width: int, height: int, color_type: int) -> int:
+    """Roughly the most memory read_info_from_png_stealth needs for an image this size"""
+    bpp = 4 if color_type == 6 else 3
+    # the buffered header rows, the inflate buffer, and a generous number of kept columns (held filtered,
+    # then as the PNG handed to Pillow and the unfiltered result)
+    return HEADER_PIXELS * (1 + width * bpp) + 2 * INFLATE_CHUNK + 3 * height * 64 * bpp
+
+
+def read_info_from_png_stealth(data: bytes):
+    """Same result as read_info_from_image_stealth(Image.open(data)) without decoding the whole image.
+
+    The IDAT stream is inflated a bit at a time and only the leading pixel columns of each scanline are
+    unfiltered and kept: first enough rows for the signature and length, then exactly the columns the
+    payload needs, so memory grows with the image height rather than its area. Images without a signature
+    stop after the first HEADER_PIXELS rows. Raises UnsupportedPng for PNGs it can't stream (16-bit,
+    interlaced, palette/grey) so the caller can fall back to Pillow."""
+    chunks = _png_idat(data)
+    try:
+        width, height, bit_depth, color_type, interlace = next(chunks)
+    except (StopIteration, struct.error, TypeError, ValueError):
+        raise UnsupportedPng("no IHDR")
+    if color_type == 0 or color_type == 3 or color_type == 4:
+        return None  # Pillow opens these as L, P or LA, which never carry stealth data
+    if bit_depth != 8 or interlace or color_type not in (2, 6):
+        raise UnsupportedPng(f"bit depth {bit_depth}, color type {color_type}, interlace {interlace}")
+    bpp = 4 if color_type == 6 else 3
+    stride = 1 + width * bpp
+    total = width * height
+    # rows (and columns, for images shorter than that) holding the header, in column-major order
+    header_rows = min(height, HEADER_PIXELS)
+    header_cols = min(width, -(-HEADER_PIXELS // height))
+
+    inflate = zlib.decompressobj()
+    pending = bytearray()
+    raw_rows = []  # whole filtered rows, until the header tells us how many columns to keep
+    keep = None  # bytes per row kept once the header is read
+    filtered = bytearray()  # filter byte and leading `keep` bytes of every row so far
+    rows = 0
+    header = None
+
+    def lsb_of(prefixes, nrows, ncols):
+        block = np.frombuffer(_unfilter_rows(prefixes, nrows, ncols, bpp), np.uint8).reshape(nrows, ncols, bpp)
+        return lambda start, count: _lsb_pixels(lambda x0, x1: block[:, x0:x1], nrows, start, count)
+
+    for body in chunks:
+        piece = inflate.decompress(body, INFLATE_CHUNK)
+        while piece:
+            pending += piece
+            view = memoryview(pending)
+            offset = 0
+            while len(pending) - offset >= stride and rows < height:
+                if raw_rows is not None:
+                    raw_rows.append(bytes(view[offset:offset + stride]))
+                else:
+                    filtered += view[offset:offset + 1 + keep]
+                offset += stride
+                rows += 1
+                if header is None and rows == header_rows:
+                    prefixes = b"".join(raw[:1 + header_cols * bpp] for raw in raw_rows)
+                    header = _read_header(lsb_of(prefixes, rows, header_cols), total, bpp == 4)
+                    if header is None or header[3] == 0:
+                        return None
+                    needed = header[2] + _payload_pixels(header)
+                    if needed > total:
+                        return None
+                    # keep the columns the payload needs of the buffered rows, then drop them
+                    keep = -(-needed // height) * bpp
+                    filtered = bytearray(b"".join(raw[:1 + keep] for raw in raw_rows))
+                    raw_rows = None
+            view.release()
+            del pending[:offset]
+            if rows == height:
+                return _read_payload(lsb_of(filtered, height, keep // bpp), total, header)
+            piece = inflate.decompress(inflate.unconsumed_tail, INFLATE_CHUNK) if inflate.unconsumed_tail else b""
+    raise ValueError("image file is truncated")
@@ -0,0 +1,60 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+from backfill import Backfill, Checkpoints
+
+
+class Channel:
+    id = 7
+
+    def __init__(self, count: int):
+        self.messages = [SimpleNamespace(id=i, jump_url=f"message {i}") for i in range(1, count + 1)]
+
+    async def history(self, limit=None, after=None, oldest_first=True):
+        for message in self.messages:
+            if after is None or message.id > after.id:
+                yield message
+
+
+def test_corrupt_checkpoint_file_starts_empty(tmp_path, capsys):
+    path = tmp_path / "backfill.json"
+    path.write_text('{"7": 12')  # cut off mid-write by something other than Checkpoints
+    checkpoints = Checkpoints(str(path))
+    assert checkpoints.get(7) is None
+    assert "Ignoring backfill checkpoints" in capsys.readouterr().out
+    checkpoints.set(7, 20)
+    assert json.loads(path.read_text()) == {"7": 20}
+
+
+def test_checkpoints_resume(tmp_path):
+    path = str(tmp_path / "backfill.json")
+
+    async def process(message):
+        return 1, 0
+
+    async def main():
+        job = Backfill(Channel(120), process, Checkpoints(path), batch_size=50)
+        await job.start()
+        resumed = Backfill(Channel(130), process, Checkpoints(path), batch_size=50)
+        await resumed.start()
+        return job.messages, resumed.messages
+    assert asyncio.run(main()) == (120, 10)
+
+
+def test_stopped_backfill_reports_where_it_stopped(tmp_path):
+    async def process(message):
+        await asyncio.sleep(0 if message.id <= 50 else 60)
+        return 1, 1
+
+    async def main():
+        job = Backfill(Channel(200), process, Checkpoints(str(tmp_path / "backfill.json")), batch_size=50)
+        job.start()
+        while job.messages < 50:
+            await asyncio.sleep(0.01)
+        job.task.cancel()
+        await asyncio.wait([job.task])
+        return job
+    job = asyncio.run(main())
+    assert job.progress().startswith("cancelled: 50 messages")
+    assert job.checkpoints.get(Channel.id) == 50
@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+
+from budget import BudgetTimeout, MemoryBudget
+
+
+async def hold(budget: MemoryBudget, nbytes: int, order: list, release: asyncio.Event):
+    async with budget.reserve(nbytes):
+        order.append(nbytes)
+        await release.wait()
+
+
+def test_waiters_are_admitted_first_come_first_served():
+    async def main():
+        budget, order, release = MemoryBudget(max_bytes=100), [], asyncio.Event()
+        first = asyncio.ensure_future(hold(budget, 90, order, release))
+        await asyncio.sleep(0)
+        big = asyncio.ensure_future(hold(budget, 60, order, release))
+        await asyncio.sleep(0)
+        small = asyncio.ensure_future(hold(budget, 5, order, release))  # fits now, but queues behind the 60
+        await asyncio.sleep(0.01)
+        queued = list(order)
+        release.set()
+        await asyncio.gather(first, big, small)
+        return queued, order, budget.stats()
+    queued, order, stats = asyncio.run(main())
+    assert queued == [90] and order == [90, 60, 5]
+    assert stats["used"] == 0 and stats["waiting"] == 0 and stats["admitted"] == 3 and stats["peak"] == 90
+
+
+def test_job_bigger_than_the_budget_runs_alone():
+    async def main():
+        budget = MemoryBudget(max_bytes=100)
+        async with budget.reserve(500):
+            return budget.used
+    assert asyncio.run(main()) == 100
+
+
+def test_budget_timeout():
+    async def main():
+        budget, release = MemoryBudget(max_bytes=100, max_wait=0.05), asyncio.Event()
+        holder = asyncio.ensure_future(hold(budget, 100, [], release))
+        await asyncio.sleep(0)
+        with pytest.raises(BudgetTimeout):
+            async with budget.reserve(10):
+                pass
+        stats = budget.stats()
+        release.set()
+        await holder
+        return stats, budget.used
+    stats, used = asyncio.run(main())
+    assert stats["timeouts"] == 1 and stats["waiting"] == 0 and stats["waiting_bytes"] == 0 and used == 0
+
+
+def test_waiter_cancelled_after_admission_returns_its_bytes():
+    async def main():
+        budget, release, order = MemoryBudget(max_bytes=100), asyncio.Event(), []
+        holder = asyncio.ensure_future(hold(budget, 80, order, release))
+        await asyncio.sleep(0)
+        waiter = asyncio.ensure_future(hold(budget, 50, order, asyncio.Event()))
+        await asyncio.sleep(0)
+        release.set()
+        await holder  # its release admits the waiter, which hasn't run yet
+        admitted = budget.used
+        waiter.cancel()
+        await asyncio.wait([waiter], timeout=1)
+        return admitted, waiter.cancelled(), budget.stats()
+    admitted, cancelled, stats = asyncio.run(main())
+    assert admitted == 50 and cancelled
+    assert stats["used"] == 0 and stats["waiting"] == 0 and stats["admitted"] == 2
+
+
+def test_cancelled_waiter_lets_the_next_one_in():
+    async def main():
+        budget, release, order = MemoryBudget(max_bytes=100), asyncio.Event(), []
+        holder = asyncio.ensure_future(hold(budget, 60, order, release))
+        await asyncio.sleep(0)
+        big = asyncio.ensure_future(hold(budget, 50, order, release))
+        await asyncio.sleep(0)
+        small = asyncio.ensure_future(hold(budget, 30, order, release))
+        await asyncio.sleep(0)
+        big.cancel()  # still queued: the 30 behind it fits and is admitted straight away
+        await asyncio.sleep(0.01)
+        admitted = list(order)
+        release.set()
+        await asyncio.gather(holder, big, small, return_exceptions=True)
+        return admitted, budget.used
+    assert asyncio.run(main()) == ([60, 30], 0)
@@ -0,0 +1,68 @@
+from cache import CacheEntry, MetadataCache
+
+INFO = "a" * 1000  # CacheEntry size: 1000 + 128
+
+
+def test_least_recently_used_is_evicted_first():
+    cache = MetadataCache(max_bytes=3 * 1128)
+    for key in ("a", "b", "c"):
+        cache.put(key, INFO)
+    cache.get_by_hash("a")  # b is now the oldest
+    cache.put("d", INFO)
+    assert list(cache.entries) == ["c", "a", "d"]
+    assert cache.stats()["evictions"] == 1
+
+
+def test_bytes_after_eviction():
+    cache = MetadataCache(max_bytes=3000)
+    cache.put("a", INFO)
+    cache.put("b", INFO)
+    cache.put("c", "x" * 2000)
+    assert list(cache.entries) == ["c"]
+    assert cache.size == sum(entry.size for entry in cache.entries.values()) == 2128
+    cache.put("c", INFO)  # replacing an entry swaps its bytes, not adds them
+    assert cache.size == 1128
+
+
+def test_parsed_results_count_and_can_evict():
+    cache = MetadataCache(max_bytes=3000)
+    old = cache.put("a", INFO)
+    entry = cache.put("b", INFO)
+    cache.set_parsed(entry, "a1111", {"prompt": "x" * 1000})
+    assert list(cache.entries) == ["b"] and cache.size == entry.size
+    cache.set_parsed(old, "a1111", {"prompt": "x"})  # evicted entries aren't counted any more
+    assert cache.size == entry.size
+
+
+def test_stale_entry_after_a_replace_isnt_counted():
+    cache = MetadataCache()
+    stale = cache.put("a", INFO)
+    fresh = cache.put("a", INFO)
+    cache.set_parsed(stale, "a1111", {"prompt": "x" * 1000})
+    assert cache.size == fresh.size == 1128
+
+
+def test_same_image_under_a_second_attachment_id():
+    cache = MetadataCache()
+    entry = cache.put("hash", INFO, attachment_id=1)
+    assert cache.get_by_id(2) is None  # reposted: unknown id, found by content hash
+    assert cache.get_by_hash("hash", attachment_id=2) is entry
+    cache.set_parsed(entry, "a1111", {"prompt": "cat"})
+    assert cache.get_by_id(1).parsed == cache.get_by_id(2).parsed == {"a1111": {"prompt": "cat"}}
+    assert len(cache.entries) == 1
+    assert cache.stats() == {"entries": 1, "bytes": entry.size, "id_hits": 2, "hash_hits": 1, "misses": 1,
+                             "evictions": 0}
+
+
+def test_ids_of_evicted_entries_miss():
+    cache = MetadataCache(max_bytes=1128, max_ids=2)
+    cache.put("a", INFO, attachment_id=1)
+    cache.put("b", INFO, attachment_id=2)
+    assert cache.get_by_id(1) is None and 1 not in cache.ids
+    cache.get_by_hash("b", attachment_id=3)
+    cache.get_by_hash("b", attachment_id=4)
+    assert list(cache.ids) == [3, 4]
+
+
+def test_entry_size():
+    assert CacheEntry("key", None).size == 16 + 128
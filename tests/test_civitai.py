@@ -0,0 +1,190 @@
+import asyncio
+import json
+import time
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from civitai import CivitaiClient
+
+
+class CivitaiStandIn:
+    """Answers by-hash lookups like Civitai: GOOD is a model, MISSING a 404, BROKEN a 500, NULL and LIST
+    answer JSON that isn't a model version, SLOW a model after a delay"""
+
+    def __init__(self):
+        self.hits = {}
+        app = web.Application()
+        app.router.add_get("/api/v1/model-versions/by-hash/{hash}", self.by_hash)
+        self.server = TestServer(app)
+
+    async def by_hash(self, request):
+        key = request.match_info["hash"]
+        self.hits[key] = self.hits.get(key, 0) + 1
+        if key == "MISSING":
+            return web.json_response({"error": "Model not found"}, status=404)
+        if key == "BROKEN":
+            return web.Response(status=500)
+        if key == "NULL":
+            return web.json_response(None)
+        if key == "LIST":
+            return web.json_response([{"modelId": 4201}])
+        if key == "SLOW":
+            await asyncio.sleep(0.2)
+        return web.json_response({"modelId": 4201})
+
+    async def __aenter__(self):
+        await self.server.start_server()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.server.close()
+
+    def client(self, **kwargs) -> CivitaiClient:
+        return CivitaiClient(api_url=str(self.server.make_url("/api/v1")), **kwargs)
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_found_model_is_cached():
+    async def main():
+        async with CivitaiStandIn() as civitai:
+            client = civitai.client()
+            assert await client.lookup("good") == "https://civitai.com/models/4201"
+            assert await client.lookup("GOOD") == "https://civitai.com/models/4201"
+            await client.close()
+            return civitai.hits, client.stats()
+    hits, stats = run(main())
+    assert hits == {"GOOD": 1}
+    assert stats["hits"] == 1 and stats["requests"] == 1
+
+
+def test_unknown_hash_is_cached_as_missing():
+    async def main():
+        async with CivitaiStandIn() as civitai:
+            client = civitai.client()
+            assert await client.lookup("MISSING") is None
+            assert await client.lookup("MISSING") is None
+            await client.close()
+            return civitai.hits
+    assert run(main()) == {"MISSING": 1}
+
+
+def test_server_errors_are_not_cached():
+    async def main():
+        async with CivitaiStandIn() as civitai:
+            client = civitai.client()
+            assert await client.lookup("BROKEN") is None
+            assert await client.lookup("BROKEN") is None
+            await client.close()
+            return civitai.hits, client.stats()
+    hits, stats = run(main())
+    assert hits == {"BROKEN": 2}
+    assert stats["errors"] == 2
+
+
+def test_entries_expire():
+    async def main():
+        async with CivitaiStandIn() as civitai:
+            client = civitai.client(ttl=0.05, negative_ttl=0.05)
+            await client.lookup("GOOD")
+            await client.lookup("MISSING")
+            await asyncio.sleep(0.1)
+            await client.lookup("GOOD")
+            await client.lookup("MISSING")
+            await client.close()
+            return civitai.hits
+    assert run(main()) == {"GOOD": 2, "MISSING": 2}
+
+
+def test_concurrent_lookups_share_one_request():
+    async def main():
+        async with CivitaiStandIn() as civitai:
+            client = civitai.client()
+            results = await asyncio.gather(*(client.lookup("SLOW") for _ in range(20)))
+            await client.close()
+            return civitai.hits, results
+    hits, results = run(main())
+    assert hits == {"SLOW": 1}
+    assert results == ["https://civitai.com/models/4201"] * 20
+
+
+def test_cache_survives_a_restart(tmp_path):
+    path = str(tmp_path / "civitai_cache.json")
+
+    async def main():
+        async with CivitaiStandIn() as civitai:
+            client = civitai.client(cache_path=path)
+            await client.lookup("GOOD")
+            await client.lookup("MISSING")
+            await client.close()
+            restarted = civitai.client(cache_path=path)
+            assert await restarted.lookup("GOOD") == "https://civitai.com/models/4201"
+            assert await restarted.lookup("MISSING") is None
+            await restarted.close()
+            return civitai.hits
+    assert run(main()) == {"GOOD": 1, "MISSING": 1}
+
+
+def test_expired_entries_are_not_loaded(tmp_path):
+    path = tmp_path / "civitai_cache.json"
+    path.write_text(json.dumps([["OLD", "https://civitai.com/models/1", time.time() - 1],
+                                ["NEW", "https://civitai.com/models/2", time.time() + 3600]]))
+    client = CivitaiClient(cache_path=str(path))
+    assert list(client.cache) == ["NEW"]
+
+
+def test_malformed_entries_are_skipped(tmp_path):
+    path = tmp_path / "civitai_cache.json"
+    later = time.time() + 3600
+    path.write_text(json.dumps([["SHORT", later], None, "GOOD", ["BAD", "url", "tomorrow"], [1, None, later],
+                                ["NEW", "https://civitai.com/models/2", later], ["MISS", None, later]]))
+    client = CivitaiClient(cache_path=str(path))
+    assert list(client.cache) == ["NEW", "MISS"]
+    path.write_text('{"NEW": "https://civitai.com/models/2"}')
+    assert list(CivitaiClient(cache_path=str(path)).cache) == []
+
+
+def test_response_that_isnt_a_model_version_is_a_miss():
+    async def main():
+        async with CivitaiStandIn() as civitai:
+            client = civitai.client()
+            results = [await client.lookup("NULL"), await client.lookup("LIST"), await client.lookup("NULL")]
+            await client.close()
+            return results, civitai.hits, client.stats()
+    results, hits, stats = run(main())
+    assert results == [None, None, None]
+    assert hits == {"NULL": 1, "LIST": 1} and stats["errors"] == 0 and stats["entries"] == 2
+
+
+def test_processes_sharing_the_file_keep_each_others_entries(tmp_path):
+    path = str(tmp_path / "civitai_cache.json")
+
+    async def main():
+        async with CivitaiStandIn() as civitai:
+            first, second = civitai.client(cache_path=path), civitai.client(cache_path=path)
+            await first.lookup("GOOD")
+            await second.lookup("MISSING")
+            await first.close()
+            await second.close()
+    run(main())
+    with open(path) as f:
+        assert sorted(key for key, _, _ in json.load(f)) == ["GOOD", "MISSING"]
+
+
+def test_periodic_save_runs_off_the_event_loop(tmp_path):
+    path = str(tmp_path / "civitai_cache.json")
+
+    async def main():
+        async with CivitaiStandIn() as civitai:
+            client = civitai.client(cache_path=path, save_interval=0)
+            await client.lookup("GOOD")
+            assert client._save_task is not None
+            await client._save_task
+            with open(path) as f:
+                saved = json.load(f)
+            await client.close()
+            return saved
+    assert [key for key, _, _ in run(main())] == ["GOOD"]
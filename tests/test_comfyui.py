@@ -0,0 +1,110 @@
+import json
+
+import pytest
+
+from comfyui import ComfyGraph
+from parsing import comfyui_get_data, comfyui_parse
+
+# API format (the `prompt` chunk): KSampler with a checkpoint -> LoRA chain, its seed on a primitive node
+# and its positive prompt behind a ControlNetApplyAdvanced, which carries both sides
+KSAMPLER = {
+    "4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "animagine-xl-3.1.safetensors"}},
+    "10": {"class_type": "LoraLoader", "inputs": {"lora_name": "detail.safetensors", "strength_model": 0.6,
+                                                  "strength_clip": 0.6, "model": ["4", 0], "clip": ["4", 1]}},
+    "6": {"class_type": "CLIPTextEncode", "inputs": {"text": "1girl, shrine, cherry blossoms", "clip": ["10", 1]}},
+    "7": {"class_type": "CLIPTextEncode", "inputs": {"text": "lowres, bad anatomy", "clip": ["10", 1]}},
+    "11": {"class_type": "ControlNetApplyAdvanced", "inputs": {"positive": ["6", 0], "negative": ["7", 0],
+                                                               "control_net": ["12", 0], "image": ["13", 0],
+                                                               "strength": 0.8}},
+    "20": {"class_type": "PrimitiveNode", "inputs": {"value": 1234}},
+    "5": {"class_type": "EmptyLatentImage", "inputs": {"width": 832, "height": 1216, "batch_size": 1}},
+    "3": {"class_type": "KSampler", "inputs": {"seed": ["20", 0], "steps": 28, "cfg": 7.0,
+                                               "sampler_name": "euler_ancestral", "scheduler": "normal",
+                                               "denoise": 1.0, "model": ["10", 0], "positive": ["11", 0],
+                                               "negative": ["11", 1], "latent_image": ["5", 0]}},
+}
+
+# Flux-style SamplerCustomAdvanced: settings live on the RandomNoise/KSamplerSelect/BasicScheduler neighbours,
+# conditioning and model on the guider
+CUSTOM_ADVANCED = {
+    "1": {"class_type": "UNETLoader", "inputs": {"unet_name": "flux1-dev.safetensors", "weight_dtype": "default"}},
+    "2": {"class_type": "CLIPTextEncode", "inputs": {"text": "a cat in a hat", "clip": ["9", 0]}},
+    "3": {"class_type": "BasicGuider", "inputs": {"model": ["1", 0], "conditioning": ["2", 0]}},
+    "4": {"class_type": "RandomNoise", "inputs": {"noise_seed": 42}},
+    "5": {"class_type": "KSamplerSelect", "inputs": {"sampler_name": "euler"}},
+    "6": {"class_type": "BasicScheduler", "inputs": {"scheduler": "simple", "steps": 20, "denoise": 1.0,
+                                                     "model": ["1", 0]}},
+    "7": {"class_type": "SamplerCustomAdvanced", "inputs": {"noise": ["4", 0], "guider": ["3", 0],
+                                                            "sampler": ["5", 0], "sigmas": ["6", 0],
+                                                            "latent_image": ["8", 0]}},
+    "8": {"class_type": "EmptySD3LatentImage", "inputs": {"width": 1024, "height": 1024, "batch_size": 1}},
+}
+
+# UI format (the `workflow` chunk) only: widgets_values without names, links as [id, from, slot, to, slot, type]
+WORKFLOW = {
+    "nodes": [
+        {"id": 4, "type": "CheckpointLoaderSimple", "widgets_values": ["dreamshaper_8.safetensors"]},
+        {"id": 6, "type": "CLIPTextEncode", "widgets_values": ["a red fox in the snow"],
+         "inputs": [{"name": "clip", "link": 3}]},
+        {"id": 7, "type": "CLIPTextEncode", "widgets_values": ["blurry"], "inputs": [{"name": "clip", "link": 5}]},
+        {"id": 8, "type": "CLIPTextEncode", "widgets_values": ["muted prompt"], "mode": 2},
+        {"id": 3, "type": "KSampler", "widgets_values": [99, "fixed", 25, 6.5, "dpmpp_2m", "karras", 1.0],
+         "inputs": [{"name": "model", "link": 1}, {"name": "positive", "link": 4},
+                    {"name": "negative", "link": 6}]},
+    ],
+    "links": [[1, 4, 0, 3, 0, "MODEL"], [3, 4, 1, 6, 0, "CLIP"], [4, 6, 0, 3, 1, "CONDITIONING"],
+              [5, 4, 1, 7, 0, "CLIP"], [6, 7, 0, 3, 2, "CONDITIONING"]],
+}
+
+
+def summary(graph: dict) -> dict:
+    return ComfyGraph.from_json(json.dumps(graph)).summary()
+
+
+def test_ksampler_links_and_conditioning():
+    sampler, = summary(KSAMPLER)["samplers"]
+    assert sampler["positive"] == ["1girl, shrine, cherry blossoms"]
+    assert sampler["negative"] == ["lowres, bad anatomy"]
+    assert sampler["settings"] == {"seed": 1234, "steps": 28, "cfg": 7.0, "sampler_name": "euler_ancestral",
+                                   "scheduler": "normal", "denoise": 1.0, "size": "832x1216"}
+    assert sampler["checkpoints"] == ["animagine-xl-3.1.safetensors"]
+    assert sampler["loras"] == [("detail.safetensors", 0.6)]
+
+
+def test_sampler_custom_advanced():
+    sampler, = summary(CUSTOM_ADVANCED)["samplers"]
+    assert sampler["positive"] == ["a cat in a hat"] and sampler["negative"] == []
+    assert sampler["settings"] == {"seed": 42, "steps": 20, "sampler_name": "euler", "scheduler": "simple",
+                                   "denoise": 1.0, "size": "1024x1024"}
+    assert sampler["checkpoints"] == ["flux1-dev.safetensors"]
+
+
+def test_workflow_only_graph():
+    graph = ComfyGraph.from_json(json.dumps(WORKFLOW))
+    assert graph.source == "workflow" and "8" not in graph.nodes  # muted nodes are left out
+    sampler, = graph.summary()["samplers"]
+    assert sampler["positive"] == ["a red fox in the snow"] and sampler["negative"] == ["blurry"]
+    assert sampler["settings"] == {"seed": 99, "steps": 25, "cfg": 6.5, "sampler_name": "dpmpp_2m",
+                                   "scheduler": "karras", "denoise": 1.0}
+    assert sampler["checkpoints"] == ["dreamshaper_8.safetensors"]
+
+
+def test_link_cycles_end():
+    graph = ComfyGraph.from_json(json.dumps({"1": {"class_type": "Reroute", "inputs": {"x": ["2", 0]}},
+                                             "2": {"class_type": "Reroute", "inputs": {"x": ["1", 0]}}}))
+    assert graph.resolve(["1", 0]) is None
+
+
+def test_embed_fields():
+    fields = comfyui_parse(json.dumps(KSAMPLER))["fields"]
+    assert [field["type"] for field in fields] == ["positive", "negative", "sampler", "model", "lora"]
+    assert fields[3]["val"] == "animagine-xl-3.1.safetensors" and fields[4]["val"] == "detail.safetensors (0.6)"
+
+
+@pytest.mark.parametrize("text", ['[{"inputs": {}}]', '"inputs"', "3"])
+def test_json_that_isnt_a_graph(text):
+    with pytest.raises(ValueError, match="not a ComfyUI graph"):
+        ComfyGraph.from_json(text)
+    with pytest.raises(ValueError, match="not a ComfyUI graph"):
+        comfyui_parse(text)
+    assert comfyui_get_data(text) == []
@@ -0,0 +1,117 @@
+import asyncio
+import io
+import struct
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+
+import containers
+from containers import HeaderInfo, fetch_header, read_header_bytes
+
+
+def png_with_text(text: str) -> bytes:
+    info = PngInfo()
+    info.add_text("parameters", text)
+    out = io.BytesIO()
+    Image.new("RGB", (8, 8)).save(out, "PNG", pnginfo=info)
+    return out.getvalue()
+
+
+def broken_crc(data: bytes) -> bytes:
+    """The same PNG with the CRC of its tEXt chunk flipped"""
+    start = data.index(b"tEXt") - 4
+    length, = struct.unpack_from(">I", data, start)
+    crc = start + 8 + length
+    return data[:crc] + bytes([data[crc] ^ 0xFF]) + data[crc + 1:]
+
+
+def box(box_type: bytes, payload: bytes) -> bytes:
+    return struct.pack(">I", 8 + len(payload)) + box_type + payload
+
+
+def avif_claiming_items(count: int) -> bytes:
+    """An AVIF whose iloc box says it has `count` items but holds none"""
+    iinf = box(b"iinf", b"\0\0\0\0" + struct.pack(">H", 0))
+    iloc = box(b"iloc", b"\2\0\0\0" + b"\x44\x00" + struct.pack(">I", count))
+    return box(b"ftyp", b"avif" + b"\0" * 4) + box(b"meta", b"\0" * 4 + iinf + iloc)
+
+
+class ImageHost:
+    """Serves /good.png, /bad-crc.png, /odd.bin (read by odd_reader), /broken (500) and /stall (headers, then nothing)"""
+
+    def __init__(self):
+        self.good = png_with_text("a cat")
+        app = web.Application()
+        app.router.add_get("/good.png", self.serve(self.good))
+        app.router.add_get("/bad-crc.png", self.serve(broken_crc(self.good)))
+        app.router.add_get("/odd.bin", self.serve(b"ODD!" + b"\0" * 60))
+        app.router.add_get("/broken", self.serve(b"", status=500))
+        app.router.add_get("/stall", self.stall)
+        self.server = TestServer(app)
+
+    @staticmethod
+    def serve(body: bytes, status: int = 200):
+        async def handler(request):
+            return web.Response(body=body, status=status)
+        return handler
+
+    async def stall(self, request):
+        response = web.StreamResponse()
+        await response.prepare(request)
+        await response.write(self.good[:8])
+        await asyncio.sleep(5)
+        return response
+
+    async def __aenter__(self):
+        await self.server.start_server()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.server.close()
+
+    async def fetch(self, path: str, timeout: float = 5):
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None, sock_read=timeout)) as session:
+            return await fetch_header(session, str(self.server.make_url(path)), 1 << 20)
+
+
+def fetch(path: str, **kwargs):
+    async def main():
+        async with ImageHost() as host:
+            return await host.fetch(path, **kwargs)
+    return asyncio.run(main())
+
+
+def test_png_text_is_read():
+    header = fetch("/good.png")
+    assert header.format == "png" and header.text["parameters"] == "a cat"
+
+
+def test_server_error_gives_none():
+    assert fetch("/broken") is None
+
+
+def test_stalled_download_gives_none():
+    assert fetch("/stall", timeout=0.2) is None
+
+
+def test_bad_crc_gives_none():
+    assert fetch("/bad-crc.png") is None
+
+
+def odd_reader(info: HeaderInfo):
+    yield 0, 16
+    return {}["missing"]  # any reader bug, not just the struct/index errors of a short file
+
+
+def test_reader_errors_give_none(monkeypatch):
+    monkeypatch.setattr(containers, "READERS", [("odd", lambda head: head[:4] == b"ODD!", odd_reader)])
+    assert read_header_bytes(b"ODD!" + b"\0" * 60) is None
+    assert fetch("/odd.bin") is None
+
+
+def test_item_count_is_bounded_by_the_box():
+    header = read_header_bytes(avif_claiming_items(0xFFFFFFFF))
+    assert header.format == "avif" and header.text == {}
@@ -0,0 +1,16 @@
+from outbound import Debouncer
+
+
+def test_claim_collapses_repeats_until_released():
+    debounce = Debouncer(window=60)
+    assert debounce.claim(("reaction", 1, 2))
+    assert not debounce.claim(("reaction", 1, 2))
+    debounce.release(("reaction", 1, 2))  # the DM failed
+    assert debounce.claim(("reaction", 1, 2))
+    assert debounce.stats() == {"claimed": 2, "collapsed": 1, "released": 1, "tracked": 1}
+
+
+def test_claims_expire():
+    debounce = Debouncer(window=0)
+    assert debounce.claim("key")
+    assert debounce.claim("key")
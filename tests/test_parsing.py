@@ -0,0 +1,118 @@
+import pytest
+
+from parsing import _tokenize_params, _tokenize_params_re, get_params_from_string, parse_a1111
+
+WEBUI = ('masterpiece, best quality, 1girl, <lora:detail:0.6>\n'
+         'Negative prompt: lowres, bad anatomy, (worst quality:1.4)\n'
+         'Steps: 28, Sampler: DPM++ 2M Karras, CFG scale: 7, Seed: 3307452371, Size: 832x1216, '
+         'Model hash: 7f96a1a9ca, Model: animagine-xl-3.1, Denoising strength: 0.35, Clip skip: 2, '
+         'Hires upscale: 1.5, Hires upscaler: R-ESRGAN 4x+ Anime6B, '
+         'Lora hashes: "detail: 1a2b3c4d5e6f, style: 0f9e8d7c6b5a", Version: v1.8.0')
+CONTROLNET = ('a cat on a windowsill\n'
+              'Steps: 20, Sampler: Euler a, CFG scale: 6.5, Seed: 1, Size: 512x512, Model: dreamshaper_8, '
+              'ControlNet 0: "Module: canny, Model: control_v11p_sd15_canny [d14c016b], Weight: 1.0, '
+              'Resize Mode: Crop and Resize, Guidance Start: 0, Guidance End: 1"')
+
+
+def legacy_get_params_from_string(param_str):
+    """The split on ', ' get_params_from_string used before the tokenizer, kept as the reference for
+    parameter strings without quoted values"""
+    output_dict = {}
+    parts = param_str.split('Steps: ')
+    prompts = parts[0]
+    params = 'Steps: ' + parts[1]
+    if 'Negative prompt: ' in prompts:
+        output_dict['Prompt'] = prompts.split('Negative prompt: ')[0]
+        output_dict['Negative Prompt'] = prompts.split('Negative prompt: ')[1]
+    else:
+        output_dict['Prompt'] = prompts
+    for param in params.split(', '):
+        try:
+            key, value = param.split(': ')
+            output_dict[key] = value
+        except ValueError:
+            pass
+    return output_dict
+
+
+def test_webui_parameters():
+    parsed = parse_a1111(WEBUI)
+    assert parsed["prompt"] == "masterpiece, best quality, 1girl, <lora:detail:0.6>"
+    assert parsed["negative_prompt"] == "lowres, bad anatomy, (worst quality:1.4)"
+    params = parsed["params"]
+    assert params["Steps"] == 28 and params["CFG scale"] == 7 and params["Denoising strength"] == 0.35
+    assert params["Seed"] == 3307452371 and params["Size"] == "832x1216"
+    assert params["Model"] == "animagine-xl-3.1" and params["Hires upscaler"] == "R-ESRGAN 4x+ Anime6B"
+    assert params["Lora hashes"] == {"detail": "1a2b3c4d5e6f", "style": "0f9e8d7c6b5a"}
+    assert parsed["raw"]["Lora hashes"] == "detail: 1a2b3c4d5e6f, style: 0f9e8d7c6b5a"
+    assert params["Version"] == "v1.8.0"
+
+
+def test_quoted_block_keys_dont_leak_out():
+    parsed = parse_a1111(CONTROLNET)
+    assert parsed["params"]["Model"] == "dreamshaper_8"  # not the ControlNet model inside the quotes
+    assert parsed["params"]["ControlNet 0"] == {
+        "Module": "canny", "Model": "control_v11p_sd15_canny [d14c016b]", "Weight": 1.0,
+        "Resize Mode": "Crop and Resize", "Guidance Start": 0, "Guidance End": 1}
+
+
+def test_escaped_quotes():
+    parsed = parse_a1111('a cat\nSteps: 20, Template: "say \\"hi\\", friend", Seed: 5')
+    assert parsed["raw"] == {"Steps": "20", "Template": 'say "hi", friend', "Seed": "5"}
+
+
+def test_odd_quote_count_falls_back_to_the_regex():
+    line = 'Steps: 20, Note: "unbalanced, Seed: 5'
+    assert _tokenize_params(line) == _tokenize_params_re(line) == {"Steps": "20", "Note": '"unbalanced', "Seed": "5"}
+
+
+def test_strict_only_accepts_whole_pair_lists():
+    assert _tokenize_params("Module: canny, Weight: 1.0", strict=True) == {"Module": "canny", "Weight": "1.0"}
+    assert _tokenize_params("just some words", strict=True) is None
+    assert _tokenize_params("Module: canny and then words, 1.0", strict=True) is None
+    # a value with ': ' in it that isn't a block stays text
+    assert parse_a1111('x\nSteps: 1, Note: "time: noon or so, maybe"')["params"]["Note"] == "time: noon or so, maybe"
+
+
+def test_missing_negative_prompt():
+    parsed = parse_a1111("a dog\nSteps: 20, Seed: 1")
+    assert parsed["prompt"] == "a dog" and parsed["negative_prompt"] is None
+    assert "Negative Prompt" not in get_params_from_string("a dog\nSteps: 20, Seed: 1")
+
+
+def test_negative_only():
+    parsed = parse_a1111("Negative prompt: ugly\nSteps: 20, Seed: 1")
+    assert parsed["prompt"] == "" and parsed["negative_prompt"] == "ugly"
+
+
+def test_negative_prompt_over_several_lines():
+    parsed = parse_a1111("a dog\nNegative prompt: ugly,\nblurry\nSteps: 20, Seed: 1")
+    assert parsed["negative_prompt"] == "ugly,\nblurry"
+    assert parsed["raw"] == {"Steps": "20", "Seed": "1"}
+
+
+def test_parameters_glued_onto_the_prompt():
+    parsed = parse_a1111("a dog Negative prompt: ugly Steps: 20, Sampler: Euler")
+    assert parsed["prompt"] == "a dog" and parsed["negative_prompt"] == "ugly"
+    assert parsed["raw"] == {"Steps": "20", "Sampler": "Euler"}
+
+
+PLAIN = [
+    "a dog\nSteps: 20, Seed: 1",
+    "a dog\nNegative prompt: ugly\nSteps: 20, Sampler: Euler a, CFG scale: 7, Seed: 1, Size: 512x512",
+    "Negative prompt: ugly, blurry\nSteps: 20, Seed: 1",
+    "a dog Negative prompt: ugly Steps: 20, Sampler: Euler",
+    WEBUI.replace('"detail: 1a2b3c4d5e6f, style: 0f9e8d7c6b5a"', "1a2b3c"),
+]
+
+
+@pytest.mark.parametrize("text", PLAIN)
+def test_same_fields_as_the_old_split(text):
+    old = {key: value.strip() for key, value in legacy_get_params_from_string(text).items()}
+    assert get_params_from_string(text) == old
+
+
+@pytest.mark.parametrize("text", PLAIN + [WEBUI, CONTROLNET])
+def test_fast_path_agrees_with_the_regex(text):
+    line = text[text.index("Steps: "):]
+    assert _tokenize_params(line) == _tokenize_params_re(line)
@@ -0,0 +1,75 @@
+import asyncio
+import datetime
+from types import SimpleNamespace
+
+from promptindex import PromptIndex
+
+GUILD_ID = 1
+
+
+def message(message_id: int):
+    return SimpleNamespace(id=message_id, guild=SimpleNamespace(id=GUILD_ID), channel=SimpleNamespace(id=2),
+                           author=SimpleNamespace(id=3), created_at=datetime.datetime.now(datetime.timezone.utc))
+
+
+FIELDS = {"format": "a1111", "prompt": "a cat in a hat", "negative": "", "model": "anything", "model_hash": "",
+          "loras": [], "sampler": "Euler a"}
+
+
+def add(index: PromptIndex, n: int, start: int = 0):
+    for i in range(start, start + n):
+        index.add(SimpleNamespace(id=i), message(i), FIELDS)
+
+
+def run_metrics(main) -> dict:
+    metrics = asyncio.run(main())
+    return {key: metrics[key] for key in ("written", "failed_batches", "pending")}
+
+
+def test_full_batches_and_the_rest_are_written_by_close(tmp_path):
+    path = str(tmp_path / "prompts.sqlite3")
+
+    async def main():
+        index = PromptIndex(path, batch_size=10, flush_interval=60)
+        await index.set_guild(GUILD_ID, True)
+        add(index, 25)
+        await index.close()
+        return index.metrics()
+    assert run_metrics(main) == {"written": 25, "failed_batches": 0, "pending": 0}
+
+    async def reopened():
+        index = PromptIndex(path)
+        results = await index.search(GUILD_ID, "cat", limit=100)
+        await index.close()
+        return len(results)
+    assert asyncio.run(reopened()) == 25
+
+
+def test_failed_write_is_logged_and_counted(tmp_path, capsys):
+    async def main():
+        index = PromptIndex(str(tmp_path / "prompts.sqlite3"), batch_size=5, flush_interval=60)
+        await index.set_guild(GUILD_ID, True)
+
+        def broken(rows):
+            raise OSError("disk full")
+        index._write = broken
+        add(index, 5)
+        await asyncio.sleep(0.05)
+        del index._write
+        add(index, 2, start=5)
+        await index.close()
+        return index.metrics()
+    assert run_metrics(main) == {"written": 2, "failed_batches": 1, "pending": 0}
+    assert "Prompt index write failed" in capsys.readouterr().out
+
+
+def test_close_cancels_the_timer(tmp_path):
+    async def main():
+        index = PromptIndex(str(tmp_path / "prompts.sqlite3"), batch_size=100, flush_interval=60)
+        await index.set_guild(GUILD_ID, True)
+        add(index, 3)
+        timer = index._flush_task
+        await asyncio.wait_for(index.close(), 5)
+        return timer.cancelled(), index.metrics()
+    cancelled, metrics = asyncio.run(main())
+    assert cancelled and metrics["written"] == 3
@@ -0,0 +1,71 @@
+import asyncio
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+def test_first_caller_cancelling_leaves_the_others_waiting():
+    started = []
+
+    async def fetch():
+        started.append(1)
+        await asyncio.sleep(0.05)
+        return "metadata"
+
+    async def main():
+        flight = SingleFlight()
+        first = asyncio.ensure_future(flight.do("key", fetch))
+        others = [asyncio.ensure_future(flight.do("key", fetch)) for _ in range(2)]
+        await asyncio.sleep(0)
+        first.cancel()
+        results = await asyncio.gather(*others)
+        return first.cancelled(), results, flight.stats()
+    cancelled, results, stats = asyncio.run(main())
+    assert cancelled and results == ["metadata", "metadata"] and started == [1]
+    assert stats == {"in_flight": 0, "started": 1, "shared": 2}
+
+
+def test_all_callers_cancelling_cancels_the_task():
+    tasks = []
+
+    async def fetch():
+        tasks.append(asyncio.current_task())
+        await asyncio.sleep(60)
+
+    async def quick():
+        return "fresh"
+
+    async def main():
+        flight = SingleFlight()
+        callers = [asyncio.ensure_future(flight.do("key", fetch)) for _ in range(3)]
+        await asyncio.sleep(0)
+        for caller in callers:
+            caller.cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        # the next call doesn't join the abandoned flight, even before its task has finished cancelling
+        result = await flight.do("key", quick)
+        await asyncio.sleep(0)
+        return tasks[0].cancelled(), result, flight.stats()
+    cancelled, result, stats = asyncio.run(main())
+    assert cancelled and result == "fresh"
+    assert stats == {"in_flight": 0, "started": 2, "shared": 2}
+
+
+def test_exception_reaches_every_waiter():
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise OSError("connection reset")
+
+    async def main():
+        flight = SingleFlight()
+        results = await asyncio.gather(*(flight.do("key", fetch) for _ in range(3)), return_exceptions=True)
+        in_flight = len(flight)
+        with pytest.raises(OSError):  # failures aren't remembered, the next call runs it again
+            await flight.do("key", fetch)
+        return results, in_flight
+    results, in_flight = asyncio.run(main())
+    assert [type(r) for r in results] == [OSError] * 3 and in_flight == 0 and len(calls) == 2
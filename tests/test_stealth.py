@@ -0,0 +1,33 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from bench import corpus
+from stealth import read_info_from_image_stealth, read_info_from_png_stealth
+
+TEXT = "masterpiece, 1girl, " * 100 + "\nSteps: 28, Sampler: Euler a, CFG scale: 7, Seed: 1"
+
+
+def decode_both(data: bytes):
+    with Image.open(io.BytesIO(data)) as image:
+        return read_info_from_png_stealth(data), read_info_from_image_stealth(image)
+
+
+@pytest.mark.parametrize("filter_type", range(5))
+@pytest.mark.parametrize("mode,compressed", corpus.STEALTH_MODES)
+def test_every_filter_type_streams_like_pillow(filter_type, mode, compressed):
+    image = corpus.encode_stealth(corpus.base_image(197, 161), TEXT, mode, compressed)
+    assert decode_both(corpus.filtered_png_bytes(image, filter_type)) == (TEXT, TEXT)
+
+
+@pytest.mark.parametrize("size", [(1024, 8), (8, 1024)])
+def test_short_and_narrow_images(size):
+    image = corpus.encode_stealth(corpus.base_image(*size), TEXT, "rgb", True)
+    assert decode_both(corpus.filtered_png_bytes(image, 4)) == (TEXT, TEXT)
+
+
+def test_no_signature():
+    image = Image.fromarray(np.random.default_rng(0).integers(0, 256, (64, 64, 4), dtype=np.uint8), "RGBA")
+    assert decode_both(corpus.filtered_png_bytes(image, 4)) == (None, None)
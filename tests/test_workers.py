@@ -0,0 +1,32 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+from workers import Workers
+
+
+def alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def test_timed_out_job_kills_its_worker_process():
+    async def main():
+        workers = Workers(mode="process", count=1, timeout=1)
+        await workers.run(len, b"")  # start the pool
+        pids = [process.pid for process in workers.executor._processes.values()]
+        with pytest.raises(asyncio.TimeoutError):
+            await workers.run(time.sleep, 60)
+        dead = [not alive(pid) for pid in pids]
+        after = await workers.run(len, b"abc")  # a fresh pool takes over
+        workers.shutdown(wait=True)
+        return pids, dead, after, workers.stats()
+    pids, dead, after, stats = asyncio.run(main())
+    assert pids and all(dead)
+    assert after == 3
+    assert stats["timeouts"] == 1 and stats["recycles"] == 1
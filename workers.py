@@ -0,0 +1,339 @@
+import asyncio
+import hashlib
+import hmac
+import itertools
+import os
+import pickle
+import struct
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+FRAME = struct.Struct("!I")
+NONCE = 32
+HANDSHAKE_SECONDS = 5
+
+
+def _timed_call(func, args):
+    """Runs inside the worker so only the time spent working is counted, not time waiting in the queue"""
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+class Workers:
+    """Runs CPU-bound work (image decoding, big JSON) off the event loop.
+
+    mode is "process" or "thread". Process workers are replaced after `max_tasks` jobs. When a job times
+    out the pool's processes are killed and a fresh pool takes over, so a stuck decode can't hold a slot
+    (or its memory) forever; the timeout is only raised once they have exited, so callers holding memory
+    budget for the job keep it until the memory is really free. Other jobs the kill interrupted are run
+    again on the new pool. Thread mode can't stop a hung job: it keeps its thread until it returns."""
+
+    def __init__(self, mode: str = "process", count: int = None, timeout: float = 30, max_tasks: int = 500):
+        if mode not in ("process", "thread"):
+            raise ValueError(f"Unknown worker mode {mode!r}")
+        self.mode = mode
+        self.count = count or os.cpu_count() or 1
+        self.timeout = timeout
+        self.max_tasks = max_tasks
+        self.executor = None
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.recycles = 0
+        self.busy_seconds = 0.0
+        self.started_at = time.monotonic()
+        self._tasks_since_recycle = 0
+
+    def _new_executor(self):
+        if self.mode == "process":
+            return ProcessPoolExecutor(max_workers=self.count)
+        return ThreadPoolExecutor(max_workers=self.count, thread_name_prefix="pi-worker")
+
+    def recycle(self):
+        """Swaps in a fresh pool and returns the old one. Jobs already running in it finish in the background."""
+        old, self.executor = self.executor, self._new_executor()
+        self._tasks_since_recycle = 0
+        if old is not None:
+            self.recycles += 1
+            old.shutdown(wait=False)
+        return old
+
+    @staticmethod
+    def _kill(processes: list):
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join(5)
+            if process.is_alive():
+                process.kill()
+                process.join()
+
+    async def run(self, func, *args):
+        """Runs `func(*args)` in the pool. func must be a module-level function for process mode."""
+        result, _ = await self.run_timed(func, *args)
+        return result
+
+    async def run_timed(self, func, *args) -> tuple:
+        """run(), also returning the seconds the worker spent on it"""
+        while True:
+            if self.executor is None or (self.mode == "process" and self._tasks_since_recycle >= self.max_tasks):
+                self.recycle()
+            self._tasks_since_recycle += 1
+            self.in_flight += 1
+            executor = self.executor
+            future = executor.submit(_timed_call, func, args)
+            try:
+                result, elapsed = await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                if self.mode == "process" and executor is self.executor:  # not already replaced by another timeout
+                    # taken before recycle(): shutting the pool down forgets its processes (_processes = None)
+                    processes = list((executor._processes or {}).values())
+                    self.recycle()
+                    await asyncio.to_thread(self._kill, processes)
+                raise
+            except BrokenProcessPool:
+                if executor is self.executor:
+                    self.failed += 1
+                    raise
+                continue  # killed along with a job that timed out, run it again on the new pool
+            except Exception:
+                self.failed += 1
+                raise
+            finally:
+                self.in_flight -= 1
+            self.completed += 1
+            self.busy_seconds += elapsed
+            return result, elapsed
+
+    def stats(self) -> dict:
+        uptime = time.monotonic() - self.started_at
+        return {
+            "mode": self.mode,
+            "workers": self.count,
+            "in_flight": self.in_flight,
+            "queued": max(0, self.in_flight - self.count),
+            "busy": min(self.in_flight, self.count),
+            "completed": self.completed,
+            "failed": self.failed,
+            "timeouts": self.timeouts,
+            "recycles": self.recycles,
+            "utilisation": self.busy_seconds / (uptime * self.count) if uptime else 0.0,
+        }
+
+    def shutdown(self, wait: bool = False):
+        """Stops the pool, dropping queued jobs. wait=True blocks until the workers have exited, which a
+        CLI should do once its jobs are done so the interpreter doesn't exit under the pool's threads."""
+        if self.executor is not None:
+            self.executor.shutdown(wait=wait, cancel_futures=True)
+            self.executor = None
+
+
+async def _write_frame(writer: asyncio.StreamWriter, message):
+    data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    writer.write(FRAME.pack(len(data)) + data)
+    await writer.drain()
+
+
+async def _read_frame(reader: asyncio.StreamReader):
+    size, = FRAME.unpack(await reader.readexactly(FRAME.size))
+    return pickle.loads(await reader.readexactly(size))
+
+
+def _secret(secret) -> bytes:
+    if not secret:
+        raise ValueError("the parse server needs PARSE_SECRET set, it won't run jobs from unauthenticated peers")
+    return secret.encode("utf-8") if isinstance(secret, str) else secret
+
+
+async def _handshake(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, secret: bytes, role: bytes):
+    """Both ends prove they know the secret (HMAC of the other's random nonce) before either unpickles
+    anything the other sent. The role is mixed in so a peer can't reflect the proof it was sent."""
+    nonce = os.urandom(NONCE)
+    writer.write(nonce)
+    await writer.drain()
+    theirs = await reader.readexactly(NONCE)
+    writer.write(hmac.new(secret, role + theirs, hashlib.sha256).digest())
+    await writer.drain()
+    proof = await reader.readexactly(hashlib.sha256().digest_size)
+    other = b"client" if role == b"server" else b"server"
+    if not hmac.compare_digest(proof, hmac.new(secret, other + nonce, hashlib.sha256).digest()):
+        raise PermissionError("parse server handshake failed: the peer doesn't have PARSE_SECRET")
+
+
+class ParseServer:
+    """Serves a Workers pool to the bot processes of a sharded deployment, so one pool sized to the
+    machine's cores is shared instead of every process starting its own.
+
+    Jobs and results are pickled, so running one is running code as the bot. The server listens on a
+    Unix socket only its user can open (0600) and each connection has to pass an HMAC handshake with
+    the shared `secret` before any frame is unpickled; without a secret it refuses to start."""
+
+    def __init__(self, workers: Workers, path: str, secret):
+        self.workers = workers
+        self.path = path
+        self.secret = _secret(secret)
+        self.server = None
+        self.connections = 0
+        self.rejected = 0
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # left over from a previous run
+        umask = os.umask(0o177)  # the socket is created 0600, nobody else can connect even briefly
+        try:
+            self.server = await asyncio.start_unix_server(self._handle, self.path)
+        finally:
+            os.umask(umask)
+        return self.server
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            await asyncio.wait_for(_handshake(reader, writer, self.secret, b"server"), HANDSHAKE_SECONDS)
+        except (PermissionError, asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError) as e:
+            self.rejected += 1
+            print(f"Parse server rejected a connection: {type(e).__name__}: {e}")
+            writer.close()
+            return
+        self.connections += 1
+        lock = asyncio.Lock()
+        jobs = set()
+
+        async def job(job_id, func, args):
+            try:
+                reply = (job_id, True, *await self.workers.run_timed(func, *args))
+            except Exception as e:  # asyncio.TimeoutError included: the pool already recycled itself
+                reply = (job_id, False, e, 0.0)
+            async with lock:
+                try:
+                    await _write_frame(writer, reply)
+                except (pickle.PicklingError, TypeError, AttributeError) as e:
+                    await _write_frame(writer, (job_id, False, RuntimeError(f"unpicklable result: {e}"), 0.0))
+
+        try:
+            await _write_frame(writer, {"workers": self.workers.count, "mode": self.workers.mode})
+            while True:
+                task = asyncio.create_task(job(*await _read_frame(reader)))
+                jobs.add(task)
+                task.add_done_callback(jobs.discard)
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass  # the bot process went away, or the server is shutting down
+        finally:
+            self.connections -= 1
+            for task in jobs:
+                task.cancel()
+            writer.close()
+
+
+class RemoteWorkers:
+    """Workers interface over a ParseServer's Unix socket, authenticated with the same secret. Jobs are
+    multiplexed over one connection, which is opened again on the next job if it drops; jobs in
+    flight when it drops fail with ConnectionError."""
+
+    def __init__(self, path: str, secret, timeout: float = 30):
+        self.path = path
+        self.secret = _secret(secret)
+        self.mode = "remote"
+        self.count = 0  # the server's pool size, known once connected
+        self.timeout = timeout
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.reconnects = 0
+        self.busy_seconds = 0.0
+        self.started_at = time.monotonic()
+        self._ids = itertools.count()
+        self._waiting = {}  # job id -> future
+        self._writer = None
+        self._reader_task = None
+        self._connecting = asyncio.Lock()
+        self._sending = asyncio.Lock()
+
+    async def _connect(self):
+        async with self._connecting:
+            if self._writer is not None and not self._writer.is_closing():
+                return
+            reader, writer = await asyncio.open_unix_connection(self.path)
+            try:
+                await asyncio.wait_for(_handshake(reader, writer, self.secret, b"client"), HANDSHAKE_SECONDS)
+            except BaseException:
+                writer.close()
+                raise
+            self._writer = writer
+            self.count = (await _read_frame(reader))["workers"]
+            if self._reader_task is not None:
+                self.reconnects += 1
+            self._reader_task = asyncio.create_task(self._read(reader, self._writer))
+
+    async def _read(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                job_id, ok, result, elapsed = await _read_frame(reader)
+                future = self._waiting.pop(job_id, None)
+                if future is None or future.done():
+                    continue
+                if ok:
+                    self.busy_seconds += elapsed
+                    future.set_result(result)
+                else:
+                    future.set_exception(result)
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            writer.close()
+            for future in self._waiting.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(f"parse server connection lost: {e}"))
+            self._waiting.clear()
+
+    async def run(self, func, *args):
+        """Runs `func(*args)` on the server's pool. func must be a module-level function."""
+        await self._connect()
+        job_id = next(self._ids)
+        future = self._waiting[job_id] = asyncio.get_running_loop().create_future()
+        self.in_flight += 1
+        try:
+            async with self._sending:
+                await _write_frame(self._writer, (job_id, func, args))
+            # a little over the server's own timeout, which answers with the TimeoutError itself
+            result = await asyncio.wait_for(future, self.timeout + 5)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self._waiting.pop(job_id, None)
+            self.in_flight -= 1
+        self.completed += 1
+        return result
+
+    def stats(self) -> dict:
+        uptime = time.monotonic() - self.started_at
+        count = self.count or 1
+        return {
+            "mode": self.mode,
+            "workers": self.count,
+            "in_flight": self.in_flight,
+            "queued": max(0, self.in_flight - count),  # as seen from this process, others share the pool
+            "busy": min(self.in_flight, count),
+            "completed": self.completed,
+            "failed": self.failed,
+            "timeouts": self.timeouts,
+            "recycles": self.reconnects,
+            "utilisation": self.busy_seconds / (uptime * count) if uptime else 0.0,
+        }
+
+    def shutdown(self, wait: bool = False):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None